@@ -1,9 +1,10 @@
 #!/usr/bin/python
 import sys
 import os
-import yaml
 import optparse
 
+from s3tests import results
+
 NANOSECONDS = int(1e9)
 
 # Output stats in a format similar to siege
@@ -21,6 +22,52 @@ Successful transactions: {trans_success:>11}
 Failed transactions:     {trans_fail:>11}
 Longest transaction:     {trans_long:>11.2f}
 Shortest transaction:    {trans_short:>11.2f}
+50th percentile:         {trans_p50:>11.2f}
+90th percentile:         {trans_p90:>11.2f}
+99th percentile:         {trans_p99:>11.2f}
+99.9th percentile:       {trans_p999:>11.2f}
+"""
+
+# Only for results that record connection reuse
+CONNECTIONS_FORMAT = """New connections:         {new:>11} hits
+New connection time:     {new_time:>11.2f} secs
+Reused connections:      {reused:>11} hits
+Reused connection time:  {reused_time:>11.2f} secs
+"""
+
+# Only for results that record the popularity rank of their object
+HOTCOLD_FORMAT = """Hot key transactions:    {hot:>11} hits
+Hot key response time:   {hot_time:>11.2f} secs
+Hot key 99th percentile: {hot_p99:>11.2f} secs
+Cold key transactions:   {cold:>11} hits
+Cold key response time:  {cold_time:>11.2f} secs
+Cold key 99th percentile:{cold_p99:>11.2f} secs
+"""
+
+# Only for results that record the timing of their request
+TIMING_FORMAT = "{name:<25}{mean:>11.4f} secs, 99th percentile {p99:.4f} secs\n"
+TIMING_NAMES = dict(
+    prepare='Prepare time:',
+    connect='Connect time:',
+    send='Send time:',
+    wait='Server wait time:',
+    receive='Receive time:',
+    )
+
+# Only for multipart uploads that record their parts
+PARTS_FORMAT = """Parts:                   {parts:>11} hits
+Part response time:      {part_time:>11.2f} secs
+Part 99th percentile:    {part_p99:>11.2f} secs
+Part throughput:         {part_rate:>11.2f} MB/sec
+"""
+
+# Only for roundtrip runs with read-after-write checks
+VISIBILITY_FORMAT = """Visibility from {delay} secs:
+Objects seen:            {visible:>11} of {total}
+Mean lag:                {mean:>11.3f} secs
+50th percentile lag:     {p50:>11.3f} secs
+99th percentile lag:     {p99:>11.3f} secs
+Longest lag:             {max:>11.3f} secs
 """
 
 def parse_options():
@@ -28,10 +75,16 @@ def parse_options():
     parser = optparse.OptionParser(usage=usage)
     parser.add_option(
         "-f", "--file", dest="input", metavar="FILE",
-        help="Name of input YAML file. Default uses sys.stdin")
+        help="Name of input results file, in any of the formats readwrite and "
+             "roundtrip write. Default uses sys.stdin")
     parser.add_option(
         "-v", "--verbose", dest="verbose", action="store_true",
         help="Enable verbose output")
+    parser.add_option(
+        "--hot-ranks", dest="hot_ranks", type="int", metavar="N",
+        help="Count objects of popularity rank below N as hot. Default "
+             "uses the hot set of the access distribution of the run, "
+             "which aggregated results are always split by")
 
     (options, args) = parser.parse_args()
 
@@ -44,29 +97,115 @@ def parse_options():
 def main():
     (options, args) = parse_options()
 
-    total     = {}
-    durations = {}
-    min_time  = {}
-    max_time  = {}
-    errors    = {}
-    success   = {}
+    total      = {}
+    histograms = {}
+    reuse      = {}
+    hotcold    = {}
+    timings    = {}
+    visibility = {}
+    parts      = {}
+    min_time   = {}
+    max_time   = {}
+    errors     = {}
+    success    = {}
 
-    calculate_stats(options, total, durations, min_time, max_time, errors,
-                    success)
-    print_results(total, durations, min_time, max_time, errors, success)
+    calculate_stats(options, total, histograms, reuse, hotcold, timings,
+                    visibility, parts, min_time, max_time, errors, success)
+    print_results(total, histograms, reuse, hotcold, timings, visibility,
+                  parts, min_time, max_time, errors, success)
+
+def update_time_boundaries(type_, start, end, min_time, max_time):
+    prev = min_time.setdefault(type_, start)
+    if start < prev:
+        min_time[type_] = start
+    prev = max_time.setdefault(type_, end)
+    if end > prev:
+        max_time[type_] = end
+
+def add_timing(type_, components, timings):
+    """
+    Records the parts of a request from results.timing_components, or
+    merges their Histograms.
+    """
+    parts = timings.setdefault(type_, {})
+    for name, value in components.iteritems():
+        if name not in parts:
+            parts[name] = results.Histogram()
+        if isinstance(value, results.Histogram):
+            parts[name].merge(value)
+        else:
+            parts[name].record(max(value, 0))
 
-def calculate_stats(options, total, durations, min_time, max_time, errors,
-                    success):
+def add_histogram(item, total, histograms, reuse, hotcold, timings, parts,
+                  min_time, max_time, errors, success):
+    """
+    Adds up an interval of an aggregated run, as written by the
+    readwrite and roundtrip --aggregate option, labelled as the
+    operations are.
+    """
+    type_ = item['op']
+    latency = results.Histogram.from_dict(item['latency'])
+    errors[type_] = errors.get(type_, 0) + item['errors']
+    if not latency.count:
+        return
+    success[type_] = success.get(type_, 0) + latency.count
+    total[type_] = total.get(type_, 0) + item['bytes']['total']
+    update_time_boundaries(type_, item['start'], item['end'], min_time,
+                           max_time)
+    if type_ in histograms:
+        histograms[type_].merge(latency)
+    else:
+        histograms[type_] = latency
+    if 'timing' in item:
+        add_timing(type_, dict(
+                (name, results.Histogram.from_dict(histogram))
+                for name, histogram in item['timing'].iteritems()
+                ), timings)
+    if 'reuse' in item:
+        counts = reuse.setdefault(type_, {True: [0, 0], False: [0, 0]})
+        for (reused, key) in [(True, 'reused'), (False, 'new')]:
+            counts[reused][0] += item['reuse'][key][0]
+            counts[reused][1] += item['reuse'][key][1]
+    # split by the hot set of the run, whatever --hot-ranks says
+    for (hot, key) in [(True, 'hot'), (False, 'cold')]:
+        if key in item:
+            latency = hotcold.setdefault(type_, {})
+            if hot not in latency:
+                latency[hot] = results.Histogram()
+            latency[hot].merge(results.Histogram.from_dict(item[key]))
+    if 'parts' in item:
+        (latency, size, busy) = parts.get(type_, (results.Histogram(), 0, 0))
+        latency.merge(results.Histogram.from_dict(item['parts']['latency']))
+        parts[type_] = (latency, size + item['parts']['size'],
+                        busy + item['parts']['busy'])
+
+def calculate_stats(options, total, histograms, reuse, hotcold, timings,
+                    visibility, parts, min_time, max_time, errors, success):
     print 'Calculating statistics...'
     
     f = sys.stdin
     if options.input:
-        f = file(options.input, 'r')
+        f = file(options.input, 'rb')
 
-    for item in yaml.safe_load_all(f):
+    hot_ranks = options.hot_ranks
+    for item in results.load_all(f):
         type_ = item.get('type')
-        if type_ not in ('r', 'w'):
+        if type_ == 'config' and hot_ranks is None:
+            hot_ranks = item.get('access', {}).get('hot_ranks')
+            continue
+        if type_ == 'histogram':
+            add_histogram(item, total, histograms, reuse, hotcold, timings,
+                          parts, min_time, max_time, errors, success)
+            continue
+        if type_ == 'visibility_lag':
+            (lags, missing) = visibility.get(item['delay'], (results.Histogram(), 0))
+            lags.merge(results.Histogram.from_dict(item['lag']))
+            visibility[item['delay']] = (lags, missing + item['missing'])
+            continue
+        if type_ not in results.OP_TYPES:
             continue # ignore any invalid items
+        # each size of a part size sweep and of ranged reads on its own
+        type_ = results.result_label(item)
 
         if 'error' in item:
             errors[type_] = errors.get(type_, 0) + 1
@@ -75,7 +214,7 @@ def calculate_stats(options, total, durations, min_time, max_time, errors,
             success[type_] = success.get(type_, 0) + 1
 
         # parse the item
-        data_size = item['chunks'][-1][0]
+        data_size = results.result_size(item)
         duration = item['duration']
         start = item['start']
         end = start + duration / float(NANOSECONDS)
@@ -90,38 +229,68 @@ def calculate_stats(options, total, durations, min_time, max_time, errors,
                 )
 
         # update time boundaries
-        prev = min_time.setdefault(type_, start)
-        if start < prev:
-            min_time[type_] = start
-        prev = max_time.setdefault(type_, end)
-        if end > prev:
-            max_time[type_] = end
-
-        # save the duration
-        if type_ not in durations:
-            durations[type_] = []
-        durations[type_].append(duration)
+        update_time_boundaries(type_, start, end, min_time, max_time)
+
+        # record the duration; the histograms take the same memory
+        # however many results there are
+        if type_ not in histograms:
+            histograms[type_] = results.Histogram()
+        histograms[type_].record(duration)
+
+        # split by whether the connection was reused, where recorded
+        if 'reused' in item:
+            counts = reuse.setdefault(type_, {True: [0, 0], False: [0, 0]})
+            counts[item['reused']][0] += 1
+            counts[item['reused']][1] += duration
+
+        # split by whether the object is a popular one
+        if 'rank' in item and hot_ranks is not None:
+            latency = hotcold.setdefault(type_, {})
+            hot = item['rank'] < hot_ranks
+            if hot not in latency:
+                latency[hot] = results.Histogram()
+            latency[hot].record(duration)
+
+        # time the parts of a multipart upload, where recorded
+        if 'parts' in item:
+            (latency, size, busy) = parts.get(type_, (results.Histogram(), 0, 0))
+            for part in item['parts']:
+                latency.record(part['duration'])
+                size += part['size']
+                busy += part['duration']
+            parts[type_] = (latency, size, busy)
+
+        # split into the parts of the request, where recorded
+        if 'timing' in item:
+            add_timing(type_, results.timing_components(item['timing']),
+                       timings)
 
         # add to running totals
         total[type_] = total.get(type_, 0) + data_size
 
-def print_results(total, durations, min_time, max_time, errors, success):
+def print_results(total, histograms, reuse, hotcold, timings, visibility,
+                  parts, min_time, max_time, errors, success):
     for type_ in total.keys():
+        latency = histograms[type_]
+
         trans_success = success.get(type_, 0)
         trans_fail    = errors.get(type_, 0)
         trans         = trans_success + trans_fail
         avail         = trans_success * 100.0 / trans
         elapsed       = max_time[type_] - min_time[type_]
         data          = total[type_] / 1024.0 / 1024.0 # convert to MB
-        resp_time     = sum(durations[type_]) / float(NANOSECONDS) / \
-                        len(durations[type_])
+        resp_time     = latency.mean() / float(NANOSECONDS)
         trans_rate    = trans / elapsed
         data_rate     = data / elapsed
         conc          = trans_rate * resp_time
-        trans_long    = max(durations[type_]) / float(NANOSECONDS)
-        trans_short   = min(durations[type_]) / float(NANOSECONDS)
+        trans_long    = latency.max / float(NANOSECONDS)
+        trans_short   = latency.min / float(NANOSECONDS)
+        trans_p50     = latency.percentile(50) / float(NANOSECONDS)
+        trans_p90     = latency.percentile(90) / float(NANOSECONDS)
+        trans_p99     = latency.percentile(99) / float(NANOSECONDS)
+        trans_p999    = latency.percentile(99.9) / float(NANOSECONDS)
 
-        print OUTPUT_FORMAT.format(
+        output = OUTPUT_FORMAT.format(
             type=type_,
             trans_success=trans_success,
             trans_fail=trans_fail,
@@ -135,6 +304,60 @@ def print_results(total, durations, min_time, max_time, errors, success):
             conc=conc,
             trans_long=trans_long,
             trans_short=trans_short,
+            trans_p50=trans_p50,
+            trans_p90=trans_p90,
+            trans_p99=trans_p99,
+            trans_p999=trans_p999,
+            )
+        if type_ in reuse:
+            (new, new_total) = reuse[type_][False]
+            (reused, reused_total) = reuse[type_][True]
+            output += CONNECTIONS_FORMAT.format(
+                new=new,
+                new_time=new_total / float(NANOSECONDS) / max(new, 1),
+                reused=reused,
+                reused_time=reused_total / float(NANOSECONDS) / max(reused, 1),
+                )
+        if type_ in hotcold:
+            hot = hotcold[type_].get(True, results.Histogram())
+            cold = hotcold[type_].get(False, results.Histogram())
+            output += HOTCOLD_FORMAT.format(
+                hot=hot.count,
+                hot_time=(hot.mean() or 0) / float(NANOSECONDS),
+                hot_p99=(hot.percentile(99) or 0) / float(NANOSECONDS),
+                cold=cold.count,
+                cold_time=(cold.mean() or 0) / float(NANOSECONDS),
+                cold_p99=(cold.percentile(99) or 0) / float(NANOSECONDS),
+                )
+        if type_ in parts:
+            (latency, size, busy) = parts[type_]
+            output += PARTS_FORMAT.format(
+                parts=latency.count,
+                part_time=(latency.mean() or 0) / float(NANOSECONDS),
+                part_p99=(latency.percentile(99) or 0) / float(NANOSECONDS),
+                part_rate=size / 1024.0 / 1024.0 / max(busy / float(NANOSECONDS), 1e-9),
+                )
+        for name in results.TIMING_COMPONENTS:
+            part = timings.get(type_, {}).get(name)
+            if part is None or not part.count:
+                continue
+            output += TIMING_FORMAT.format(
+                name=TIMING_NAMES[name],
+                mean=part.mean() / float(NANOSECONDS),
+                p99=part.percentile(99) / float(NANOSECONDS),
+                )
+        print output
+
+    for delay in sorted(visibility):
+        (lags, missing) = visibility[delay]
+        print VISIBILITY_FORMAT.format(
+            delay=delay,
+            visible=lags.count,
+            total=lags.count + missing,
+            mean=(lags.mean() or 0) / float(NANOSECONDS),
+            p50=(lags.percentile(50) or 0) / float(NANOSECONDS),
+            p99=(lags.percentile(99) or 0) / float(NANOSECONDS),
+            max=(lags.max or 0) / float(NANOSECONDS),
             )
 
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+import optparse
+import time
+
+import realistic
+
+
+def parse_options():
+    parser = optparse.OptionParser(
+        usage='%prog [OPTS]',
+        )
+    parser.add_option("--size", dest="size", type="int", default=1024,
+        help="megabytes of content to generate per run (default %default)")
+    parser.add_option("--read-size", dest="read_size", type="int", default=8192,
+        help="bytes per read() call; boto reads 8192 at a time (default %default)")
+    parser.add_option("--seed", dest="seed", type="int", default=1256193726,
+        help="seed for the generated content")
+
+    return parser.parse_args()
+
+
+def bench_read(size, read_size, seed):
+    fp = realistic.RandomContentFile(size=size, seed=seed)
+    start = time.time()
+    while fp.read(read_size):
+        pass
+    return time.time() - start
+
+
+def bench_readinto(size, read_size, seed):
+    fp = realistic.RandomContentFile(size=size, seed=seed)
+    buf = bytearray(read_size)
+    start = time.time()
+    while fp.readinto(buf):
+        pass
+    return time.time() - start
+
+
+def main():
+    """
+    Measures how fast RandomContentFile produces data on a single core,
+    so the load generator's own ceiling is known before blaming the
+    server.
+    """
+    (options, args) = parse_options()
+
+    size = options.size * 1024 * 1024
+    for name, func in [('read', bench_read), ('readinto', bench_readinto)]:
+        elapsed = func(size, options.read_size, options.seed)
+        print '{name:>8}: {size} MB in {elapsed:.2f} secs, {rate:.3f} GB/s'.format(
+            name=name,
+            size=options.size,
+            elapsed=elapsed,
+            rate=size / elapsed / 1e9,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,18 @@
 import boto.s3.connection
 import bunch
+import ctypes
+import ctypes.util
+import gevent
 import itertools
 import os
 import random
 import string
+import sys
+import threading
+import time
+import traceback
+import warnings
+import weakref
 import yaml
 import re
 from lxml import etree
@@ -89,7 +98,213 @@ def read_config(fp):
         config.update(bunch.bunchify(new))
     return config
 
-def connect(conf):
+def _monotonic_clock(platform=sys.platform, find_library=ctypes.util.find_library):
+    """
+    Returns a function giving the seconds on CLOCK_MONOTONIC, which
+    never jumps with changes to the system time. Only Linux is
+    supported, as the number of the clock differs between systems;
+    elsewhere, or if clock_gettime cannot be found, this warns and
+    falls back to time.time.
+    """
+    class timespec(ctypes.Structure):
+        _fields_ = [
+            ('tv_sec', ctypes.c_long),
+            ('tv_nsec', ctypes.c_long),
+            ]
+    if not platform.startswith('linux'):
+        warnings.warn('no monotonic clock on {platform}, timing with time.time'.format(platform=platform))
+        return time.time
+    # clock_gettime is in librt before glibc 2.17, and in libc since
+    path = find_library('rt') or find_library('c')
+    try:
+        if path is None:
+            raise OSError('neither librt nor libc found')
+        clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+    except (OSError, AttributeError) as e:
+        warnings.warn('no monotonic clock ({e}), timing with time.time'.format(e=e))
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    # from <linux/time.h>
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+# greenlet-local once gevent has patched threading
+_timers = threading.local()
+
+class RequestTimer(object):
+    """
+    Notes when the steps of the last HTTP request made by the current
+    greenlet (or thread) while the timer is active happened, as
+    nanoseconds since the timer started, on the monotonic clock:
+
+      - request: the request started
+      - connect_start, connected: a new connection was opened; this
+        covers the DNS lookup, TCP connect and, with TLS, the handshake
+      - sent: the whole request, with its body, was sent
+      - first_byte: the status line and headers of the response arrived
+      - last_byte: the timer stopped, after the response was read
+
+    Only requests on connections of a TimedS3Connection are timed.
+    Use as a context manager; the marks are in `marks`.
+    """
+    def __init__(self):
+        self.marks = {}
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic()
+        _timers.current = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.mark('last_byte')
+        _timers.current = None
+
+    def mark(self, name):
+        self.marks[name] = int(round((monotonic() - self.start) * 1e9))
+
+def run_request(bucket, result, func, timing=True):
+    """
+    Runs `func`, which makes its requests through `bucket`, as one
+    operation, and returns what it returns, or None if it failed.
+
+    Records in `result` the start of the operation and its duration in
+    nanoseconds, then either the error it raised or, with `timing`, the
+    RequestTimer marks of its request, and whether it reused a
+    connection, where the connection counts the ones it opens. Leave
+    out the timing of operations of several requests, as the marks
+    only cover the last of them.
+    """
+    opened = getattr(bucket.connection, 'opened', None)
+    timer = RequestTimer()
+    value = None
+    start = time.time()
+    try:
+        with timer:
+            value = func()
+    except gevent.GreenletExit:
+        raise
+    except Exception as e:
+        # stop timer ASAP, even on errors
+        end = time.time()
+        result.update(
+            error=dict(
+                msg=str(e),
+                traceback=traceback.format_exc(),
+                ),
+            )
+        # certain kinds of programmer errors make this a busy
+        # loop; let parent greenlet get some time too
+        time.sleep(0)
+    else:
+        end = time.time()
+        if timing and 'request' in timer.marks:
+            result['timing'] = timer.marks
+    result.update(
+        start=start,
+        duration=int(round((end - start) * 1e9)),
+        )
+    if opened is not None:
+        result['reused'] = bucket.connection.opened == opened
+    return value
+
+def _mark(name, reset=False):
+    timer = getattr(_timers, 'current', None)
+    if timer is not None:
+        if reset:
+            timer.marks.clear()
+        timer.mark(name)
+
+def _time_http_connection(connection):
+    """
+    Makes `connection` mark the steps of its requests in the active
+    RequestTimer. boto uses the httplib API of its connections in a few
+    different ways, but always through these methods.
+    """
+    # a weak reference, so dropped connections still close right away
+    # instead of waiting for the garbage collector to break the cycle
+    ref = weakref.ref(connection)
+    cls = connection.__class__
+
+    def timed_putrequest(*args, **kwargs):
+        _mark('request', reset=True)
+        return cls.putrequest(ref(), *args, **kwargs)
+
+    def timed_connect():
+        _mark('connect_start')
+        cls.connect(ref())
+        _mark('connected')
+
+    def timed_getresponse(*args, **kwargs):
+        _mark('sent')
+        response = cls.getresponse(ref(), *args, **kwargs)
+        _mark('first_byte')
+        return response
+
+    connection.putrequest = timed_putrequest
+    connection.connect = timed_connect
+    connection.getresponse = timed_getresponse
+    return connection
+
+class TimedS3Connection(boto.s3.connection.S3Connection):
+    """
+    An S3Connection whose HTTP connections mark the steps of their
+    requests in the active RequestTimer.
+    """
+    def new_http_connection(self, host, port, is_secure):
+        connection = super(TimedS3Connection, self).new_http_connection(host, port, is_secure)
+        return _time_http_connection(connection)
+
+class PooledS3Connection(TimedS3Connection):
+    """
+    An S3Connection with explicit control over reusing its HTTP
+    connections: at most `pool_size` of them are kept for reuse, none
+    without `keepalive`, and each is dropped after serving
+    `max_requests` requests, if set. `opened` counts the HTTP
+    connections it has opened so far.
+    """
+    def __init__(self, pool_size=1, keepalive=True, max_requests=None, **kwargs):
+        super(PooledS3Connection, self).__init__(**kwargs)
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.max_requests = max_requests
+        self.opened = 0
+
+    def new_http_connection(self, host, port, is_secure):
+        self.opened += 1
+        return super(PooledS3Connection, self).new_http_connection(host, port, is_secure)
+
+    def get_http_connection(self, host, port, is_secure):
+        connection = super(PooledS3Connection, self).get_http_connection(host, port, is_secure)
+        connection.s3tests_requests = getattr(connection, 's3tests_requests', 0) + 1
+        return connection
+
+    def put_http_connection(self, host, port, is_secure, connection):
+        # the response may not have been read yet, so connections that
+        # are not kept are just dropped, and close once it is done
+        if not self.keepalive:
+            return
+        if self.max_requests and connection.s3tests_requests >= self.max_requests:
+            return
+        if self._pool.size() >= self.pool_size:
+            return
+        super(PooledS3Connection, self).put_http_connection(host, port, is_secure, connection)
+
+def connect(conf, pool=None):
+    """
+    Connects to S3 as configured in `conf`. With `pool` settings
+    (pool_size, keepalive, max_requests), the connection is a
+    PooledS3Connection using them, otherwise a TimedS3Connection.
+    """
     mapping = dict(
         port='port',
         host='host',
@@ -114,7 +329,14 @@ def connect(conf):
                 'calling_format unknown: %r' % raw_calling_format
                 )
     # TODO test vhost calling format
-    conn = boto.s3.connection.S3Connection(**kwargs)
+    if pool is not None:
+        kwargs.update(
+            pool_size=pool.get('pool_size', 1),
+            keepalive=pool.get('keepalive', True),
+            max_requests=pool.get('max_requests'),
+            )
+        return PooledS3Connection(**kwargs)
+    conn = TimedS3Connection(**kwargs)
     return conn
 
 def setup():
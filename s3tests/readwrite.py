@@ -1,7 +1,11 @@
 import gevent
 import gevent.pool
 import gevent.queue
+import gevent.fileobject
+import gevent.threadpool
 import gevent.monkey; gevent.monkey.patch_all()
+import bisect
+import functools
 import itertools
 import optparse
 import os
@@ -9,104 +13,399 @@ import sys
 import time
 import traceback
 import random
+import tempfile
 import yaml
 
 import realistic
+import results
 import common
 
 NANOSECOND = int(1e9)
 
-def reader(bucket, worker_id, file_names, queue, rand):
-    while True:
-        objname = rand.choice(file_names)
-        key = bucket.new_key(objname)
+# name of the object describing a dataset bucket
+MANIFEST = 's3tests-manifest.yaml'
 
-        fp = realistic.FileValidator()
-        result = dict(
-                type='r',
-                bucket=bucket.name,
-                key=key.name,
-                worker=worker_id,
-                )
+class Verification(object):
+    """
+    Picks the reads that verify the contents they read, one in `every`,
+    and where their contents are hashed: with `threads`, in a pool of
+    that many threads shared by all readers, off the gevent hub, and
+    otherwise inline in the reading greenlet.
+    """
+    def __init__(self, every=1, threads=0):
+        if every < 1:
+            raise ValueError('verify every must be at least 1, not {every!r}'.format(every=every))
+        if threads < 0:
+            raise ValueError('verify threads must not be negative, not {threads!r}'.format(threads=threads))
+        self.every = every
+        self.threads = threads
+        self.reads = itertools.count()
+        # made on first use, so every worker process has its own
+        self.pool = None
 
-        start = time.time()
-        try:
-            key.get_contents_to_file(fp._file)
-        except gevent.GreenletExit:
-            raise
-        except Exception as e:
-            # stop timer ASAP, even on errors
-            end = time.time()
-            result.update(
-                error=dict(
-                    msg=str(e),
-                    traceback=traceback.format_exc(),
-                    ),
-                )
-            # certain kinds of programmer errors make this a busy
-            # loop; let parent greenlet get some time too
-            time.sleep(0)
-        else:
-            end = time.time()
-
-            if not fp.valid():
-                m='md5sum check failed start={s} ({se}) end={e} size={sz} obj={o}'.format(s=time.ctime(start), se=start, e=end, sz=fp._file.tell(), o=objname)
-                result.update(
-                    error=dict(
-                        msg=m,
-                        traceback=traceback.format_exc(),
-                        ),
-                    )
-                print "ERROR:", m
-            else:
-                elapsed = end - start
-                result.update(
-                    start=start,
-                    duration=int(round(elapsed * NANOSECOND)),
-                    )
-        queue.put(result)
+    def describe(self):
+        return dict(every=self.every, threads=self.threads)
 
-def writer(bucket, worker_id, file_names, files, queue, rand):
-    while True:
-        fp = next(files)
-        fp.seek(0)
-        objname = rand.choice(file_names)
-        key = bucket.new_key(objname)
+    def file(self):
+        """
+        Returns a file to read the next object into, and whether it
+        verifies the contents.
+        """
+        if next(self.reads) % self.every:
+            return (realistic.FileSizer(), False)
+        if not self.threads:
+            return (realistic.FileValidator(), True)
+        if self.pool is None:
+            self.pool = gevent.threadpool.ThreadPool(self.threads)
+        return (realistic.FileValidator(pool=self.pool), True)
 
-        result = dict(
-            type='w',
+def read_object(bucket, worker_id, objname, verify=None):
+    """
+    Reads and validates a single object, returning the result. With a
+    Verification `verify`, only the reads it picks are validated.
+    """
+    key = bucket.new_key(objname)
+
+    if verify is None:
+        (fp, verified) = (realistic.FileValidator(), True)
+    else:
+        (fp, verified) = verify.file()
+    result = dict(
+            type='r',
             bucket=bucket.name,
             key=key.name,
             worker=worker_id,
+            verified=verified,
             )
 
-        start = time.time()
+    common.run_request(bucket, result, lambda: key.get_contents_to_file(fp))
+    if 'error' in result:
+        return result
+    if verified and not fp.valid():
+        start = result['start']
+        end = start + result['duration'] / float(NANOSECOND)
+        m='md5sum check failed start={s} ({se}) end={e} size={sz} obj={o}'.format(s=time.ctime(start), se=start, e=end, sz=fp.size, o=objname)
+        result.update(
+            error=dict(
+                msg=m,
+                traceback=traceback.format_exc(),
+                ),
+            )
+        print "ERROR:", m
+    else:
+        result['size'] = fp.size
+    return result
+
+def write_object(bucket, worker_id, objname, fp):
+    """
+    Writes a single object from `fp`, returning the result.
+    """
+    fp.seek(0)
+    key = bucket.new_key(objname)
+
+    result = dict(
+        type='w',
+        bucket=bucket.name,
+        key=key.name,
+        worker=worker_id,
+        )
+
+    common.run_request(bucket, result, lambda: key.set_contents_from_file(fp))
+    if 'error' not in result:
+        result['size'] = fp.size
+    return result
+
+def run_op(bucket, type_, worker_id, objname, func, timing=True):
+    """
+    Runs `func`, which returns the number of bytes it transferred, as a
+    single operation of type `type_` on `objname`, returning the result.
+    Without `timing`, the parts of its requests are not timed.
+    """
+    result = dict(
+        type=type_,
+        bucket=bucket.name,
+        key=objname,
+        worker=worker_id,
+        )
+
+    size = common.run_request(bucket, result, func, timing=timing)
+    if 'error' not in result:
+        result['size'] = size
+    return result
+
+def head_object(bucket, worker_id, objname):
+    def head():
+        if bucket.get_key(objname) is None:
+            raise RuntimeError('{name} not found'.format(name=objname))
+        return 0
+    return run_op(bucket, 'head', worker_id, objname, head)
+
+def list_objects(bucket, worker_id, objname, delimiter, max_keys):
+    """
+    Lists the keys next to `objname`: those sharing its prefix up to
+    the last `delimiter`, if it has one.
+    """
+    prefix = ''
+    if delimiter and delimiter in objname:
+        prefix = objname[:objname.rindex(delimiter) + 1]
+    def list_():
+        bucket.get_all_keys(prefix=prefix, delimiter=delimiter, max_keys=max_keys)
+        return 0
+    return run_op(bucket, 'list', worker_id, objname, list_)
+
+def copy_object(bucket, worker_id, objname):
+    """
+    Copies `objname` within the bucket, to the name delete_object
+    deletes, so both leave the objects that are read alone.
+    """
+    def copy():
+        bucket.copy_key(objname + '.copy', bucket.name, objname)
+        return 0
+    return run_op(bucket, 'copy', worker_id, objname, copy)
+
+def delete_object(bucket, worker_id, objname):
+    """
+    Deletes the copy of `objname` that copy_object makes, whether or
+    not there is one.
+    """
+    def delete():
+        bucket.delete_key(objname + '.copy')
+        return 0
+    return run_op(bucket, 'delete', worker_id, objname, delete)
+
+def read_range(bucket, worker_id, objname, offset, length):
+    def read():
+        key = bucket.new_key(objname)
+        data = key.get_contents_as_string(headers=dict(
+                Range='bytes={first}-{last}'.format(first=offset, last=offset + length - 1),
+                ))
+        return len(data)
+    result = run_op(bucket, 'range', worker_id, objname, read)
+    result.update(offset=offset, length=length)
+    return result
+
+def write_multipart(bucket, worker_id, objname, fp, part_size):
+    """
+    Writes `fp` to `objname` as a multipart upload of `part_size` byte
+    parts, uploaded one after another.
+    """
+    def write():
+        fp.seek(0)
+        upload = bucket.initiate_multipart_upload(objname)
         try:
-            key.set_contents_from_file(fp)
-        except gevent.GreenletExit:
+            part_num = 1
+            offset = 0
+            while True:
+                size = min(part_size, fp.size - offset)
+                upload.upload_part_from_file(fp, part_num, size=size)
+                offset += size
+                if offset >= fp.size:
+                    break
+                part_num += 1
+            upload.complete_upload()
+        except:
+            upload.cancel_upload()
             raise
-        except Exception as e:
-            # stop timer ASAP, even on errors
-            end = time.time()
-            result.update(
-                error=dict(
-                    msg=str(e),
-                    traceback=traceback.format_exc(),
-                    ),
-                )
-            # certain kinds of programmer errors make this a busy
-            # loop; let parent greenlet get some time too
-            time.sleep(0)
-        else:
-            end = time.time()
+        return fp.size
+    return run_op(bucket, 'multipart', worker_id, objname, write, timing=False)
+
+# operations of the ops config, by name
+OPS = dict(
+    read=read_object,
+    write=write_object,
+    head=head_object,
+    list=list_objects,
+    copy=copy_object,
+    delete=delete_object,
+    range=read_range,
+    multipart=write_multipart,
+    )
+
+class OpMix(object):
+    """
+    Picks operations on objects picked by `access` at random, in the
+    proportions of the (operation name, weight) pairs in `weights`,
+    and fills in their arguments: new contents from `files`, the
+    `list`, `range` and `multipart` settings of the readwrite config,
+    and the Verification `verify` of reads.
+
+    `object_sizes` maps object names to their known sizes, so ranged
+    reads start inside the object; it is kept up to date by passing
+    results to record().
+
+    Raises ValueError if a weight is negative or none is positive.
+    """
+    def __init__(self, weights, access, files, object_sizes, settings=None, verify=None):
+        self.names = []
+        self.cumulative = []
+        self.total = 0
+        for (name, weight) in weights:
+            if weight < 0:
+                raise ValueError('weight of {name} must not be negative'.format(name=name))
+            self.names.append(name)
+            self.total += weight
+            self.cumulative.append(self.total)
+        if self.total <= 0:
+            raise ValueError('operation mix needs a positive weight')
+        self.access = access
+        self.files = files
+        self.object_sizes = object_sizes
+        self.verify = verify
+        settings = settings or {}
+        list_ = settings.get('list') or {}
+        self.delimiter = list_.get('delimiter', '/')
+        self.max_keys = list_.get('max_keys', 1000)
+        self.range_size = (settings.get('range') or {}).get('size', 64) * 1024
+        self.part_size = (settings.get('multipart') or {}).get('part_size', 5 * 1024) * 1024
+
+    def choose(self, rand):
+        """
+        Returns the name of a random operation in OPS, its keyword
+        arguments except for the bucket and worker id, and the
+        popularity rank of its object.
+        """
+        (objname, rank) = self.access.choose(rand)
+        name = self.names[bisect.bisect_right(self.cumulative, rand.random() * self.total)]
+        kwargs = dict(objname=objname)
+        if name in ('write', 'multipart'):
+            fp = next(self.files)
+            kwargs['fp'] = fp
+            # until it is done, the object may have either size
+            if objname in self.object_sizes:
+                self.object_sizes[objname] = min(self.object_sizes[objname], fp.size)
+        if name == 'read':
+            kwargs['verify'] = self.verify
+        elif name == 'multipart':
+            kwargs['part_size'] = self.part_size
+        elif name == 'list':
+            kwargs.update(delimiter=self.delimiter, max_keys=self.max_keys)
+        elif name == 'range':
+            size = self.object_sizes.get(objname, 1)
+            kwargs.update(offset=rand.randrange(max(size, 1)), length=self.range_size)
+        return (name, kwargs, rank)
 
-            elapsed = end - start
+    def record(self, result, name):
+        """
+        Tags `result` with the name of the operation that made it, and
+        keeps the size of written objects.
+        """
+        result['operation'] = name
+        if result['type'] in ('w', 'multipart') and 'error' not in result:
+            self.object_sizes[result['key']] = result['size']
+
+def add_rank(result, rank):
+    """
+    Records the popularity rank of the object in `result`, if the
+    access distribution has one.
+    """
+    if rank is not None:
+        result['rank'] = rank
+    return result
+
+def mixer(bucket, worker_id, mix, queue, rand):
+    while True:
+        (name, kwargs, rank) = mix.choose(rand)
+        result = add_rank(OPS[name](bucket=bucket, worker_id=worker_id, **kwargs), rank)
+        mix.record(result, name)
+        queue.put(result)
+
+def reader(bucket, worker_id, access, queue, rand, verify=None):
+    while True:
+        (objname, rank) = access.choose(rand)
+        queue.put(add_rank(read_object(bucket, worker_id, objname, verify), rank))
+
+def writer(bucket, worker_id, access, files, queue, rand):
+    while True:
+        fp = next(files)
+        (objname, rank) = access.choose(rand)
+        queue.put(add_rank(write_object(bucket, worker_id, objname, fp), rank))
+
+def run_scheduled(name, intended, worker_id, idle, queue, mix, rank, **kwargs):
+    """
+    Runs the scheduled operation `name` as worker `worker_id`, timing it from
+    its `intended` start so time spent waiting for a free worker counts
+    as latency, and hands the worker back to `idle` afterwards.
+    """
+    try:
+        result = add_rank(OPS[name](worker_id=worker_id, **kwargs), rank)
+        mix.record(result, name)
+        if 'start' in result:
+            lag = int(round((result['start'] - intended) * NANOSECOND))
             result.update(
-                start=start,
-                duration=int(round(elapsed * NANOSECOND)),
+                start=intended,
+                duration=result['duration'] + lag,
+                lag=lag,
                 )
-
         queue.put(result)
+    finally:
+        idle.put(worker_id)
+
+def scheduler(buckets, mix, queue, rand, rate, arrivals):
+    """
+    Open-loop load: starts operations picked from the OpMix `mix` at
+    `rate` per second, with exponentially distributed ('poisson') or
+    fixed ('constant') gaps, whether or not earlier ones have finished.
+    At most one operation per bucket in `buckets` runs at once, using
+    that bucket; when all of them are busy, the schedule falls behind,
+    which is recorded in a final 'schedule' result.
+    """
+    idle = gevent.queue.Queue()
+    for worker_id in xrange(len(buckets)):
+        idle.put(worker_id)
+    group = gevent.pool.Group()
+
+    scheduled = 0
+    late = 0
+    max_behind = 0.0
+    total_behind = 0.0
+    intended = time.time()
+    try:
+        while True:
+            if arrivals == 'poisson':
+                intended += rand.expovariate(rate)
+            else:
+                intended += 1.0 / rate
+            delay = intended - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            worker_id = idle.get()
+            behind = time.time() - intended
+            scheduled += 1
+            if behind > 0.001:
+                late += 1
+                total_behind += behind
+                max_behind = max(max_behind, behind)
+
+            (name, kwargs, rank) = mix.choose(rand)
+            group.spawn(
+                run_scheduled,
+                name,
+                intended=intended,
+                worker_id=worker_id,
+                idle=idle,
+                queue=queue,
+                mix=mix,
+                rank=rank,
+                bucket=buckets[worker_id],
+                **kwargs
+                )
+    finally:
+        group.kill(block=True)
+        print 'Schedule: {late} of {n} operations started late, by up to {behind:.3f} secs'.format(
+            late=late,
+            n=scheduled,
+            behind=max_behind,
+            )
+        queue.put(dict(
+                type='schedule',
+                rate=rate,
+                arrivals=arrivals,
+                scheduled=scheduled,
+                late=late,
+                max_behind=int(round(max_behind * NANOSECOND)),
+                total_behind=int(round(total_behind * NANOSECOND)),
+                ))
 
 def parse_options():
     parser = optparse.OptionParser(
@@ -114,8 +413,32 @@ def parse_options():
         )
     parser.add_option("--no-cleanup", dest="cleanup", action="store_false",
         help="skip cleaning up all created buckets", default=True)
+    parser.add_option("--processes", dest="processes", type="int", default=1,
+        help="split the readers and writers over N worker processes", metavar="N")
+    parser.add_option("--format", dest="format", type="choice", default="yaml",
+        choices=sorted(results.FORMATS),
+        help="format of the results: yaml, jsonl or binary, which only the same Python version reads back (default %default)")
+    parser.add_option("--aggregate", dest="aggregate", type="float",
+        help="instead of every operation, write latency and size histograms "
+             "of each operation type every SECONDS", metavar="SECONDS")
+    parser.add_option("--live", dest="live", type="float",
+        help="print the throughput, errors and latency of each operation "
+             "type to stderr every SECONDS while running", metavar="SECONDS")
+    parser.add_option("--live-file", dest="live_file",
+        help="also append the --live statistics to PATH as JSON lines",
+        metavar="PATH")
 
-    return parser.parse_args()
+    (options, args) = parser.parse_args()
+    if options.processes < 1:
+        parser.error("--processes must be at least 1")
+    if options.aggregate is not None and options.aggregate <= 0:
+        parser.error("--aggregate must be positive")
+    if options.live is not None and options.live <= 0:
+        parser.error("--live must be positive")
+    if options.live_file is not None and options.live is None:
+        parser.error("--live-file needs --live")
+
+    return (options, args)
 
 def write_file(bucket, file_name, fp):
     """
@@ -125,6 +448,591 @@ def write_file(bucket, file_name, fp):
     key = bucket.new_key(file_name)
     key.set_contents_from_file(fp)
 
+def read_manifest(bucket):
+    """
+    Returns what the dataset in `bucket` was made with, as saved by
+    write_manifest, or None if that is not known.
+    """
+    key = bucket.get_key(MANIFEST)
+    if key is None:
+        return None
+    return yaml.safe_load(key.get_contents_as_string())
+
+def write_manifest(bucket, manifest):
+    key = bucket.new_key(MANIFEST)
+    key.set_contents_from_string(yaml.safe_dump(manifest, default_flow_style=False))
+
+def dataset_inventory(bucket, file_names, manifest, description):
+    """
+    Returns the sizes of the objects of `file_names` in the dataset
+    `bucket` that were made as `description` says, for warmup to skip.
+
+    Unless the `manifest` of the bucket already says so, the objects
+    there may have the right size but not the right contents, so they
+    are deleted instead, and then `description` is saved as the
+    manifest. That happens before any uploads, so that the next run
+    carries on with a warmup that was cut short or partly failed.
+    """
+    names = set(file_names)
+    listed = dict(
+        (key.name, key.size)
+        for key in bucket.list()
+        if key.name in names
+        )
+    if manifest == description:
+        return listed
+    if listed:
+        deleted = bucket.delete_keys(listed.keys())
+        if deleted.errors:
+            raise RuntimeError('Cannot delete {n} files of the dataset, first: {name}: {msg}'.format(
+                    n=len(deleted.errors),
+                    name=deleted.errors[0].key,
+                    msg=deleted.errors[0].message,
+                    ))
+    write_manifest(bucket, description)
+    return {}
+
+def warmup(bucket, file_names, files, workers, inventory):
+    """
+    Uploads a file from `files` to each of `file_names`, `workers` at
+    a time, skipping the names that `inventory` (a dict of object names
+    to sizes) already has at the size the file would have.
+
+    Returns the size of every object, and the number of uploads done
+    and failed.
+    """
+    object_sizes = {}
+    pool = gevent.pool.Pool(size=workers)
+    uploads = []
+    for file_name in file_names:
+        # always take the next file, so every name gets the same one
+        # whether or not earlier names were skipped
+        fp = next(files)
+        object_sizes[file_name] = fp.size
+        if inventory.get(file_name) == fp.size:
+            continue
+        uploads.append(pool.spawn(
+                write_file,
+                bucket=bucket,
+                file_name=file_name,
+                fp=fp,
+                ))
+    pool.join()
+    failed = len([g for g in uploads if not g.successful()])
+    return (object_sizes, len(uploads), failed)
+
+def make_plans(conf, seeds):
+    """
+    Returns a plan for every phase of the run: its settings, duration,
+    (worker id, seed) pairs for its writers and readers, open-loop
+    schedule if it has a rate, and operation mix if it has ops.
+
+    Phases come from the optional `phases` list; each one overrides the
+    top-level duration, readers, writers, rate, arrivals and ops.
+    Without it, the run is a single phase with the top-level settings.
+    """
+    defaults = dict(
+        duration=conf.duration,
+        readers=conf.readers,
+        writers=conf.writers,
+        )
+    for item in ['rate', 'arrivals', 'ops']:
+        if item in conf:
+            defaults[item] = conf[item]
+    phases = []
+    for phase in conf.get('phases') or [{}]:
+        settings = dict(defaults)
+        settings.update(phase)
+        phases.append(settings)
+
+    # the same worker id gets the same seed in every phase
+    rand_writer = random.Random(seeds['writer'])
+    writer_seeds = [
+        rand_writer.randrange(2**32)
+        for x in xrange(max(settings['writers'] for settings in phases))
+        ]
+    rand_reader = random.Random(seeds['reader'])
+    reader_seeds = [
+        rand_reader.randrange(2**32)
+        for x in xrange(max(settings['readers'] for settings in phases))
+        ]
+    rand_scheduler = random.Random(seeds['scheduler'])
+
+    plans = []
+    for settings in phases:
+        writers = []
+        # Don't create random files if deterministic_files_names is set and true
+        if not conf.get('deterministic_file_names'):
+            writers = list(enumerate(writer_seeds[:settings['writers']]))
+        # If zero readers are specified, it will behave as expected
+        # (no data is read)
+        readers = list(enumerate(reader_seeds[:settings['readers']]))
+
+        schedule = None
+        if 'rate' in settings:
+            schedule = dict(
+                rate=float(settings['rate']),
+                arrivals=settings.get('arrivals', 'poisson'),
+                seed=rand_scheduler.randrange(2**32),
+                )
+            if schedule['rate'] <= 0:
+                raise RuntimeError("Bad readwrite config item: rate must be positive")
+            if schedule['arrivals'] not in ('poisson', 'constant'):
+                raise RuntimeError("Bad readwrite config item: arrivals must be poisson or constant")
+            if not writers and not readers:
+                raise RuntimeError("readwrite rate needs at least one reader or writer")
+
+        ops = None
+        if 'ops' in settings:
+            weights = sorted(settings['ops'].iteritems())
+            for (name, weight) in weights:
+                if name not in OPS:
+                    raise RuntimeError("Bad readwrite config item: unknown op: {name}".format(name=name))
+                if weight < 0:
+                    raise RuntimeError("Bad readwrite config item: ops weights must not be negative")
+            if not sum(weight for (name, weight) in weights):
+                raise RuntimeError("Bad readwrite config item: ops needs a positive weight")
+            ops = dict(
+                weights=weights,
+                settings=dict(
+                    (item, conf.get(item))
+                    for item in ['list', 'range', 'multipart']
+                    ),
+                )
+
+        plans.append(dict(
+                settings=settings,
+                duration=settings['duration'],
+                writers=writers,
+                readers=readers,
+                schedule=schedule,
+                ops=ops,
+                ))
+    return plans
+
+def run_phases(bucket, access, files, plans, queue, new_bucket=None, object_sizes=None, verify=None):
+    """
+    Runs every phase in `plans` in turn, putting the results in `queue`,
+    tagged with their phase if there is more than one. Returns a
+    summary of every phase.
+    """
+    if object_sizes is None:
+        object_sizes = {}
+    summaries = []
+    for (index, plan) in enumerate(plans):
+        settings = plan['settings']
+        if len(plans) > 1:
+            print 'Phase {index}: {settings}'.format(index=index, settings=settings)
+        if plan['schedule'] is not None:
+            print "Starting {arrivals} arrivals at {rate} operations/sec".format(**plan['schedule'])
+        print "Spawning {w} writers and {r} readers...".format(w=len(plan['writers']), r=len(plan['readers']))
+
+        stats = PhaseStats(index, settings, queue, tag=len(plans) > 1)
+        start = time.time()
+        run_workers(
+            bucket=bucket,
+            access=access,
+            files=files,
+            writers=plan['writers'],
+            readers=plan['readers'],
+            queue=stats,
+            duration=plan['duration'],
+            schedule=plan['schedule'],
+            new_bucket=new_bucket,
+            ops=plan['ops'],
+            object_sizes=object_sizes,
+            verify=verify,
+            )
+        elapsed = time.time() - start
+        summaries.append(stats.summary(elapsed))
+    return summaries
+
+class PhaseStats(object):
+    """
+    Throughput and latency of the operation results of one phase,
+    used as the workers' queue: results put in it are counted, tagged
+    with the phase if `tag` is set, and passed on to `queue`.
+
+    Latency percentiles come from a uniform sample of at most
+    `max_samples` durations, so memory use does not grow with the
+    length of the phase.
+    """
+    def __init__(self, index, settings, queue, tag=False, max_samples=10000):
+        self.index = index
+        self.settings = settings
+        self.queue = queue
+        self.tag = tag
+        self.max_samples = max_samples
+        self.rand = random.Random(index)
+        self.ops = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_duration = 0
+        self.max_duration = 0
+        self.durations = []
+
+    def put(self, result):
+        if self.tag:
+            result['phase'] = self.index
+        self.add(result)
+        self.queue.put(result)
+
+    def add(self, result):
+        if result.get('type') not in results.OP_TYPES:
+            return
+        if 'error' in result:
+            self.errors += 1
+            return
+        self.ops += 1
+        self.bytes += result.get('size', 0)
+        duration = result['duration']
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        # reservoir sampling
+        if len(self.durations) < self.max_samples:
+            self.durations.append(duration)
+        else:
+            i = self.rand.randrange(self.ops)
+            if i < self.max_samples:
+                self.durations[i] = duration
+
+    def summary(self, elapsed):
+        durations = sorted(self.durations)
+        def percentile(p):
+            if not durations:
+                return 0
+            return durations[min(len(durations) - 1, int(len(durations) * p))]
+        return dict(
+            type='phase',
+            phase=self.index,
+            settings=self.settings,
+            elapsed=int(round(elapsed * NANOSECOND)),
+            ops=self.ops,
+            errors=self.errors,
+            bytes=self.bytes,
+            ops_per_sec=self.ops / elapsed,
+            mb_per_sec=self.bytes / 1024.0 / 1024.0 / elapsed,
+            latency=dict(
+                mean=self.total_duration / self.ops if self.ops else 0,
+                p50=percentile(0.5),
+                p99=percentile(0.99),
+                max=self.max_duration,
+                ),
+            )
+
+def merge_phase_summaries(summaries, settings):
+    """
+    Combines the summaries of the same phase from several processes.
+    Counts and rates add up and the mean latency is weighted by
+    operations; the percentiles and maximum are the worst of any
+    process, which bounds the combined ones from above.
+    """
+    ops = sum(summary['ops'] for summary in summaries)
+    merged = dict(
+        type='phase',
+        phase=summaries[0]['phase'],
+        settings=settings,
+        elapsed=max(summary['elapsed'] for summary in summaries),
+        ops=ops,
+        errors=sum(summary['errors'] for summary in summaries),
+        bytes=sum(summary['bytes'] for summary in summaries),
+        ops_per_sec=sum(summary['ops_per_sec'] for summary in summaries),
+        mb_per_sec=sum(summary['mb_per_sec'] for summary in summaries),
+        latency=dict(
+            mean=sum(summary['latency']['mean'] * summary['ops'] for summary in summaries) / ops if ops else 0,
+            ),
+        )
+    for item in ['p50', 'p99', 'max']:
+        merged['latency'][item] = max(summary['latency'][item] for summary in summaries)
+    return merged
+
+def find_knee(summaries, min_gain=0.1, max_latency_jump=2.0):
+    """
+    Returns the index of the last phase whose added load still paid
+    off, i.e. the phase before the first one whose throughput grew by
+    less than `min_gain` (relative) or whose p99 latency grew more than
+    `max_latency_jump` times. Returns None if throughput kept scaling.
+    """
+    for (prev, cur) in zip(summaries, summaries[1:]):
+        if not prev['ops_per_sec']:
+            continue
+        gain = cur['ops_per_sec'] / prev['ops_per_sec'] - 1
+        jump = 1.0
+        if prev['latency']['p99']:
+            jump = cur['latency']['p99'] / float(prev['latency']['p99'])
+        if gain < min_gain or jump > max_latency_jump:
+            return prev['phase']
+    return None
+
+def report_phases(summaries, queue):
+    """
+    Prints per-phase throughput and latency and the saturation knee,
+    and puts them in `queue` as results.
+    """
+    for summary in summaries:
+        print 'Phase {phase}: {ops_per_sec:.2f} ops/sec, {mb_per_sec:.2f} MB/sec, p50 {p50:.3f} secs, p99 {p99:.3f} secs, {errors} errors'.format(
+            p50=summary['latency']['p50'] / float(NANOSECOND),
+            p99=summary['latency']['p99'] / float(NANOSECOND),
+            **summary
+            )
+        queue.put(summary)
+    knee = find_knee(summaries)
+    if knee is None:
+        print 'No saturation knee: throughput kept scaling'
+    else:
+        print 'Saturation knee at phase {phase}: {settings}'.format(
+            phase=knee,
+            settings=summaries[knee]['settings'],
+            )
+    queue.put(dict(
+            type='knee',
+            phase=knee,
+            ))
+
+def worker_bucket(config, bucket_name):
+    """
+    Opens `bucket_name` on a connection of its own, with the HTTP
+    connection pool settings in readwrite.connections.
+    """
+    conn = common.connect(config.s3, pool=config.readwrite.connections)
+    return conn.get_bucket(bucket_name, validate=False)
+
+def run_workers(bucket, access, files, writers, readers, queue, duration, schedule=None, new_bucket=None, ops=None, object_sizes=None, verify=None):
+    """
+    Runs a writer and a reader greenlet per (worker id, seed) pair in
+    `writers` and `readers` for `duration` seconds, putting their
+    results in `queue`.
+
+    With `ops` (weights and settings of an operation mix), every one
+    of those workers runs operations from the mix instead. With a
+    `schedule` (rate, arrivals and seed), operations are instead
+    started open-loop by a scheduler, with as many workers as there are
+    writers and readers, from the mix or else reads and writes in the
+    same proportion as readers and writers.
+
+    All workers share `bucket`, and so its connection pool, unless
+    `new_bucket` is set; then every worker gets a bucket of its own
+    from calling it. Reads are verified as the Verification `verify`
+    decides, or all inline without it.
+    """
+    group = gevent.pool.Group()
+    workers = len(writers) + len(readers)
+    if new_bucket is None:
+        buckets = [bucket] * workers
+    else:
+        buckets = [new_bucket() for _ in xrange(workers)]
+    if object_sizes is None:
+        object_sizes = {}
+    mix = None
+    if ops is not None:
+        mix = OpMix(ops['weights'], access, files, object_sizes, ops['settings'], verify)
+    elif schedule is not None and workers:
+        mix = OpMix(
+            [('read', len(readers)), ('write', len(writers))],
+            access,
+            files,
+            object_sizes,
+            verify=verify,
+            )
+    if schedule is not None and workers:
+        group.spawn(
+            scheduler,
+            buckets=buckets,
+            mix=mix,
+            queue=queue,
+            rand=random.Random(schedule['seed']),
+            rate=schedule['rate'],
+            arrivals=schedule['arrivals'],
+            )
+        writers = readers = []
+    elif ops is not None:
+        for (worker_id, (_, seed)) in enumerate(writers + readers):
+            group.spawn(
+                mixer,
+                bucket=buckets.pop(),
+                worker_id=worker_id,
+                mix=mix,
+                queue=queue,
+                rand=random.Random(seed),
+                )
+        writers = readers = []
+    for (worker_id, seed) in writers:
+        group.spawn(
+            writer,
+            bucket=buckets.pop(),
+            worker_id=worker_id,
+            access=access,
+            files=files,
+            queue=queue,
+            rand=random.Random(seed),
+            )
+    for (worker_id, seed) in readers:
+        group.spawn(
+            reader,
+            bucket=buckets.pop(),
+            worker_id=worker_id,
+            access=access,
+            queue=queue,
+            rand=random.Random(seed),
+            verify=verify,
+            )
+    gevent.sleep(duration)
+    group.kill(block=True)
+
+def run_processes(processes, config, bucket_name, access, files, plans, sink, aggregate=None, live=None, live_file=None, new_bucket=None, object_sizes=None, verify=None):
+    """
+    Forks `processes` worker processes, each running its share of the
+    writers, readers and rate of every phase in `plans` in its own
+    gevent hub. Their results are passed on to `sink` as they come in,
+    as histograms every `aggregate` seconds if set. With `live`, every
+    process reports its own live statistics, see results.LiveStats.
+    Returns the phase summaries merged over all processes, and the
+    number of failed operations and the first error over all of them,
+    since relayed results are not looked at on the way.
+
+    Every process opens its own connection and then waits at a shared
+    start barrier, so they all run over the same period.
+    """
+    shares = [[] for p in xrange(processes)]
+    for plan in plans:
+        schedule = plan['schedule']
+        if schedule is not None:
+            # give every scheduler its own seed, and split the rate
+            # between the processes that get any workers
+            rand = random.Random(schedule['seed'])
+            active = min(processes, max(len(plan['writers']), len(plan['readers'])))
+        for p in xrange(processes):
+            share = dict(
+                plan,
+                writers=plan['writers'][p::processes],
+                readers=plan['readers'][p::processes],
+                )
+            if schedule is not None:
+                share['schedule'] = dict(
+                    schedule,
+                    rate=schedule['rate'] / active,
+                    seed=rand.randrange(2**32),
+                    )
+            shares[p].append(share)
+
+    ready_r, ready_w = os.pipe()
+    start_r, start_w = os.pipe()
+    children = []
+    for p in xrange(processes):
+        output_r, output_w = os.pipe()
+        summary_output = tempfile.TemporaryFile()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_r)
+            os.close(start_w)
+            os.close(output_r)
+            for (_, other_output_r, _) in children:
+                os.close(other_output_r)
+            status = 1
+            try:
+                # never share the parent's pooled sockets
+                conn = common.connect(config.s3)
+                bucket = conn.get_bucket(bucket_name, validate=False)
+                os.write(ready_w, 'x')
+                # returns once the parent closes start_w
+                os.read(start_r, 1)
+
+                sink = results.ResultSink(
+                    gevent.fileobject.FileObject(output_w, 'wb'),
+                    format=sink.format.name,
+                    )
+                out = sink
+                if aggregate is not None:
+                    out = results.Aggregator(
+                        sink,
+                        interval=aggregate,
+                        hot_ranks=access.describe().get('hot_ranks'),
+                        )
+                queue = out
+                if live is not None:
+                    queue = results.LiveStats(
+                        out,
+                        interval=live,
+                        path=live_file,
+                        label='process {p}'.format(p=p),
+                        )
+                summaries = run_phases(
+                    bucket=bucket,
+                    access=access,
+                    files=files,
+                    plans=shares[p],
+                    queue=queue,
+                    new_bucket=new_bucket,
+                    object_sizes=object_sizes,
+                    verify=verify,
+                    )
+                if live is not None:
+                    queue.close()
+                if aggregate is not None:
+                    out.flush()
+                sink.close()
+                yaml.safe_dump(
+                    dict(
+                        summaries=summaries,
+                        errors=out.errors,
+                        first_error=out.first_error,
+                        ),
+                    stream=summary_output,
+                    )
+                summary_output.flush()
+                status = 0
+            except:
+                traceback.print_exc()
+            finally:
+                # skip the parent's cleanup
+                os._exit(status)
+        os.close(output_w)
+        children.append((pid, output_r, summary_output))
+
+    os.close(ready_w)
+    os.close(start_r)
+    for _ in xrange(processes):
+        if not os.read(ready_r, 1):
+            # every child is gone already
+            break
+    os.close(ready_r)
+    print 'Starting {n} worker processes'.format(n=processes)
+    os.close(start_w)
+
+    relays = gevent.pool.Group()
+    for (_, output_r, _) in children:
+        relays.spawn(
+            results.relay_records,
+            gevent.fileobject.FileObject(output_r, 'rb'),
+            sink,
+            )
+    relays.join()
+
+    failed = []
+    child_summaries = []
+    errors = 0
+    first_error = None
+    for (p, (pid, _, summary_output)) in enumerate(children):
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            failed.append(p)
+        else:
+            summary_output.seek(0)
+            report = yaml.safe_load(summary_output)
+            child_summaries.append(report['summaries'])
+            errors += report['errors']
+            if first_error is None:
+                first_error = report['first_error']
+        summary_output.close()
+    if failed:
+        raise RuntimeError('Worker processes failed: {failed}'.format(failed=failed))
+
+    summaries = [
+        merge_phase_summaries([child[i] for child in child_summaries], plan['settings'])
+        for (i, plan) in enumerate(plans)
+        ]
+    return (summaries, errors, first_error)
+
 def main():
     # parse options
     (options, args) = parse_options()
@@ -143,36 +1051,77 @@ def main():
         # verify all required config items are present
         if 'readwrite' not in config:
             raise RuntimeError('readwrite section not found in config')
-        for item in ['readers', 'writers', 'duration', 'files', 'bucket']:
+        for item in ['readers', 'writers', 'duration', 'files']:
             if item not in config.readwrite:
                 raise RuntimeError("Missing readwrite config item: {item}".format(item=item))
-        for item in ['num', 'size', 'stddev']:
+        if 'bucket' not in config.readwrite and 'dataset' not in config.readwrite:
+            raise RuntimeError("Missing readwrite config item: bucket")
+        for item in ['num']:
             if item not in config.readwrite.files:
                 raise RuntimeError("Missing readwrite config item: files.{item}".format(item=item))
 
+        # a dataset bucket from an earlier run knows how its files were made
+        dataset = config.readwrite.get('dataset')
+        manifest = None
+        if dataset is not None:
+            bucket = conn.lookup(dataset)
+            if bucket is not None:
+                manifest = read_manifest(bucket)
+
         seeds = dict(config.readwrite.get('random_seed', {}))
         seeds.setdefault('main', random.randrange(2**32))
 
         rand = random.Random(seeds['main'])
 
-        for name in ['names', 'contents', 'writer', 'reader']:
+        if manifest is not None:
+            for name in ['names', 'contents']:
+                seeds.setdefault(name, manifest['seeds'][name])
+
+        for name in ['names', 'contents', 'writer', 'reader', 'scheduler']:
             seeds.setdefault(name, rand.randrange(2**32))
 
         print 'Using random seeds: {seeds}'.format(seeds=seeds)
 
+        content = dict(
+            compression=config.readwrite.files.get('compression', 1.0),
+            dedupe=config.readwrite.files.get('dedupe', 0.0),
+            )
+        try:
+            realistic.check_content_ratios(**content)
+        except ValueError as e:
+            raise RuntimeError("Bad readwrite config item: files: {e}".format(e=e))
+        print 'Using content ratios: {content}'.format(content=content)
+
+        try:
+            sizes = realistic.sizes_from_config(config.readwrite.files)
+        except KeyError as e:
+            raise RuntimeError("Missing readwrite config item: files.{item}".format(item=e.args[0]))
+        except ValueError as e:
+            raise RuntimeError("Bad readwrite config item: files: {e}".format(e=e))
+        print 'Using file sizes: {sizes}'.format(sizes=sizes.describe())
+
         # setup bucket and other objects
-        bucket_name = common.choose_bucket_prefix(config.readwrite.bucket, max_len=30)
-        bucket = conn.create_bucket(bucket_name)
-        print "Created bucket: {name}".format(name=bucket.name)
+        if dataset is None:
+            bucket_name = common.choose_bucket_prefix(config.readwrite.bucket, max_len=30)
+            bucket = conn.create_bucket(bucket_name)
+            print "Created bucket: {name}".format(name=bucket.name)
+        elif bucket is None:
+            bucket = conn.create_bucket(dataset)
+            print "Created dataset bucket: {name}".format(name=bucket.name)
+        else:
+            print "Using dataset bucket: {name}".format(name=bucket.name)
+
+        # give every worker its own connection pool if configured
+        new_bucket = None
+        if 'connections' in config.readwrite:
+            new_bucket = functools.partial(worker_bucket, config, bucket.name)
+            print 'Using a connection pool per worker: {pool}'.format(
+                pool=dict(config.readwrite.connections))
 
         # check flag for deterministic file name creation
         if not config.readwrite.get('deterministic_file_names'):
             print 'Creating random file names'
-            file_names = realistic.names(
-                mean=15,
-                stddev=4,
-                seed=seeds['names'],
-                )
+            file_names = realistic.names_from_config(config.readwrite.get('names'), seeds['names'])
             file_names = itertools.islice(file_names, config.readwrite.files.num)
             file_names = list(file_names)
         else:
@@ -181,85 +1130,134 @@ def main():
             for x in xrange(config.readwrite.files.num):
                 file_names.append('test_file_{num}'.format(num=x))
 
+        try:
+            access = realistic.access_from_config(config.readwrite.get('access'), file_names)
+        except ValueError as e:
+            raise RuntimeError("Bad readwrite config item: access: {e}".format(e=e))
+        print 'Using access distribution: {access}'.format(access=access.describe())
+        verify_conf = config.readwrite.get('verify') or {}
+        try:
+            verify = Verification(
+                every=verify_conf.get('every', 1),
+                threads=verify_conf.get('threads', 0),
+                )
+        except ValueError as e:
+            raise RuntimeError("Bad readwrite config item: verify: {e}".format(e=e))
+
         files = realistic.files2(
-            mean=1024 * config.readwrite.files.size,
-            stddev=1024 * config.readwrite.files.stddev,
+            mean=None,
+            stddev=None,
+            sizes=sizes,
             seed=seeds['contents'],
+            path=config.readwrite.files.get('pool'),
+            **content
             )
-        q = gevent.queue.Queue()
+        sink = results.ResultSink(real_stdout, format=options.format)
+        # record what is needed to reproduce the run along with the results
+        sink.put(dict(
+                type='config',
+                seeds=seeds,
+                content=content,
+                sizes=sizes.describe(),
+                access=access.describe(),
+                verify=verify.describe(),
+                ))
+        out = sink
+        if options.aggregate is not None:
+            out = results.Aggregator(
+                sink,
+                interval=options.aggregate,
+                hot_ranks=access.describe().get('hot_ranks'),
+                )
 
+        # warmup - get initial set of files uploaded if there are any
+        # writers specified, or complete the dataset
+        object_sizes = {}
+        if config.readwrite.writers > 0 or dataset is not None:
+            inventory = {}
+            description = dict(
+                seeds=dict(names=seeds['names'], contents=seeds['contents']),
+                content=content,
+                sizes=sizes.describe(),
+                deterministic_file_names=bool(config.readwrite.get('deterministic_file_names')),
+                )
+            if dataset is not None:
+                print 'Listing dataset bucket {name}'.format(name=bucket.name)
+                if manifest is not None and manifest != description:
+                    print 'Dataset was made with other settings, replacing all files'
+                inventory = dataset_inventory(bucket, file_names, manifest, description)
 
-        # warmup - get initial set of files uploaded if there are any writers specified
-        if config.readwrite.writers > 0:
             print "Uploading initial set of {num} files".format(num=config.readwrite.files.num)
-            warmup_pool = gevent.pool.Pool(size=100)
-            for file_name in file_names:
-                fp = next(files)
-                warmup_pool.spawn(
-                    write_file,
-                    bucket=bucket,
-                    file_name=file_name,
-                    fp=fp,
-                    )
-            warmup_pool.join()
+            (object_sizes, uploaded, failed) = warmup(
+                bucket=bucket,
+                file_names=file_names,
+                files=files,
+                workers=config.readwrite.get('warmup_workers', 100),
+                inventory=inventory,
+                )
+            print 'Uploaded {uploaded} files, {failed} failed, {skipped} already there'.format(
+                uploaded=uploaded - failed,
+                failed=failed,
+                skipped=len(object_sizes) - uploaded,
+                )
 
         # main work
         print "Starting main worker loop."
-        print "Using file size: {size} +- {stddev}".format(size=config.readwrite.files.size, stddev=config.readwrite.files.stddev)
-        print "Spawning {w} writers and {r} readers...".format(w=config.readwrite.writers, r=config.readwrite.readers)
-        group = gevent.pool.Group()
-        rand_writer = random.Random(seeds['writer'])
+        plans = make_plans(config.readwrite, seeds)
 
-        # Don't create random files if deterministic_files_names is set and true
-        if not config.readwrite.get('deterministic_file_names'):
-            for x in xrange(config.readwrite.writers):
-                this_rand = random.Random(rand_writer.randrange(2**32))
-                group.spawn(
-                    writer,
-                    bucket=bucket,
-                    worker_id=x,
-                    file_names=file_names,
-                    files=files,
-                    queue=q,
-                    rand=this_rand,
-                    )
-
-        # Since the loop generating readers already uses config.readwrite.readers
-        # and the file names are already generated (randomly or deterministically),
-        # this loop needs no additional qualifiers. If zero readers are specified,
-        # it will behave as expected (no data is read)
-        rand_reader = random.Random(seeds['reader'])
-        for x in xrange(config.readwrite.readers):
-            this_rand = random.Random(rand_reader.randrange(2**32))
-            group.spawn(
-                reader,
+        if options.processes > 1:
+            (summaries, errors, first_error) = run_processes(
+                processes=options.processes,
+                config=config,
+                bucket_name=bucket.name,
+                access=access,
+                files=files,
+                plans=plans,
+                sink=sink,
+                aggregate=options.aggregate,
+                live=options.live,
+                live_file=options.live_file,
+                new_bucket=new_bucket,
+                object_sizes=object_sizes,
+                verify=verify,
+                )
+        else:
+            queue = out
+            if options.live is not None:
+                queue = results.LiveStats(out, interval=options.live, path=options.live_file)
+            summaries = run_phases(
                 bucket=bucket,
-                worker_id=x,
-                file_names=file_names,
-                queue=q,
-                rand=this_rand,
+                access=access,
+                files=files,
+                plans=plans,
+                queue=queue,
+                new_bucket=new_bucket,
+                object_sizes=object_sizes,
+                verify=verify,
                 )
-        def stop():
-            group.kill(block=True)
-            q.put(StopIteration)
-        gevent.spawn_later(config.readwrite.duration, stop)
-
-        # wait for all the tests to finish
-        group.join()
-        print 'post-join, queue size {size}'.format(size=q.qsize())
-
-        if q.qsize() > 0:
-            for temp_dict in q:
-                if 'error' in temp_dict:
-                    raise Exception('exception:\n\t{msg}\n\t{trace}'.format(
-                                    msg=temp_dict['error']['msg'],
-                                    trace=temp_dict['error']['traceback'])
-                                   )
-                else:
-                    yaml.safe_dump(temp_dict, stream=real_stdout)
+            if options.live is not None:
+                queue.close()
+
+        if len(plans) > 1:
+            report_phases(summaries, sink)
+        if options.aggregate is not None:
+            out.flush()
+        sink.close()
+        print 'Wrote {count} results'.format(count=sink.count)
+        if options.processes > 1:
+            out.errors += errors
+            if out.first_error is None:
+                out.first_error = first_error
+        if out.errors:
+            raise Exception('{n} operations failed, first:\n\t{msg}\n\t{trace}'.format(
+                            n=out.errors,
+                            msg=out.first_error['msg'],
+                            trace=out.first_error.get('traceback'))
+                           )
 
     finally:
         # cleanup
+        real_stdout.flush()
         if options.cleanup:
             if bucket is not None:
                 common.nuke_bucket(bucket)
@@ -1,18 +1,41 @@
+import bisect
+import cPickle
 import hashlib
+import pickle
 import random
 import string
-import struct
 import time
 import math
+import mmap
 import tempfile
 import shutil
 import os
+import yaml
 
 
 NANOSECOND = int(1e9)
 
+# most [size, nanoseconds] chunk marks kept per operation
+MAX_CHUNKS = 256
 
-def generate_file_contents(size):
+# granularity of generated content; compressibility and duplication
+# are decided per block of this size
+CONTENT_BLOCK_SIZE = 64*1024
+
+# duplicated blocks are drawn from this many blocks, which are the
+# same for every seed so they also repeat across objects
+DEDUPE_BLOCKS = 16
+DEDUPE_SEED = 0
+
+
+def check_content_ratios(compression, dedupe):
+    if compression < 1:
+        raise ValueError('compression ratio must be at least 1: {c!r}'.format(c=compression))
+    if not 0 <= dedupe <= 1:
+        raise ValueError('dedupe ratio must be between 0 and 1: {d!r}'.format(d=dedupe))
+
+
+def generate_file_contents(size, compression=1.0, dedupe=0.0):
     """
     A helper function to generate binary contents for a given size, and
     calculates the md5 hash of the contents appending itself at the end of the
@@ -20,59 +43,242 @@ def generate_file_contents(size):
     It uses sha1's hexdigest which is 40 chars long. So any binary generated
     should remove the last 40 chars from the blob to retrieve the original hash
     and binary so that validity can be proved.
+
+    `compression` and `dedupe` shape the contents block by block, see
+    random_block.
     """
     size = int(size)
-    contents = os.urandom(size)
+    if compression == 1 and dedupe == 0:
+        contents = os.urandom(size)
+    else:
+        seed = random.SystemRandom().getrandbits(64)
+        blocks = int(math.ceil(size / float(CONTENT_BLOCK_SIZE)))
+        contents = ''.join(
+            random_block(seed, i, CONTENT_BLOCK_SIZE, compression, dedupe)
+            for i in xrange(blocks)
+            )[:size]
     content_hash = hashlib.sha1(contents).hexdigest()
     return contents + content_hash
 
 
-class FileValidator(object):
+class ChunkSampler(object):
+    """
+    Appends [size, nanoseconds] marks to `chunks`, keeping at most
+    about `max_chunks` of them however many are made.
 
-    def __init__(self, f=None):
-        self._file = tempfile.SpooledTemporaryFile()
+    Whenever the list fills up, every other sample is dropped and from
+    then on only every other mark is sampled, so the kept marks stay
+    evenly spaced. The most recent mark is always the last element.
+    """
+    def __init__(self, chunks, max_chunks=MAX_CHUNKS):
+        self.chunks = chunks
+        self.max_chunks = max_chunks
+        self.stride = 1
+        self.count = 0
+        # whether the last element is only there for being the latest
+        self.unsampled_tail = False
+
+    def mark(self, size, elapsed):
+        if self.unsampled_tail:
+            self.chunks.pop()
+        self.count += 1
+        self.unsampled_tail = bool(self.count % self.stride)
+        if not self.unsampled_tail and len(self.chunks) >= self.max_chunks:
+            del self.chunks[1::2]
+            self.stride *= 2
+        self.chunks.append([size, elapsed])
+
+
+class TrailingDigestWriter(object):
+    """
+    Base for write-only files whose last `trailer_size` bytes are a
+    digest of everything before them.
+
+    Data is hashed as it is written and only the trailing window is
+    kept, so memory use does not depend on the size of the file.
+    """
+    def __init__(self, hash, trailer_size):
+        self.size = 0
+        self.hash = hash
+        self.trailer_size = trailer_size
+        self.buf = ''
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        self.size += len(data)
+        trailer_size = self.trailer_size
+        if len(data) >= trailer_size:
+            # the old tail and all but the end of data are hashed in
+            # place, without concatenating them first
+            self._update(self.buf)
+            self._update(memoryview(data)[:len(data) - trailer_size])
+            self.buf = data[len(data) - trailer_size:]
+        else:
+            buf = self.buf + data
+            new_data, self.buf = buf[:-trailer_size], buf[-trailer_size:]
+            self._update(new_data)
+
+    def _update(self, data):
+        self.hash.update(data)
+
+
+class FileValidator(TrailingDigestWriter):
+    """
+    Validates contents made by generate_file_contents while they are
+    written to it, e.g. by boto's `key.get_contents_to_file`. The body
+    is never stored.
+
+    With a `pool`, e.g. a gevent ThreadPool, the contents are hashed
+    there in blocks of `block_size` bytes, one block at a time while
+    the next one is written, instead of by the writer. hashlib releases
+    the GIL while hashing, so this takes the hashing off the gevent
+    hub.
+    """
+    def __init__(self, f=None, pool=None, block_size=1024*1024):
+        # the trailer is the 40 char sha1 hexdigest
+        super(FileValidator, self).__init__(hashlib.sha1(), 40)
         self.original_hash = None
         self.new_hash = None
+        self.pool = pool
+        self.block_size = block_size
+        self.block = []
+        self.block_length = 0
+        self.hashing = None
         if f:
             f.seek(0)
-            shutil.copyfileobj(f, self._file)
+            shutil.copyfileobj(f, self)
+
+    def _update(self, data):
+        if self.pool is None:
+            self.hash.update(data)
+            return
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.block.append(data)
+        self.block_length += len(data)
+        if self.block_length >= self.block_size:
+            self._hash_block()
+
+    def _hash_block(self):
+        """
+        Hands the data written since the last block to the pool, after
+        waiting for the last block to be hashed, so they are hashed in
+        order.
+        """
+        if self.hashing is not None:
+            self.hashing.get()
+            self.hashing = None
+        if self.block:
+            block = ''.join(self.block)
+            self.block = []
+            self.block_length = 0
+            self.hashing = self.pool.spawn(self.hash.update, block)
 
     def valid(self):
         """
         Returns True if this file looks valid. The file is valid if the end
-        of the file has the md5 digest for the first part of the file.
+        of the file has the sha1 hexdigest for the first part of the file.
         """
-        self._file.seek(0)
-        contents = self._file.read()
-        self.original_hash, binary = contents[-40:], contents[:-40]
-        self.new_hash = hashlib.sha1(binary).hexdigest()
+        if self.pool is not None:
+            # hand over what is left, then wait for it to be hashed
+            self._hash_block()
+            self._hash_block()
+        self.original_hash = self.buf
+        self.new_hash = self.hash.hexdigest()
         if not self.new_hash == self.original_hash:
             print 'original  hash: ', self.original_hash
             print 'new hash: ', self.new_hash
-            print 'size: ', self._file.tell()
+            print 'size: ', self.size
             return False
         return True
 
-    # XXX not sure if we need all of these
-    def seek(self, offset, whence=os.SEEK_SET):
-        self._file.seek(offset, whence)
 
-    def tell(self):
-        return self._file.tell()
+class FileSizer(object):
+    """
+    Counts the bytes written to it and drops them, for reads whose
+    contents are not verified.
+    """
+    def __init__(self):
+        self.size = 0
 
-    def read(self, size=-1):
-        return self._file.read(size)
+    def tell(self):
+        return self.size
 
     def write(self, data):
-        self._file.write(data)
-        self._file.seek(0)
+        self.size += len(data)
+
+
+def _long_to_bytes(value, size):
+    """
+    Returns the `size` low-order bytes of the non-negative `value`,
+    little endian.
+
+    Python 2 has no int.to_bytes, but pickle protocol 2 serializes
+    longs with the same C routine, which is much faster than going
+    through a hex string.
+    """
+    encoded = cPickle.dumps(value, 2)
+    # protocol header, then LONG1 (1-byte length) or LONG4 (4-byte length)
+    if encoded[2] == pickle.LONG1:
+        start = 4
+    else:
+        start = 7
+    return encoded[start:-1][:size].ljust(size, '\0')
+
+
+def random_block(seed, index, size=1024*1024, compression=1.0, dedupe=0.0):
+    """
+    Returns the `index`-th block of `size` pseudorandom bytes for
+    `seed`.
+
+    Every block depends only on (seed, index), so any part of a
+    RandomContentFile can be regenerated on its own, in any order, or
+    in separate processes.
+
+    With `compression` above 1, only 1/compression of the block is
+    random and the rest repeats the start of it, so the block
+    compresses by about that ratio. With `dedupe` above 0, that
+    fraction of blocks is instead one of DEDUPE_BLOCKS blocks shared by
+    all seeds.
+    """
+    rand = random.Random((seed << 64) | index)
+    if dedupe and rand.random() < dedupe:
+        return random_block(DEDUPE_SEED, rand.randrange(DEDUPE_BLOCKS), size, compression)
+
+    random_size = int(math.ceil(size / float(compression)))
+    # one call for the whole block, instead of packing 8 bytes at a time
+    data = _long_to_bytes(rand.getrandbits(random_size*8), random_size)
+    if random_size < size:
+        # repeat a short run rather than zeros, which some backends
+        # special-case
+        pattern = data[:256]
+        data += (pattern * ((size - random_size) // len(pattern) + 1))[:size - random_size]
+    return data
 
 
 class RandomContentFile(object):
-    def __init__(self, size, seed):
+    # size of the independently generated blocks; a read anywhere in
+    # the object never generates more than this beyond what it returns
+    block_size = CONTENT_BLOCK_SIZE
+
+    def __init__(self, size, seed, compression=1.0, dedupe=0.0):
+        check_content_ratios(compression, dedupe)
         self.size = size
         self.seed = seed
-        self.random = random.Random(self.seed)
+        self.compression = compression
+        self.dedupe = dedupe
+
+        self.digest_size = hashlib.md5().digest_size
+        # everything before the trailing digest is pseudorandom data
+        self.data_size = max(0, self.size - self.digest_size)
+        self.digest = None
+        self.hash = None
+        self.hashed = 0
+
+        self.block_index = None
+        self.block = None
 
         # Boto likes to seek once more after it's done reading, so we need to save the last chunks/seek value.
         self.last_chunks = self.chunks = None
@@ -82,7 +288,7 @@ class RandomContentFile(object):
         self.seek(0)
 
     def _mark_chunk(self):
-        self.chunks.append([self.offset, int(round((time.time() - self.last_seek) * NANOSECOND))])
+        self.chunk_sampler.mark(self.offset, int(round((time.time() - self.last_seek) * NANOSECOND)))
 
     def seek(self, offset, whence=os.SEEK_SET):
         if whence == os.SEEK_SET:
@@ -92,32 +298,97 @@ class RandomContentFile(object):
         elif whence == os.SEEK_CUR:
             self.offset += offset
 
-        assert self.offset == 0
-
-        self.random.seed(self.seed)
-        self.buffer = ''
+        assert 0 <= self.offset <= self.size
 
-        self.hash = hashlib.md5()
-        self.digest_size = self.hash.digest_size
-        self.digest = None
+        # the digest is hashed on the fly while the data is read in
+        # order from the start; once known, it is kept across seeks
+        if self.offset == 0 and self.digest is None:
+            self.hash = hashlib.md5()
+            self.hashed = 0
 
         # Save the last seek time as our start time, and the last chunks
         self.last_chunks = self.chunks
         # Before emptying.
         self.last_seek = time.time()
         self.chunks = []
+        self.chunk_sampler = ChunkSampler(self.chunks)
 
     def tell(self):
         return self.offset
 
-    def _generate(self):
-        # generate and return a chunk of pseudorandom data
-        size = min(self.size, 1*1024*1024) # generate at most 1 MB at a time
-        chunks = int(math.ceil(size/8.0))  # number of 8-byte chunks to create
+    def compute_digest(self):
+        """
+        Works out the trailing digest now, if it is not known yet, so
+        that copies made afterwards share it instead of hashing the
+        whole file again when they reach it.
+        """
+        self._get_digest()
+
+    def copy(self, offset=0):
+        """
+        Returns an independent file with the same contents, at `offset`,
+        e.g. to upload parts of this one in parallel. Only a copy that
+        reads the trailing digest works it out, unless it is known
+        already; see compute_digest.
+        """
+        other = RandomContentFile(self.size, self.seed, self.compression, self.dedupe)
+        if self.digest is not None:
+            other.digest = self.digest
+            other.hash = None
+        other.seek(offset)
+        return other
+
+    def _generate(self, index):
+        # return the index-th block, keeping the last one around since
+        # consecutive reads are usually much smaller than a block
+        if index != self.block_index:
+            self.block = random_block(
+                self.seed,
+                index,
+                self.block_size,
+                self.compression,
+                self.dedupe,
+                )
+            self.block_index = index
+        return self.block
+
+    def _read_data(self, offset, count):
+        index, skip = divmod(offset, self.block_size)
+        block = self._generate(index)
+        if skip == 0 and count == self.block_size:
+            # hand out the block itself, no copy needed
+            return block
+        if skip + count <= self.block_size:
+            return block[skip:skip + count]
+
+        r = []
+        while count > 0:
+            index, skip = divmod(offset, self.block_size)
+            data = self._generate(index)[skip:skip + count]
+            offset += len(data)
+            count -= len(data)
+            r.append(data)
+        return ''.join(r)
+
+    def _readinto_data(self, view, offset, count):
+        pos = 0
+        while pos < count:
+            index, skip = divmod(offset + pos, self.block_size)
+            n = min(count - pos, self.block_size - skip)
+            view[pos:pos + n] = memoryview(self._generate(index))[skip:skip + n]
+            pos += n
 
-        l = [self.random.getrandbits(64) for _ in xrange(chunks)]
-        s = struct.pack(chunks*'Q', *l)
-        return s
+    def _get_digest(self):
+        if self.digest is None:
+            if self.hashed != self.data_size:
+                # the data was not read in order, rehash all of it
+                self.hash = hashlib.md5()
+                for offset in xrange(0, self.data_size, self.block_size):
+                    count = min(self.block_size, self.data_size - offset)
+                    self.hash.update(self._read_data(offset, count))
+            self.digest = self.hash.digest()
+            self.hash = None
+        return self.digest
 
     def read(self, size=-1):
         if size < 0:
@@ -125,31 +396,60 @@ class RandomContentFile(object):
 
         r = []
 
-        random_count = min(size, self.size - self.offset - self.digest_size)
+        random_count = min(size, self.data_size - self.offset)
         if random_count > 0:
-            while len(self.buffer) < random_count:
-                self.buffer += self._generate()
+            data = self._read_data(self.offset, random_count)
+            if self.hash is not None and self.hashed == self.offset:
+                self.hash.update(data)
+                self.hashed += random_count
             self.offset += random_count
             size -= random_count
-            data, self.buffer = self.buffer[:random_count], self.buffer[random_count:]
-            if self.hash is not None:
-                self.hash.update(data)
             r.append(data)
 
         digest_count = min(size, self.size - self.offset)
         if digest_count > 0:
-            if self.digest is None:
-                self.digest = self.hash.digest()
-                self.hash = None
+            start = self.offset - self.data_size
+            data = self._get_digest()[start:start + digest_count]
             self.offset += digest_count
             size -= digest_count
-            data = self.digest[:digest_count]
             r.append(data)
 
         self._mark_chunk()
 
+        if len(r) == 1:
+            return r[0]
         return ''.join(r)
 
+    def readinto(self, b):
+        """
+        Reads up to len(b) bytes straight into the writable buffer `b`
+        and returns how many were read. Unlike read(), this does not
+        allocate any intermediate strings for the data.
+        """
+        view = memoryview(b)
+        size = len(view)
+        pos = 0
+
+        random_count = min(size, self.data_size - self.offset)
+        if random_count > 0:
+            self._readinto_data(view, self.offset, random_count)
+            if self.hash is not None and self.hashed == self.offset:
+                self.hash.update(view[:random_count])
+                self.hashed += random_count
+            self.offset += random_count
+            pos += random_count
+
+        digest_count = min(size - pos, self.size - self.offset)
+        if digest_count > 0:
+            start = self.offset - self.data_size
+            view[pos:pos + digest_count] = self._get_digest()[start:start + digest_count]
+            self.offset += digest_count
+            pos += digest_count
+
+        self._mark_chunk()
+
+        return pos
+
 
 class PrecomputedContentFile(object):
     def __init__(self, f):
@@ -168,6 +468,7 @@ class PrecomputedContentFile(object):
             self.last_chunks = self.chunks
             self.last_seek = time.time()
             self.chunks = []
+            self.chunk_sampler = ChunkSampler(self.chunks)
 
     def tell(self):
         return self._file.tell()
@@ -180,25 +481,25 @@ class PrecomputedContentFile(object):
     def _mark_chunk(self):
         elapsed = time.time() - self.last_seek
         elapsed_nsec = int(round(elapsed * NANOSECOND))
-        self.chunks.append([self.tell(), elapsed_nsec])
+        self.chunk_sampler.mark(self.tell(), elapsed_nsec)
 
-class FileVerifier(object):
+class FileVerifier(TrailingDigestWriter):
+    """
+    Verifies contents made by RandomContentFile while they are written
+    to it, in constant memory.
+    """
     def __init__(self):
-        self.size = 0
-        self.hash = hashlib.md5()
-        self.buf = ''
+        hash = hashlib.md5()
+        super(FileVerifier, self).__init__(hash, hash.digest_size)
         self.created_at = time.time()
         self.chunks = []
+        self.chunk_sampler = ChunkSampler(self.chunks)
 
     def _mark_chunk(self):
-        self.chunks.append([self.size, int(round((time.time() - self.created_at) * NANOSECOND))])
+        self.chunk_sampler.mark(self.size, int(round((time.time() - self.created_at) * NANOSECOND)))
 
     def write(self, data):
-        self.size += len(data)
-        self.buf += data
-        digsz = -1*self.hash.digest_size
-        new_data, self.buf = self.buf[0:digsz], self.buf[digsz:]
-        self.hash.update(new_data)
+        super(FileVerifier, self).write(data)
         self._mark_chunk()
 
     def valid(self):
@@ -212,11 +513,193 @@ class FileVerifier(object):
         return self.buf == self.hash.digest()
 
 
-def files(mean, stddev, seed=None):
+class NormalSizes(object):
+    """
+    Sizes following the normal distribution with `mean` and `stddev`;
+    negative draws are discarded.
+    """
+    def __init__(self, mean, stddev):
+        self.mean = mean
+        self.stddev = stddev
+
+    def describe(self):
+        return dict(distribution='normal', mean=self.mean, stddev=self.stddev)
+
+    def sample(self, rand, count):
+        sizes = []
+        while len(sizes) < count:
+            size = int(rand.normalvariate(self.mean, self.stddev))
+            if size >= 0:
+                sizes.append(size)
+        return sizes
+
+
+class LognormalSizes(object):
+    """
+    Heavy-tailed sizes following the lognormal distribution whose own
+    mean and standard deviation are `mean` and `stddev`.
+    """
+    def __init__(self, mean, stddev):
+        if mean <= 0:
+            raise ValueError('lognormal sizes need a positive mean: {m!r}'.format(m=mean))
+        self.mean = mean
+        self.stddev = stddev
+        variance = math.log(1 + (float(stddev) / mean) ** 2)
+        self.mu = math.log(mean) - variance / 2
+        self.sigma = math.sqrt(variance)
+
+    def describe(self):
+        return dict(distribution='lognormal', mean=self.mean, stddev=self.stddev)
+
+    def sample(self, rand, count):
+        mu, sigma = self.mu, self.sigma
+        return [int(rand.lognormvariate(mu, sigma)) for _ in xrange(count)]
+
+
+class ParetoSizes(object):
+    """
+    Heavy-tailed sizes following the Pareto distribution with shape
+    `alpha`, starting at `minimum` and optionally capped at `maximum`.
+    """
+    def __init__(self, minimum, alpha, maximum=None):
+        if alpha <= 0:
+            raise ValueError('pareto sizes need a positive alpha: {a!r}'.format(a=alpha))
+        self.minimum = minimum
+        self.alpha = alpha
+        self.maximum = maximum
+
+    def describe(self):
+        return dict(
+            distribution='pareto',
+            minimum=self.minimum,
+            alpha=self.alpha,
+            maximum=self.maximum,
+            )
+
+    def sample(self, rand, count):
+        minimum, alpha = self.minimum, self.alpha
+        sizes = [int(minimum * rand.paretovariate(alpha)) for _ in xrange(count)]
+        if self.maximum is not None:
+            sizes = [min(size, self.maximum) for size in sizes]
+        return sizes
+
+
+class ChoiceSizes(object):
+    """
+    Sizes picked from a fixed set, e.g. a bimodal mix of small and
+    large objects. `choices` is a list of [size, weight] pairs.
+    """
+    def __init__(self, choices):
+        if not choices:
+            raise ValueError('choice sizes need at least one choice')
+        self.choices = [[int(size), weight] for (size, weight) in choices]
+        self.sizes = [size for (size, _) in self.choices]
+        self.cumulative = []
+        total = 0.0
+        for (_, weight) in self.choices:
+            total += weight
+            self.cumulative.append(total)
+
+    def describe(self):
+        return dict(distribution='choice', choices=self.choices)
+
+    def sample(self, rand, count):
+        sizes, cumulative = self.sizes, self.cumulative
+        total = cumulative[-1]
+        last = len(sizes) - 1
+        return [
+            sizes[min(bisect.bisect(cumulative, rand.random() * total), last)]
+            for _ in xrange(count)
+            ]
+
+
+class HistogramSizes(object):
+    """
+    Sizes following an empirical histogram, given as [low, high, count]
+    buckets. A bucket is picked in proportion to its count, then a size
+    uniformly from [low, high).
+    """
+    def __init__(self, buckets):
+        if not buckets:
+            raise ValueError('histogram sizes need at least one bucket')
+        self.buckets = [[int(low), int(high), count] for (low, high, count) in buckets]
+        self.cumulative = []
+        total = 0.0
+        for (_, _, count) in self.buckets:
+            total += count
+            self.cumulative.append(total)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Loads buckets from a text file with one ``low high count`` line
+        per bucket, sizes in bytes. Blank lines and lines starting with
+        ``#`` are skipped.
+        """
+        buckets = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                low, high, count = line.split()
+                buckets.append([int(low), int(high), float(count)])
+        return cls(buckets)
+
+    def describe(self):
+        return dict(distribution='histogram', buckets=self.buckets)
+
+    def sample(self, rand, count):
+        buckets, cumulative = self.buckets, self.cumulative
+        total = cumulative[-1]
+        last = len(buckets) - 1
+        sizes = []
+        for _ in xrange(count):
+            low, high, _ = buckets[min(bisect.bisect(cumulative, rand.random() * total), last)]
+            sizes.append(low + int(rand.random() * (high - low)))
+        return sizes
+
+
+def sample_sizes(sizes, rand, batch=1024):
+    """
+    Yields sizes from the distribution `sizes`, drawn `batch` at a
+    time.
+    """
+    while True:
+        for size in sizes.sample(rand, batch):
+            yield size
+
+
+def sizes_from_config(conf):
+    """
+    Returns the size distribution for a readwrite/roundtrip `files`
+    config section. Sizes in the config are in KB, except for the
+    histogram file which is in bytes.
+    """
+    distribution = conf.get('distribution', 'normal')
+    if distribution == 'normal':
+        return NormalSizes(1024 * conf['size'], 1024 * conf['stddev'])
+    if distribution == 'lognormal':
+        return LognormalSizes(1024 * conf['size'], 1024 * conf['stddev'])
+    if distribution == 'pareto':
+        maximum = conf.get('max')
+        if maximum is not None:
+            maximum *= 1024
+        return ParetoSizes(1024 * conf['size'], conf['alpha'], maximum)
+    if distribution == 'choice':
+        return ChoiceSizes([[1024 * size, weight] for (size, weight) in conf['choices']])
+    if distribution == 'histogram':
+        return HistogramSizes.from_file(conf['histogram'])
+    raise ValueError('unknown size distribution: {d!r}'.format(d=distribution))
+
+
+def files(mean, stddev, seed=None, compression=1.0, dedupe=0.0, sizes=None):
     """
     Yields file-like objects with effectively random contents, where
     the size of each file follows the normal distribution with `mean`
-    and `stddev`.
+    and `stddev`, or the distribution `sizes` if given. The contents
+    compress by about `compression` and a `dedupe` fraction of their
+    blocks are duplicates.
 
     Beware, the file-likeness is very shallow. You can use boto's
     `key.set_contents_from_file` to send these to S3, but they are not
@@ -232,50 +715,486 @@ def files(mean, stddev, seed=None):
     Except for objects shorter than 16 bytes, where the second line
     will be proportionally shorter.
     """
+    if sizes is None:
+        sizes = NormalSizes(mean, stddev)
     rand = random.Random(seed)
-    while True:
-        while True:
-            size = int(rand.normalvariate(mean, stddev))
-            if size >= 0:
-                break
-        yield RandomContentFile(size=size, seed=rand.getrandbits(32))
+    for size in sample_sizes(sizes, rand):
+        yield RandomContentFile(
+            size=size,
+            seed=rand.getrandbits(32),
+            compression=compression,
+            dedupe=dedupe,
+            )
 
 
-def files2(mean, stddev, seed=None, numfiles=10):
+class PoolFile(object):
     """
-    Yields file objects with effectively random contents, where the
-    size of each file follows the normal distribution with `mean` and
-    `stddev`.
+    Read-only file over the bytes [offset, offset + size) of `data`,
+    usually a ContentPool's memory map. Every instance has its own
+    position, so many writers can upload the same pool entry at once.
+    """
+    def __init__(self, data, offset, size):
+        self._data = data
+        self.start = offset
+        self.size = size
+        self.offset = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.offset = offset
+        elif whence == os.SEEK_END:
+            self.offset = self.size + offset
+        elif whence == os.SEEK_CUR:
+            self.offset += offset
+        self.offset = max(0, min(self.offset, self.size))
+
+    def tell(self):
+        return self.offset
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size - self.offset:
+            size = self.size - self.offset
+        start = self.start + self.offset
+        self.offset += size
+        return self._data[start:start + size]
+
+
+class ContentPool(object):
+    """
+    `numfiles` blobs made by generate_file_contents, stored back to back
+    in the file at `path` and memory-mapped read-only, so every process
+    using the same path shares one copy through the page cache.
+
+    The index of (offset, size, digest) entries is kept next to the pool
+    in `path`.index, together with the parameters it was built from. If
+    both already exist and match, the pool is reused as is instead of
+    being generated again. Without a `path`, the pool lives in an
+    anonymous temporary file that disappears with the process (and its
+    forked children).
+    """
+    def __init__(self, mean, stddev, seed=None, numfiles=10, path=None,
+                 compression=1.0, dedupe=0.0, sizes=None):
+        check_content_ratios(compression, dedupe)
+        if sizes is None:
+            sizes = NormalSizes(mean, stddev)
+        self.sizes = sizes
+        self.params = dict(
+            sizes=sizes.describe(),
+            seed=seed,
+            numfiles=numfiles,
+            compression=compression,
+            dedupe=dedupe,
+            )
+        self.path = path
+        self.index = None
+        if path is not None:
+            self.index = self._load_index()
+
+        if self.index is None:
+            if path is None:
+                fd, tmp_path = tempfile.mkstemp(prefix='s3tests-pool-')
+                os.close(fd)
+                self.index = self._generate(tmp_path)
+                f = open(tmp_path, 'rb')
+                os.unlink(tmp_path)
+            else:
+                # each process generating the same pool at once writes
+                # its own temporary files, and the last rename wins
+                pool_tmp = self._mkstemp(path)
+                self.index = self._generate(pool_tmp)
+                os.rename(pool_tmp, path)
+                index_tmp = self._mkstemp(path + '.index')
+                with open(index_tmp, 'w') as index_file:
+                    yaml.safe_dump(
+                        dict(params=self.params, index=self.index),
+                        stream=index_file,
+                        )
+                os.rename(index_tmp, path + '.index')
+                f = open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+
+        with f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _mkstemp(path):
+        """
+        Makes a temporary file to be renamed to `path`, in the same
+        directory and readable by all like a plain new file.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(path) + '.',
+            suffix='.tmp',
+            dir=os.path.dirname(path) or '.',
+            )
+        os.fchmod(fd, 0644)
+        os.close(fd)
+        return tmp_path
+
+    def _load_index(self):
+        try:
+            with open(self.path + '.index') as f:
+                saved = yaml.safe_load(f)
+            pool_size = os.path.getsize(self.path)
+        except (IOError, OSError):
+            return None
+        if not saved or saved.get('params') != self.params:
+            return None
+        index = saved['index']
+        if sum(size for (_, size, _) in index) != pool_size:
+            return None
+        return index
+
+    def _generate(self, path):
+        rand = random.Random(self.params['seed'])
+        index = []
+        offset = 0
+        with open(path, 'wb') as f:
+            for size in self.sizes.sample(rand, self.params['numfiles']):
+                contents = generate_file_contents(
+                    size,
+                    compression=self.params['compression'],
+                    dedupe=self.params['dedupe'],
+                    )
+                f.write(contents)
+                index.append([offset, len(contents), contents[-40:]])
+                offset += len(contents)
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    def open(self, i):
+        """
+        Returns a new PoolFile for the i-th entry.
+        """
+        offset, size, _ = self.index[i]
+        return PoolFile(self._map, offset, size)
+
+
+def files2(mean, stddev, seed=None, numfiles=10, path=None,
+           compression=1.0, dedupe=0.0, sizes=None):
+    """
+    Returns an endless iterator of file objects with effectively random
+    contents, where the size of each file follows the normal
+    distribution with `mean` and `stddev`, or the distribution `sizes`
+    if given.
 
     Rather than continuously generating new files, this pre-computes and
-    stores `numfiles` files and yields them in a loop.
+    stores `numfiles` files in a ContentPool and yields them in a loop.
+    The pool is built right away, not on first use, so that processes
+    forked afterwards share it. Pass `path` to share the pool between
+    processes and runs. `compression` and `dedupe` shape the contents
+    as in random_block.
     """
-    # pre-compute all the files (and save with TemporaryFiles)
-    fs = []
-    for _ in xrange(numfiles):
-        t = tempfile.SpooledTemporaryFile()
-        t.write(generate_file_contents(random.normalvariate(mean, stddev)))
-        t.seek(0)
-        fs.append(t)
+    pool = ContentPool(
+        mean=mean,
+        stddev=stddev,
+        seed=seed,
+        numfiles=numfiles,
+        path=path,
+        compression=compression,
+        dedupe=dedupe,
+        sizes=sizes,
+        )
+    return _pool_files(pool)
+
 
+def _pool_files(pool):
     while True:
-        for f in fs:
-            yield f
+        for i in xrange(len(pool)):
+            yield pool.open(i)
 
 
-def names(mean, stddev, charset=None, seed=None):
+def random_chars(rand, count, charset):
+    """
+    Returns a string of `count` characters drawn uniformly from
+    `charset` using `rand`.
+
+    The characters are made in bulk from random bytes with
+    str.translate, rather than one rand.choice call per character.
+    """
+    # bytes past the last whole multiple of len(charset) are dropped,
+    # so every character stays equally likely
+    usable = 256 - 256 % len(charset)
+    table = ''.join(charset[i % len(charset)] for i in xrange(256))
+    dropped = ''.join(chr(i) for i in xrange(usable, 256))
+
+    r = []
+    have = 0
+    while have < count:
+        need = count - have
+        raw_size = need * 256 // usable + 16
+        raw = _long_to_bytes(rand.getrandbits(raw_size*8), raw_size)
+        chars = raw.translate(table, dropped)[:need]
+        have += len(chars)
+        r.append(chars)
+    return ''.join(r)
+
+
+def _name_lengths(rand, mean, stddev, count):
+    lengths = []
+    while len(lengths) < count:
+        length = int(rand.normalvariate(mean, stddev))
+        if length > 0:
+            lengths.append(length)
+    return lengths
+
+
+def names(mean, stddev, charset=None, seed=None, batch=1024):
     """
     Yields strings that are somewhat plausible as file names, where
     the lenght of each filename follows the normal distribution with
     `mean` and `stddev`.
+
+    Names are generated `batch` at a time.
     """
     if charset is None:
         charset = string.ascii_lowercase
     rand = random.Random(seed)
     while True:
-        while True:
-            length = int(rand.normalvariate(mean, stddev))
-            if length > 0:
-                break
-        name = ''.join(rand.choice(charset) for _ in xrange(length))
-        yield name
+        lengths = _name_lengths(rand, mean, stddev, batch)
+        chars = random_chars(rand, sum(lengths), charset)
+        pos = 0
+        for length in lengths:
+            yield chars[pos:pos + length]
+            pos += length
+
+
+def tree_names(fanout, delimiter='/', skew=0.0, prefix='', mean=15,
+               stddev=4, charset=None, seed=None, batch=1024):
+    """
+    Yields key names shaped like paths in a directory tree, such as
+    ``prefix + 'abc/defg/hijklmn'``, for exercising delimiter listings
+    and bucket index sharding.
+
+    The tree has ``len(fanout)`` levels of directories, and every
+    directory at level ``i`` has ``fanout[i]`` subdirectories. The leaf
+    names follow `mean` and `stddev` like names().
+
+    With `skew` above 0, directories are picked with Zipf-like weights
+    ``1 / (rank + 1) ** skew``, so a few prefixes get most of the keys;
+    with 0 every directory is equally likely.
+    """
+    if charset is None:
+        charset = string.ascii_lowercase
+    rand = random.Random(seed)
+
+    # every level reuses the same directory names under each parent
+    levels = []
+    for n in fanout:
+        lengths = _name_lengths(rand, mean, stddev, n)
+        chars = random_chars(rand, sum(lengths), charset)
+        dirs = []
+        pos = 0
+        for length in lengths:
+            dirs.append(chars[pos:pos + length])
+            pos += length
+        total = 0.0
+        cumulative = []
+        for rank in xrange(n):
+            total += 1.0 / (rank + 1) ** skew
+            cumulative.append(total)
+        levels.append((dirs, cumulative))
+
+    leaves = names(mean, stddev, charset=charset, seed=rand.getrandbits(32), batch=batch)
+    while True:
+        path = [prefix]
+        for dirs, cumulative in levels:
+            if skew:
+                i = bisect.bisect(cumulative, rand.random() * cumulative[-1])
+                path.append(dirs[min(i, len(dirs) - 1)])
+            else:
+                path.append(dirs[rand.randrange(len(dirs))])
+            path.append(delimiter)
+        path.append(next(leaves))
+        yield ''.join(path)
+
+
+def names_from_config(conf, seed):
+    """
+    Returns the object name generator for the optional `names` config
+    section: flat names by default, or directory-like key trees when it
+    has a `fanout` list.
+    """
+    if not conf or 'fanout' not in conf:
+        return names(
+            mean=15,
+            stddev=4,
+            seed=seed,
+            )
+    return tree_names(
+        fanout=conf['fanout'],
+        delimiter=conf.get('delimiter', '/'),
+        skew=conf.get('skew', 0.0),
+        prefix=conf.get('prefix', ''),
+        mean=conf.get('size', 15),
+        stddev=conf.get('stddev', 4),
+        seed=seed,
+        )
+
+
+class AliasTable(object):
+    """
+    Walker's alias method: after O(n) setup, samples index i with
+    probability weights[i] / sum(weights) in O(1), from a single
+    random number.
+    """
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        self.prob = [weight * count / total for weight in weights]
+        self.alias = range(count)
+        small = [i for (i, p) in enumerate(self.prob) if p < 1.0]
+        large = [i for (i, p) in enumerate(self.prob) if p >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.alias[less] = more
+            self.prob[more] -= 1.0 - self.prob[less]
+            if self.prob[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # only rounding errors are left
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self, rand):
+        x = rand.random() * len(self.prob)
+        i = int(x)
+        if x - i < self.prob[i]:
+            return i
+        return self.alias[i]
+
+
+class UniformAccess(object):
+    """
+    Picks every name in `names` equally often, drawing the same random
+    numbers as rand.choice(names).
+    """
+    def __init__(self, names):
+        self.names = names
+
+    def describe(self):
+        return dict(distribution='uniform', keys=len(self.names))
+
+    def choose(self, rand):
+        """
+        Returns a name and its popularity rank; always None here.
+        """
+        return (self.names[int(rand.random() * len(self.names))], None)
+
+
+class ZipfAccess(object):
+    """
+    Picks the name of rank k in `names` (0 being the most popular) with
+    probability proportional to 1 / (k + 1) ** `s`. The top `hot_keys`
+    fraction of the names count as hot in reports.
+    """
+    def __init__(self, names, s=1.0, hot_keys=0.1):
+        if s < 0:
+            raise ValueError('zipf s must not be negative')
+        if not 0 < hot_keys <= 1:
+            raise ValueError('hot_keys must be above 0 and at most 1')
+        self.names = names
+        self.s = s
+        self.hot_keys = hot_keys
+        self.table = AliasTable([1.0 / (k + 1) ** s for k in xrange(len(names))])
+
+    def describe(self):
+        return dict(
+            distribution='zipf',
+            keys=len(self.names),
+            s=self.s,
+            hot_ranks=max(1, int(round(self.hot_keys * len(self.names)))),
+            )
+
+    def choose(self, rand):
+        rank = self.table.sample(rand)
+        return (self.names[rank], rank)
+
+
+class HotspotAccess(object):
+    """
+    Spends a `hot_ops` fraction of the picks on the first `hot_keys`
+    fraction of `names`, and the rest on the others, uniformly within
+    each set.
+    """
+    def __init__(self, names, hot_ops=0.9, hot_keys=0.1):
+        if not 0 <= hot_ops <= 1:
+            raise ValueError('hot_ops must be between 0 and 1')
+        if not 0 < hot_keys <= 1:
+            raise ValueError('hot_keys must be above 0 and at most 1')
+        self.names = names
+        self.hot_ops = hot_ops
+        self.hot_keys = hot_keys
+        self.hot_ranks = max(1, min(len(names), int(round(hot_keys * len(names)))))
+
+    def describe(self):
+        return dict(
+            distribution='hotspot',
+            keys=len(self.names),
+            hot_ops=self.hot_ops,
+            hot_keys=self.hot_keys,
+            hot_ranks=self.hot_ranks,
+            )
+
+    def _rank(self, rand):
+        cold_ranks = len(self.names) - self.hot_ranks
+        if not cold_ranks or rand.random() < self.hot_ops:
+            return int(rand.random() * self.hot_ranks)
+        return self.hot_ranks + int(rand.random() * cold_ranks)
+
+    def choose(self, rand):
+        rank = self._rank(rand)
+        return (self.names[rank], rank)
+
+
+class MovingHotspotAccess(HotspotAccess):
+    """
+    A HotspotAccess whose hot set moves on to the next names, by its own
+    size, every `period` seconds, so that what was hot goes cold.
+    """
+    def __init__(self, names, hot_ops=0.9, hot_keys=0.1, period=60.0, clock=time.time):
+        super(MovingHotspotAccess, self).__init__(names, hot_ops, hot_keys)
+        if period <= 0:
+            raise ValueError('period must be positive')
+        self.period = period
+        self.clock = clock
+        self.start = clock()
+
+    def describe(self):
+        description = super(MovingHotspotAccess, self).describe()
+        description.update(distribution='moving_hotspot', period=self.period)
+        return description
+
+    def choose(self, rand):
+        rank = self._rank(rand)
+        moves = int((self.clock() - self.start) / self.period)
+        return (self.names[(rank + moves * self.hot_ranks) % len(self.names)], rank)
+
+
+def access_from_config(conf, names):
+    """
+    Returns how to pick among `names` for the optional readwrite
+    `access` config section: uniformly by default.
+    """
+    if not conf:
+        return UniformAccess(names)
+    distribution = conf.get('distribution', 'uniform')
+    if distribution == 'uniform':
+        return UniformAccess(names)
+    if distribution == 'zipf':
+        return ZipfAccess(names, conf.get('s', 1.0), conf.get('hot_keys', 0.1))
+    if distribution == 'hotspot':
+        return HotspotAccess(names, conf.get('hot_ops', 0.9), conf.get('hot_keys', 0.1))
+    if distribution == 'moving_hotspot':
+        return MovingHotspotAccess(
+            names,
+            conf.get('hot_ops', 0.9),
+            conf.get('hot_keys', 0.1),
+            conf.get('period', 60.0),
+            )
+    raise ValueError('unknown access distribution: {d!r}'.format(d=distribution))
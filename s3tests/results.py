@@ -0,0 +1,641 @@
+import gevent
+import gevent.queue
+import json
+import marshal
+import math
+import struct
+import sys
+import time
+import yaml
+
+
+class YAMLFormat(object):
+    """
+    One YAML document per result. Slow, but easy to read.
+    """
+    name = 'yaml'
+    header = ''
+
+    def dump(self, result, stream):
+        yaml.safe_dump(result, stream=stream, explicit_start=True)
+
+    def load_all(self, f):
+        return yaml.safe_load_all(f)
+
+    def raw_records(self, f):
+        lines = []
+        for line in iter(f.readline, ''):
+            if line.startswith('---') and lines:
+                yield ''.join(lines)
+                lines = []
+            lines.append(line)
+        if lines:
+            yield ''.join(lines)
+
+
+class JSONLinesFormat(object):
+    """
+    One JSON object per line.
+    """
+    name = 'jsonl'
+    header = ''
+
+    def dump(self, result, stream):
+        stream.write(json.dumps(result, separators=(',', ':')))
+        stream.write('\n')
+
+    def load_all(self, f):
+        loads = json.loads
+        for line in self.raw_records(f):
+            yield loads(line)
+
+    def raw_records(self, f):
+        for line in iter(f.readline, ''):
+            if not line.endswith('\n'):
+                # cut short by a killed run
+                return
+            if line.strip():
+                yield line
+
+
+def _plain(value):
+    """
+    Returns a copy of `value` with every dict, list and tuple, including
+    subclasses of them, turned into a plain dict or list.
+    """
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for (k, v) in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+class BinaryFormat(object):
+    """
+    A header of MAGIC, a 2-byte little endian format version and the
+    major and minor version of the Python that wrote it, followed by
+    records of a 4-byte little endian length and that many bytes of the
+    result in marshal format 2.
+
+    marshal is only guaranteed to read back what the same Python
+    version wrote, so files are refused by other versions; use jsonl
+    for results that are kept or read elsewhere.
+    """
+    name = 'binary'
+    MAGIC = 'S3TR'
+    VERSION = 2
+    PYTHON = sys.version_info[:2]
+    header = MAGIC + struct.pack('<HBB', VERSION, *PYTHON)
+
+    def dump(self, result, stream):
+        try:
+            data = marshal.dumps(result, 2)
+        except ValueError:
+            # marshal takes no subclasses, like the bunch.Bunch values
+            # of the config that phase settings carry
+            data = marshal.dumps(_plain(result), 2)
+        stream.write(struct.pack('<I', len(data)))
+        stream.write(data)
+
+    def _read_header(self, f, magic=None):
+        if magic is None:
+            magic = f.read(len(self.MAGIC))
+        if magic != self.MAGIC:
+            raise ValueError('not a binary result file')
+        (version,) = struct.unpack('<H', f.read(2))
+        if version != self.VERSION:
+            raise ValueError('unsupported binary result version: {v}'.format(v=version))
+        python = struct.unpack('<BB', f.read(2))
+        if python != self.PYTHON:
+            raise ValueError(
+                'binary results written by Python {written} cannot be read by Python {running}'.format(
+                    written='.'.join(map(str, python)),
+                    running='.'.join(map(str, self.PYTHON)),
+                    )
+                )
+
+    def raw_records(self, f, magic=None):
+        self._read_header(f, magic)
+        while True:
+            length = f.read(4)
+            if len(length) < 4:
+                # end of file, or a record cut short by a killed run
+                return
+            (size,) = struct.unpack('<I', length)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield length + data
+
+    def load_all(self, f, magic=None):
+        loads = marshal.loads
+        for record in self.raw_records(f, magic):
+            yield loads(record[4:])
+
+
+FORMATS = dict(
+    (format.name, format)
+    for format in [YAMLFormat(), JSONLinesFormat(), BinaryFormat()]
+    )
+
+
+class _Prefixed(object):
+    """
+    Read-only file that returns `prefix` before the rest of `f`.
+    """
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.f = f
+
+    def read(self, size=-1):
+        prefix = self.prefix
+        if not prefix:
+            return self.f.read(size)
+        if size < 0:
+            self.prefix = ''
+            return prefix + self.f.read()
+        self.prefix = prefix[size:]
+        data = prefix[:size]
+        if len(data) < size:
+            data += self.f.read(size - len(data))
+        return data
+
+    def readline(self):
+        prefix = self.prefix
+        if '\n' in prefix:
+            line, self.prefix = prefix.split('\n', 1)
+            return line + '\n'
+        self.prefix = ''
+        return prefix + self.f.readline()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+def load_all(f):
+    """
+    Yields the results in the file `f`, in whichever of the FORMATS it
+    was written.
+    """
+    magic = f.read(len(BinaryFormat.MAGIC))
+    if magic == BinaryFormat.MAGIC:
+        return FORMATS['binary'].load_all(f, magic)
+    if magic.startswith('{'):
+        return FORMATS['jsonl'].load_all(_Prefixed(magic, f))
+    return FORMATS['yaml'].load_all(_Prefixed(magic, f))
+
+
+# the types of results that are single operations: whole object reads
+# and writes, and the other operations of a readwrite operation mix
+OP_TYPES = ('r', 'w', 'head', 'list', 'delete', 'copy', 'range', 'multipart')
+
+
+def result_size(result):
+    """
+    The number of bytes read or written by the operation `result`.
+    """
+    if 'chunks' in result:
+        return result['chunks'][-1][0]
+    return result['size']
+
+
+def size_class(size):
+    """
+    Returns the smallest power of two number of KB that `size` bytes
+    fit in.
+    """
+    kb = 1
+    while kb * 1024 < size:
+        kb *= 2
+    return kb
+
+
+def result_label(result):
+    """
+    What the operation `result` is reported as: its type, with each
+    part size of a multipart upload sweep and each size class of ranged
+    reads on its own.
+    """
+    if 'part_size' in result:
+        return '{type} {size} KB parts'.format(
+            type=result['type'],
+            size=result['part_size'] // 1024,
+            )
+    if 'length' in result:
+        return '{type} up to {size} KB'.format(
+            type=result['type'],
+            size=size_class(result['length']),
+            )
+    return result['type']
+
+
+# the parts of a request, from the marks of common.RequestTimer
+TIMING_COMPONENTS = ('prepare', 'connect', 'send', 'wait', 'receive')
+
+
+def timing_components(timing):
+    """
+    Splits the `timing` marks of a result into the nanoseconds spent
+    preparing the request, opening a connection (only for requests
+    that opened one), sending the request, waiting for the first byte
+    of the response and receiving the rest of it.
+    """
+    components = dict(prepare=timing['request'])
+    sending = timing['request']
+    if 'connected' in timing:
+        components['connect'] = timing['connected'] - timing['connect_start']
+        sending = timing['connected']
+    components['send'] = timing['sent'] - sending
+    components['wait'] = timing['first_byte'] - timing['sent']
+    components['receive'] = timing['last_byte'] - timing['first_byte']
+    return components
+
+
+class Histogram(object):
+    """
+    Counts of non-negative integers in log-scaled buckets, as in HDR
+    histograms.
+
+    Values below 2**precision get a bucket each; above that, every
+    power of two is split into 2**(precision-1) buckets, so a value is
+    known to within 2**(1-precision) of itself (0.8% by default) while
+    a 64-bit value range needs at most a few thousand buckets. The
+    count, total, min and max are exact.
+    """
+    def __init__(self, precision=8):
+        self.precision = precision
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return (shift << (self.precision - 1)) + (value >> shift)
+
+    def _highest(self, index):
+        """
+        The highest value counted in bucket `index`.
+        """
+        if index < 1 << self.precision:
+            return index
+        shift = (index >> (self.precision - 1)) - 1
+        base = index - (shift << (self.precision - 1))
+        return ((base + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            raise ValueError('cannot record negative value: {v}'.format(v=value))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge histograms of different precision')
+        for index, count in other.counts.iteritems():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / float(self.count)
+
+    def percentile(self, percent):
+        """
+        The value below or at which `percent` percent of the recorded
+        values are, or None if there are none.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return max(self.min, min(self.max, self._highest(index)))
+        return self.max
+
+    def to_dict(self):
+        return dict(
+            precision=self.precision,
+            count=self.count,
+            total=self.total,
+            min=self.min,
+            max=self.max,
+            counts=[[index, self.counts[index]] for index in sorted(self.counts)],
+            )
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls(precision=d['precision'])
+        histogram.counts = dict((index, count) for (index, count) in d['counts'])
+        histogram.count = d['count']
+        histogram.total = d['total']
+        histogram.min = d['min']
+        histogram.max = d['max']
+        return histogram
+
+
+class Aggregator(object):
+    """
+    Takes the place of a ResultSink for long runs: instead of passing
+    on every operation, keeps a latency and a size Histogram per
+    result_label of operation and passes on one "histogram" result per
+    label every `interval` seconds. Results of other types go through
+    as they are.
+
+    Where the operations record them, a histogram result also has
+    - timing: a latency Histogram per part of the requests
+    - reuse: the count and total duration of the operations on new and
+      on reused connections
+    - hot, cold: latency Histograms of the operations on objects of
+      popularity rank below `hot_ranks` and of the others
+    - parts: a latency Histogram of the parts of multipart uploads, and
+      their total size and duration
+
+    Failed operations are only counted; errors and first_error keep
+    track of them as in ResultSink.
+    """
+    def __init__(self, sink, interval, precision=8, hot_ranks=None):
+        self.sink = sink
+        self.interval = interval
+        self.precision = precision
+        self.hot_ranks = hot_ranks
+        self.errors = 0
+        self.first_error = None
+        self.stats = {}
+        self.interval_end = time.time() + interval
+
+    def put(self, result):
+        now = time.time()
+        if now >= self.interval_end:
+            self.flush()
+            while self.interval_end <= now:
+                self.interval_end += self.interval
+
+        type_ = result.get('type')
+        if type_ not in OP_TYPES:
+            self.sink.put(result)
+            return
+
+        label = result_label(result)
+        stats = self.stats.get(label)
+        if stats is None:
+            stats = self.stats[label] = dict(
+                errors=0,
+                start=None,
+                end=None,
+                latency=Histogram(self.precision),
+                bytes=Histogram(self.precision),
+                timing={},
+                )
+        if 'error' in result:
+            stats['errors'] += 1
+            self.errors += 1
+            if self.first_error is None:
+                self.first_error = result['error']
+            return
+
+        stats['latency'].record(result['duration'])
+        stats['bytes'].record(result_size(result))
+        if 'timing' in result:
+            components = timing_components(result['timing'])
+            for name, value in components.iteritems():
+                if name not in stats['timing']:
+                    stats['timing'][name] = Histogram(self.precision)
+                stats['timing'][name].record(max(value, 0))
+        if 'reused' in result:
+            reuse = stats.setdefault('reuse', dict(new=[0, 0], reused=[0, 0]))
+            counts = reuse['reused' if result['reused'] else 'new']
+            counts[0] += 1
+            counts[1] += result['duration']
+        if 'rank' in result and self.hot_ranks is not None:
+            hot = 'hot' if result['rank'] < self.hot_ranks else 'cold'
+            if hot not in stats:
+                stats[hot] = Histogram(self.precision)
+            stats[hot].record(result['duration'])
+        if 'parts' in result:
+            parts = stats.setdefault('parts', dict(
+                    latency=Histogram(self.precision),
+                    size=0,
+                    busy=0,
+                    ))
+            for part in result['parts']:
+                parts['latency'].record(part['duration'])
+                parts['size'] += part['size']
+                parts['busy'] += part['duration']
+        start = result['start']
+        end = start + result['duration'] / 1e9
+        if stats['start'] is None or start < stats['start']:
+            stats['start'] = start
+        if stats['end'] is None or end > stats['end']:
+            stats['end'] = end
+
+    def flush(self):
+        """
+        Passes on the histograms of the current interval and starts
+        over with empty ones.
+        """
+        for label in sorted(self.stats):
+            stats = self.stats[label]
+            record = dict(
+                type='histogram',
+                op=label,
+                interval=self.interval,
+                start=stats['start'],
+                end=stats['end'],
+                errors=stats['errors'],
+                latency=stats['latency'].to_dict(),
+                bytes=stats['bytes'].to_dict(),
+                )
+            if stats['timing']:
+                record['timing'] = dict(
+                    (name, histogram.to_dict())
+                    for name, histogram in stats['timing'].iteritems()
+                    )
+            if 'reuse' in stats:
+                record['reuse'] = stats['reuse']
+            for hot in ['hot', 'cold']:
+                if hot in stats:
+                    record['hot_ranks'] = self.hot_ranks
+                    record[hot] = stats[hot].to_dict()
+            if 'parts' in stats:
+                record['parts'] = dict(
+                    stats['parts'],
+                    latency=stats['parts']['latency'].to_dict(),
+                    )
+            self.sink.put(record)
+        self.stats = {}
+
+
+LIVE_FORMAT = '{clock} {prefix}{op:>9}: {ops_per_sec:>9.1f} ops/s {mb_per_sec:>9.2f} MB/s {errors:>5} errors  p50 {p50:.3f}  p99 {p99:.3f} secs'
+
+
+class LiveStats(object):
+    """
+    Passes results on to `queue`, and every `interval` seconds prints
+    the throughput, errors and latency percentiles of each type of
+    operation finished during the last interval to `stream` (stderr by
+    default). With a `path`, they are also appended to that file as
+    JSON lines, along with the time and `label`.
+    """
+    def __init__(self, queue, interval, path=None, label=None, stream=None):
+        self.queue = queue
+        self.interval = interval
+        self.label = label
+        self.stream = stream
+        self.output = None
+        if path is not None:
+            self.output = open(path, 'a')
+        self.stats = {}
+        self.last_report = time.time()
+        self._greenlet = gevent.spawn(self._run)
+
+    def put(self, result):
+        type_ = result.get('type')
+        if type_ in OP_TYPES:
+            stats = self.stats.get(type_)
+            if stats is None:
+                stats = self.stats[type_] = dict(
+                    ops=0,
+                    errors=0,
+                    bytes=0,
+                    latency=Histogram(),
+                    )
+            if 'error' in result:
+                stats['errors'] += 1
+            else:
+                stats['ops'] += 1
+                stats['bytes'] += result_size(result)
+                stats['latency'].record(result['duration'])
+        self.queue.put(result)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.report()
+
+    def report(self):
+        now = time.time()
+        elapsed = max(now - self.last_report, 1e-9)
+        self.last_report = now
+        stats, self.stats = self.stats, {}
+        stream = self.stream or sys.stderr
+        for type_ in sorted(stats):
+            latency = stats[type_]['latency']
+            line = dict(
+                time=now,
+                interval=elapsed,
+                op=type_,
+                ops=stats[type_]['ops'],
+                errors=stats[type_]['errors'],
+                ops_per_sec=stats[type_]['ops'] / elapsed,
+                mb_per_sec=stats[type_]['bytes'] / elapsed / 1024.0 / 1024.0,
+                p50=(latency.percentile(50) or 0) / 1e9,
+                p99=(latency.percentile(99) or 0) / 1e9,
+                )
+            if self.label is not None:
+                line['label'] = self.label
+            print >> stream, LIVE_FORMAT.format(
+                clock=time.strftime('%H:%M:%S', time.localtime(now)),
+                prefix='' if self.label is None else '[{label}] '.format(label=self.label),
+                **line
+                )
+            if self.output is not None:
+                self.output.write(json.dumps(line, sort_keys=True))
+                self.output.write('\n')
+        if self.output is not None:
+            self.output.flush()
+
+    def close(self):
+        """
+        Stops reporting, after a last report of what is left.
+        """
+        self._greenlet.kill()
+        self.report()
+        if self.output is not None:
+            self.output.close()
+
+
+class ResultSink(object):
+    """
+    Writes results to `stream` in `format` (one of FORMATS) while the
+    run goes on, from a dedicated greenlet.
+
+    At most `maxsize` results wait in memory; once that many are queued,
+    put() blocks the worker producing them until the writer catches up.
+    The stream is flushed at least every `flush_interval` seconds, so a
+    run that gets killed still leaves the results written until then.
+
+    Besides result dicts, put() takes already serialized records as
+    strings, which are written as they are.
+    """
+    def __init__(self, stream, format='yaml', maxsize=10000, flush_interval=1.0):
+        self.stream = stream
+        self.format = FORMATS[format]
+        self.flush_interval = flush_interval
+        self.queue = gevent.queue.Queue(maxsize=maxsize)
+        self.count = 0
+        self.errors = 0
+        self.first_error = None
+        self.stream.write(self.format.header)
+        self._greenlet = gevent.spawn(self._run)
+
+    def put(self, result):
+        self.queue.put(result)
+
+    def _run(self):
+        dump = self.format.dump
+        last_flush = time.time()
+        for result in self.queue:
+            if isinstance(result, str):
+                self.stream.write(result)
+            else:
+                if 'error' in result:
+                    self.errors += 1
+                    if self.first_error is None:
+                        self.first_error = result['error']
+                dump(result, self.stream)
+            self.count += 1
+
+            now = time.time()
+            if self.queue.empty() or now - last_flush >= self.flush_interval:
+                self.stream.flush()
+                last_flush = now
+        self.stream.flush()
+
+    def close(self):
+        """
+        Writes out everything still queued and waits for it.
+        """
+        self.queue.put(StopIteration)
+        self._greenlet.get()
+
+
+def relay_records(f, sink):
+    """
+    Copies the records another ResultSink with the same format wrote to
+    the file `f` (usually a pipe from a worker process) into `sink`,
+    one whole record at a time, until end of file.
+    """
+    for record in sink.format.raw_records(f):
+        sink.put(record)
@@ -3,15 +3,15 @@ import gevent.pool
 import gevent.queue
 import gevent.monkey; gevent.monkey.patch_all()
 import itertools
+import math
 import optparse
 import os
 import sys
 import time
-import traceback
 import random
-import yaml
 
 import realistic
+import results
 import common
 
 NANOSECOND = int(1e9)
@@ -25,35 +25,69 @@ def writer(bucket, objname, fp, queue):
         key=key.name,
         )
 
-    start = time.time()
-    try:
-        key.set_contents_from_file(fp, rewind=True)
-    except gevent.GreenletExit:
-        raise
-    except Exception as e:
-        # stop timer ASAP, even on errors
-        end = time.time()
-        result.update(
-            error=dict(
-                msg=str(e),
-                traceback=traceback.format_exc(),
-                ),
-            )
-        # certain kinds of programmer errors make this a busy
-        # loop; let parent greenlet get some time too
-        time.sleep(0)
-    else:
-        end = time.time()
+    common.run_request(bucket, result, lambda: key.set_contents_from_file(fp, rewind=True))
+    result.update(chunks=fp.last_chunks)
+    queue.put(result)
+
+
+def multipart_writer(bucket, objname, fp, queue, part_size, concurrency=1):
+    """
+    Writes `fp` to `objname` as a multipart upload of `part_size` byte
+    parts, `concurrency` of them at once, each read from its own copy
+    of `fp`. The result records the time of every part as well as of
+    the whole upload.
+    """
+    result = dict(
+        type='multipart',
+        bucket=bucket.name,
+        key=objname,
+        part_size=part_size,
+        concurrency=concurrency,
+        )
+    parts = []
+
+    def upload_part(upload, part_num, offset, size):
+        part = fp.copy(offset)
+        start = time.time()
+        upload.upload_part_from_file(part, part_num, size=size)
+        parts.append(dict(
+                num=part_num,
+                size=size,
+                start=start,
+                duration=int(round((time.time() - start) * NANOSECOND)),
+                ))
 
-    elapsed = end - start
+    def upload_parts():
+        upload = bucket.initiate_multipart_upload(objname)
+        group = gevent.pool.Pool(size=concurrency)
+        try:
+            # an empty object is a single empty part
+            offsets = xrange(0, max(fp.size, 1), part_size)
+            for (part_num, offset) in enumerate(offsets, 1):
+                group.spawn(
+                    upload_part,
+                    upload,
+                    part_num,
+                    offset,
+                    min(part_size, fp.size - offset),
+                    )
+            group.join(raise_error=True)
+            upload.complete_upload()
+        except:
+            group.kill()
+            upload.cancel_upload()
+            raise
+
+    # hash the object once, before and outside the timing, or else the
+    # copy uploading the last part would rehash all of it
+    fp.compute_digest()
+    common.run_request(bucket, result, upload_parts, timing=False)
     result.update(
-        start=start,
-        duration=int(round(elapsed * NANOSECOND)),
-        chunks=fp.last_chunks,
+        size=fp.size,
+        parts=sorted(parts, key=lambda part: part['num']),
         )
     queue.put(result)
 
-
 def reader(bucket, objname, queue):
     key = bucket.new_key(objname)
 
@@ -64,49 +98,250 @@ def reader(bucket, objname, queue):
             key=key.name,
             )
 
-    start = time.time()
-    try:
-        key.get_contents_to_file(fp)
-    except gevent.GreenletExit:
-        raise
-    except Exception as e:
-        # stop timer ASAP, even on errors
-        end = time.time()
+    common.run_request(bucket, result, lambda: key.get_contents_to_file(fp))
+    if 'error' not in result and not fp.valid():
         result.update(
             error=dict(
-                msg=str(e),
-                traceback=traceback.format_exc(),
+                msg='md5sum check failed',
                 ),
             )
-        # certain kinds of programmer errors make this a busy
-        # loop; let parent greenlet get some time too
-        time.sleep(0)
-    else:
-        end = time.time()
+    result.update(chunks=fp.chunks)
+    queue.put(result)
 
-        if not fp.valid():
+def range_reader(bucket, objname, offset, length, size, seed, content, queue):
+    """
+    Reads `length` bytes of `objname` from `offset` with a ranged GET,
+    and checks them against the same bytes of the RandomContentFile of
+    `size`, `seed` and `content` ratios the object was written from,
+    regenerated instead of keeping the object around.
+    """
+    key = bucket.new_key(objname)
+
+    result = dict(
+        type='range',
+        bucket=bucket.name,
+        key=key.name,
+        offset=offset,
+        length=length,
+        )
+
+    def read():
+        return key.get_contents_as_string(headers=dict(
+                Range='bytes={first}-{last}'.format(first=offset, last=offset + length - 1),
+                ))
+    data = common.run_request(bucket, result, read) or ''
+    if 'error' not in result:
+        expected = realistic.RandomContentFile(size, seed, **content)
+        expected.seek(offset)
+        if data != expected.read(length):
             result.update(
                 error=dict(
-                    msg='md5sum check failed',
+                    msg='range check failed: {got} bytes from {offset}, {length} expected'.format(
+                        got=len(data),
+                        offset=offset,
+                        length=length,
+                        ),
                     ),
                 )
-
-    elapsed = end - start
-    result.update(
-        start=start,
-        duration=int(round(elapsed * NANOSECOND)),
-        chunks=fp.chunks,
-        )
+    result.update(size=len(data))
     queue.put(result)
 
+def random_ranges(rand, files, count, min_size, max_size):
+    """
+    Yields `count` (object name, offset, length) ranges of objects in
+    `files`, a dict of their names and sizes, picked at random. Lengths
+    are log-uniform between `min_size` and `max_size` bytes, so small
+    and large ranges are about as common, cut to the object size, and
+    offsets uniform over where the range fits.
+    """
+    names = sorted(name for (name, size) in files.iteritems() if size > 0)
+    if not names:
+        return
+    low = math.log(min_size)
+    high = math.log(max_size)
+    for _ in xrange(count):
+        objname = rand.choice(names)
+        size = files[objname]
+        length = min(size, int(round(math.exp(rand.uniform(low, high)))))
+        offset = rand.randrange(size - length + 1)
+        yield (objname, offset, length)
+
+class Visibility(object):
+    """
+    Read-after-write checks, used as the writers' queue: results put in
+    it are passed on to `queue`, and after every successful write the
+    object is read from `delay` seconds after the write finished, for
+    each of `delays`, with a bucket taken from `buckets`. Reads are
+    retried every `retry` seconds until one reads back the whole object
+    intact, for at most `timeout` seconds.
+
+    Every check is a 'visibility' result, with the lag from the end of
+    the write to the start of the first read that saw the object, and
+    the lags of all checks are kept in a Histogram per delay.
+    """
+    def __init__(self, buckets, queue, delays, retry=0.1, timeout=30):
+        self.buckets = buckets
+        self.queue = queue
+        self.delays = delays
+        self.retry = retry
+        self.timeout = timeout
+        self.group = gevent.pool.Group()
+        self.lags = dict((delay, results.Histogram()) for delay in delays)
+        self.missing = dict((delay, 0) for delay in delays)
+
+    def put(self, result):
+        if result.get('type') in ('w', 'multipart') and 'error' not in result:
+            written = result['start'] + result['duration'] / float(NANOSECOND)
+            for delay in self.delays:
+                self.group.spawn(
+                    self.check,
+                    objname=result['key'],
+                    size=results.result_size(result),
+                    written=written,
+                    delay=delay,
+                    )
+        self.queue.put(result)
+
+    def read(self, bucket, objname, size):
+        """
+        Returns None if `objname` reads back intact from `bucket`, or
+        else why not.
+        """
+        try:
+            fp = realistic.FileVerifier()
+            bucket.new_key(objname).get_contents_to_file(fp)
+        except gevent.GreenletExit:
+            raise
+        except Exception as e:
+            return str(e)
+        if fp.size != size:
+            return 'read {got} bytes of {size}'.format(got=fp.size, size=size)
+        if not fp.valid():
+            return 'md5sum check failed'
+        return None
+
+    def check(self, objname, size, written, delay):
+        result = dict(
+            type='visibility',
+            key=objname,
+            start=written,
+            delay=delay,
+            )
+        deadline = written + self.timeout
+        due = written + delay
+        attempts = 0
+        while True:
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            bucket = self.buckets.get()
+            try:
+                start = time.time()
+                attempts += 1
+                problem = self.read(bucket, objname, size)
+            finally:
+                self.buckets.put(bucket)
+            if problem is None:
+                lag = int(round((start - written) * NANOSECOND))
+                result.update(lag=lag)
+                self.lags[delay].record(max(lag, 0))
+                break
+            if time.time() + self.retry > deadline:
+                result.update(
+                    error=dict(
+                        msg='not visible after {timeout} secs: {problem}'.format(
+                            timeout=self.timeout,
+                            problem=problem,
+                            ),
+                        ),
+                    )
+                self.missing[delay] += 1
+                break
+            due = time.time() + self.retry
+        result.update(attempts=attempts)
+        self.queue.put(result)
+
+    def close(self):
+        """
+        Waits for the checks still running, then passes on a
+        'visibility_lag' result with the lag Histogram of each delay,
+        and prints them.
+        """
+        self.group.join()
+        for delay in self.delays:
+            lags = self.lags[delay]
+            self.queue.put(dict(
+                    type='visibility_lag',
+                    delay=delay,
+                    missing=self.missing[delay],
+                    lag=lags.to_dict(),
+                    ))
+            print VISIBILITY_FORMAT.format(
+                delay=delay,
+                visible=lags.count,
+                total=lags.count + self.missing[delay],
+                p50=(lags.percentile(50) or 0) / float(NANOSECOND),
+                p99=(lags.percentile(99) or 0) / float(NANOSECOND),
+                max=(lags.max or 0) / float(NANOSECOND),
+                )
+
+VISIBILITY_FORMAT = 'Visibility from {delay} secs: {visible} of {total} objects seen, lag p50 {p50:.3f} p99 {p99:.3f} max {max:.3f} secs'
+
+def with_bucket(buckets, op, **kwargs):
+    """
+    Runs `op` with a bucket taken from the queue `buckets` for the
+    time being, so each has at most one operation in flight.
+    """
+    bucket = buckets.get()
+    try:
+        op(bucket=bucket, **kwargs)
+    finally:
+        buckets.put(bucket)
+
+def worker_buckets(config, bucket, count, s3=None):
+    """
+    A queue of `count` buckets for the workers to take turns with: all
+    of them `bucket`, sharing its connection pool, unless
+    roundtrip.connections asks for a pool per worker, connecting as
+    `s3` says if set, or else as config.s3 does.
+    """
+    buckets = gevent.queue.Queue()
+    for _ in xrange(count):
+        if 'connections' in config.roundtrip:
+            conn = common.connect(s3 or config.s3, pool=config.roundtrip.connections)
+            buckets.put(conn.get_bucket(bucket.name, validate=False))
+        else:
+            buckets.put(bucket)
+    return buckets
+
 def parse_options():
     parser = optparse.OptionParser(
         usage='%prog [OPTS] <CONFIG_YAML',
         )
     parser.add_option("--no-cleanup", dest="cleanup", action="store_false",
         help="skip cleaning up all created buckets", default=True)
+    parser.add_option("--format", dest="format", type="choice", default="yaml",
+        choices=sorted(results.FORMATS),
+        help="format of the results: yaml, jsonl or binary, which only the same Python version reads back (default %default)")
+    parser.add_option("--aggregate", dest="aggregate", type="float",
+        help="instead of every operation, write latency and size histograms "
+             "of each operation type every SECONDS", metavar="SECONDS")
+    parser.add_option("--live", dest="live", type="float",
+        help="print the throughput, errors and latency of each operation "
+             "type to stderr every SECONDS while running", metavar="SECONDS")
+    parser.add_option("--live-file", dest="live_file",
+        help="also append the --live statistics to PATH as JSON lines",
+        metavar="PATH")
 
-    return parser.parse_args()
+    (options, args) = parser.parse_args()
+    if options.aggregate is not None and options.aggregate <= 0:
+        parser.error("--aggregate must be positive")
+    if options.live is not None and options.live <= 0:
+        parser.error("--live must be positive")
+    if options.live_file is not None and options.live is None:
+        parser.error("--live-file needs --live")
+
+    return (options, args)
 
 def main():
     # parse options
@@ -129,62 +364,165 @@ def main():
         for item in ['readers', 'writers', 'duration', 'files', 'bucket']:
             if item not in config.roundtrip:
                 raise RuntimeError("Missing roundtrip config item: {item}".format(item=item))
-        for item in ['num', 'size', 'stddev']:
+        for item in ['num']:
             if item not in config.roundtrip.files:
                 raise RuntimeError("Missing roundtrip config item: files.{item}".format(item=item))
+        visibility_conf = config.roundtrip.get('visibility')
+        if visibility_conf is not None:
+            if not visibility_conf.get('delays'):
+                raise RuntimeError("Missing roundtrip config item: visibility.delays")
+            if min(visibility_conf.delays) < 0 or visibility_conf.get('retry', 0.1) <= 0:
+                raise RuntimeError("Bad roundtrip config item: visibility: delays must not be negative, and retry must be positive")
+            if config.roundtrip.readers < 1:
+                raise RuntimeError("Bad roundtrip config item: visibility needs at least one reader to check with")
+        multipart_conf = config.roundtrip.get('multipart')
+        part_sizes = [None]
+        if multipart_conf is not None:
+            if 'part_size' not in multipart_conf:
+                raise RuntimeError("Missing roundtrip config item: multipart.part_size")
+            part_sizes = multipart_conf.part_size
+            if not isinstance(part_sizes, list):
+                part_sizes = [part_sizes]
+            if not part_sizes or min(part_sizes) <= 0 or multipart_conf.get('concurrency', 1) < 1:
+                raise RuntimeError("Bad roundtrip config item: multipart: part sizes must be positive, and concurrency at least 1")
+        ranges_conf = config.roundtrip.get('ranges')
+        if ranges_conf is not None:
+            if 'count' not in ranges_conf:
+                raise RuntimeError("Missing roundtrip config item: ranges.count")
+            if not 0 < ranges_conf.get('min_size', 1) <= ranges_conf.get('max_size', 1024):
+                raise RuntimeError("Bad roundtrip config item: ranges: min_size must be positive, and at most max_size")
 
         seeds = dict(config.roundtrip.get('random_seed', {}))
         seeds.setdefault('main', random.randrange(2**32))
 
         rand = random.Random(seeds['main'])
 
-        for name in ['names', 'contents', 'writer', 'reader']:
+        for name in ['names', 'contents', 'writer', 'reader', 'ranges']:
             seeds.setdefault(name, rand.randrange(2**32))
 
         print 'Using random seeds: {seeds}'.format(seeds=seeds)
 
+        content = dict(
+            compression=config.roundtrip.files.get('compression', 1.0),
+            dedupe=config.roundtrip.files.get('dedupe', 0.0),
+            )
+        try:
+            realistic.check_content_ratios(**content)
+        except ValueError as e:
+            raise RuntimeError("Bad roundtrip config item: files: {e}".format(e=e))
+        print 'Using content ratios: {content}'.format(content=content)
+
+        try:
+            sizes = realistic.sizes_from_config(config.roundtrip.files)
+        except KeyError as e:
+            raise RuntimeError("Missing roundtrip config item: files.{item}".format(item=e.args[0]))
+        except ValueError as e:
+            raise RuntimeError("Bad roundtrip config item: files: {e}".format(e=e))
+        print 'Using file sizes: {sizes}'.format(sizes=sizes.describe())
+
         # setup bucket and other objects
         bucket_name = common.choose_bucket_prefix(config.roundtrip.bucket, max_len=30)
         bucket = conn.create_bucket(bucket_name)
         print "Created bucket: {name}".format(name=bucket.name)
-        objnames = realistic.names(
-            mean=15,
-            stddev=4,
-            seed=seeds['names'],
-            )
+        objnames = realistic.names_from_config(config.roundtrip.get('names'), seeds['names'])
         objnames = itertools.islice(objnames, config.roundtrip.files.num)
         objnames = list(objnames)
-        files = realistic.files(
-            mean=1024 * config.roundtrip.files.size,
-            stddev=1024 * config.roundtrip.files.stddev,
-            seed=seeds['contents'],
-            )
-        q = gevent.queue.Queue()
-
-        logger_g = gevent.spawn(yaml.safe_dump_all, q, stream=real_stdout)
+        sink = results.ResultSink(real_stdout, format=options.format)
+        q = sink
+        if options.aggregate is not None:
+            q = results.Aggregator(sink, interval=options.aggregate)
+        live = q
+        if options.live is not None:
+            live = results.LiveStats(q, interval=options.live, path=options.live_file)
+        # record what is needed to reproduce the run along with the results
+        q.put(dict(
+                type='config',
+                seeds=seeds,
+                content=content,
+                sizes=sizes.describe(),
+                ))
 
-        print "Writing {num} objects with {w} workers...".format(
-            num=config.roundtrip.files.num,
-            w=config.roundtrip.writers,
-            )
-        pool = gevent.pool.Pool(size=config.roundtrip.writers)
-        start = time.time()
-        for objname in objnames:
-            fp = next(files)
-            pool.spawn(
-                writer,
-                bucket=bucket,
-                objname=objname,
-                fp=fp,
-                queue=q,
+        # the size and seed every object was last written with, to
+        # check ranges against
+        written = {}
+        writes = live
+        visibility = None
+        if visibility_conf is not None:
+            print "Checking when written objects can be read from {delays} secs after writing them...".format(
+                delays=visibility_conf.delays,
                 )
-        pool.join()
-        stop = time.time()
-        elapsed = stop - start
-        q.put(dict(
+            check_bucket = bucket
+            check_s3 = None
+            if 'endpoint' in visibility_conf:
+                check_s3 = dict(config.s3)
+                check_s3.update(visibility_conf.endpoint)
+                check_bucket = common.connect(check_s3).get_bucket(bucket.name, validate=False)
+            writes = visibility = Visibility(
+                buckets=worker_buckets(config, check_bucket, config.roundtrip.readers, s3=check_s3),
+                queue=live,
+                delays=visibility_conf.delays,
+                retry=visibility_conf.get('retry', 0.1),
+                timeout=visibility_conf.get('timeout', 30),
+                )
+        # with a list of part sizes, all objects are written again with
+        # each of them, with the same contents every time
+        for part_size in part_sizes:
+            if part_size is None:
+                print "Writing {num} objects with {w} workers...".format(
+                    num=config.roundtrip.files.num,
+                    w=config.roundtrip.writers,
+                    )
+                op = writer
+                kwargs = {}
+            else:
+                kwargs = dict(
+                    part_size=part_size * 1024,
+                    concurrency=multipart_conf.get('concurrency', 1),
+                    )
+                print "Writing {num} objects in {size} KB parts, {concurrency} at once, with {w} workers...".format(
+                    num=config.roundtrip.files.num,
+                    size=part_size,
+                    concurrency=kwargs['concurrency'],
+                    w=config.roundtrip.writers,
+                    )
+                op = multipart_writer
+            files = realistic.files(
+                mean=None,
+                stddev=None,
+                sizes=sizes,
+                seed=seeds['contents'],
+                **content
+                )
+            pool = gevent.pool.Pool(size=config.roundtrip.writers)
+            buckets = worker_buckets(config, bucket, config.roundtrip.writers)
+            start = time.time()
+            for objname in objnames:
+                fp = next(files)
+                if ranges_conf is not None:
+                    written[objname] = (fp.size, fp.seed)
+                pool.spawn(
+                    with_bucket,
+                    buckets,
+                    op,
+                    objname=objname,
+                    fp=fp,
+                    queue=writes,
+                    **kwargs
+                    )
+            pool.join()
+            stop = time.time()
+            elapsed = stop - start
+            if options.aggregate is not None:
+                q.flush()
+            done = dict(
                 type='write_done',
                 duration=int(round(elapsed * NANOSECOND)),
-                ))
+                )
+            if part_size is not None:
+                done['part_size'] = kwargs['part_size']
+            q.put(done)
+        if visibility is not None:
+            visibility.close()
 
         print "Reading {num} objects with {w} workers...".format(
             num=config.roundtrip.files.num,
@@ -193,24 +531,71 @@ def main():
         # avoid accessing them in the same order as the writing
         rand.shuffle(objnames)
         pool = gevent.pool.Pool(size=config.roundtrip.readers)
+        buckets = worker_buckets(config, bucket, config.roundtrip.readers)
         start = time.time()
         for objname in objnames:
             pool.spawn(
+                with_bucket,
+                buckets,
                 reader,
-                bucket=bucket,
                 objname=objname,
-                queue=q,
+                queue=live,
                 )
         pool.join()
         stop = time.time()
         elapsed = stop - start
+        if options.aggregate is not None:
+            q.flush()
         q.put(dict(
                 type='read_done',
                 duration=int(round(elapsed * NANOSECOND)),
                 ))
 
-        q.put(StopIteration)
-        logger_g.get()
+        if ranges_conf is not None:
+            min_size = ranges_conf.get('min_size', 1)
+            max_size = ranges_conf.get('max_size', 1024)
+            print "Reading {count} random ranges of {min_size} to {max_size} KB with {w} workers...".format(
+                count=ranges_conf.count,
+                min_size=min_size,
+                max_size=max_size,
+                w=config.roundtrip.readers,
+                )
+            ranges = random_ranges(
+                rand=random.Random(seeds['ranges']),
+                files=dict((objname, size) for (objname, (size, _)) in written.iteritems()),
+                count=ranges_conf.count,
+                min_size=min_size * 1024,
+                max_size=max_size * 1024,
+                )
+            pool = gevent.pool.Pool(size=config.roundtrip.readers)
+            buckets = worker_buckets(config, bucket, config.roundtrip.readers)
+            start = time.time()
+            for (objname, offset, length) in ranges:
+                pool.spawn(
+                    with_bucket,
+                    buckets,
+                    range_reader,
+                    objname=objname,
+                    offset=offset,
+                    length=length,
+                    size=written[objname][0],
+                    seed=written[objname][1],
+                    content=content,
+                    queue=live,
+                    )
+            pool.join()
+            stop = time.time()
+            elapsed = stop - start
+            if options.aggregate is not None:
+                q.flush()
+            q.put(dict(
+                    type='range_done',
+                    duration=int(round(elapsed * NANOSECOND)),
+                    ))
+
+        if options.live is not None:
+            live.close()
+        sink.close()
 
     finally:
         # cleanup
@@ -0,0 +1,194 @@
+from s3tests import common
+
+import time
+import warnings
+
+from nose.tools import eq_ as eq
+
+HOST = ('localhost', 80, False)
+
+
+def pooled(**kwargs):
+    return common.PooledS3Connection(
+        host='localhost',
+        is_secure=False,
+        aws_access_key_id='access',
+        aws_secret_access_key='secret',
+        **kwargs
+        )
+
+
+class TestPooledS3Connection(object):
+    def test_reuse(self):
+        conn = pooled()
+        first = conn.get_http_connection(*HOST)
+        eq(conn.opened, 1)
+        conn.put_http_connection(*(HOST + (first,)))
+        assert conn.get_http_connection(*HOST) is first
+        eq(conn.opened, 1)
+
+    def test_no_keepalive(self):
+        conn = pooled(keepalive=False)
+        first = conn.get_http_connection(*HOST)
+        conn.put_http_connection(*(HOST + (first,)))
+        assert conn.get_http_connection(*HOST) is not first
+        eq(conn.opened, 2)
+
+    def test_max_requests(self):
+        conn = pooled(max_requests=2)
+        first = conn.get_http_connection(*HOST)
+        conn.put_http_connection(*(HOST + (first,)))
+        assert conn.get_http_connection(*HOST) is first
+        conn.put_http_connection(*(HOST + (first,)))
+        assert conn.get_http_connection(*HOST) is not first
+        eq(conn.opened, 2)
+
+    def test_pool_size(self):
+        conn = pooled(pool_size=1)
+        first = conn.get_http_connection(*HOST)
+        second = conn.get_http_connection(*HOST)
+        conn.put_http_connection(*(HOST + (first,)))
+        conn.put_http_connection(*(HOST + (second,)))
+        eq(conn._pool.size(), 1)
+
+    def test_connect(self):
+        conf = dict(host='localhost', is_secure=False, access_key='a', secret_key='s')
+        conn = common.connect(conf, pool=dict(pool_size=4, keepalive=False))
+        assert isinstance(conn, common.PooledS3Connection)
+        eq((conn.pool_size, conn.keepalive, conn.max_requests), (4, False, None))
+        assert not isinstance(common.connect(conf), common.PooledS3Connection)
+
+
+class FakeHTTPConnection:
+    # old-style, like httplib's
+    def __init__(self):
+        self.sock = None
+        self.calls = []
+
+    def putrequest(self, method, url):
+        self.calls.append('putrequest')
+
+    def connect(self):
+        self.calls.append('connect')
+        self.sock = object()
+
+    def send(self, data):
+        if self.sock is None:
+            self.connect()
+
+    def getresponse(self):
+        self.calls.append('getresponse')
+        return 'response'
+
+
+class TestRequestTimer(object):
+    def request(self, connection):
+        connection.putrequest('GET', '/')
+        connection.send('')
+        return connection.getresponse()
+
+    def test_marks(self):
+        connection = common._time_http_connection(FakeHTTPConnection())
+        with common.RequestTimer() as timer:
+            eq(self.request(connection), 'response')
+        eq(connection.calls, ['putrequest', 'connect', 'getresponse'])
+        marks = timer.marks
+        eq(sorted(marks), ['connect_start', 'connected', 'first_byte', 'last_byte', 'request', 'sent'])
+        order = ['request', 'connect_start', 'connected', 'sent', 'first_byte', 'last_byte']
+        eq(sorted(order, key=lambda name: marks[name]), order)
+
+        # a reused connection, only the last request counts
+        with common.RequestTimer() as timer:
+            self.request(connection)
+            self.request(connection)
+        eq(sorted(timer.marks), ['first_byte', 'last_byte', 'request', 'sent'])
+
+    def test_inactive(self):
+        connection = common._time_http_connection(FakeHTTPConnection())
+        timer = common.RequestTimer()
+        self.request(connection)
+        eq(timer.marks, {})
+
+    def test_connect(self):
+        conf = dict(host='localhost', is_secure=False, access_key='a', secret_key='s')
+        conn = common.connect(conf)
+        assert isinstance(conn, common.TimedS3Connection)
+        connection = conn.new_http_connection('localhost', 80, False)
+        assert 'putrequest' in connection.__dict__
+
+
+class FakeBucket(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+
+class TestRunRequest(object):
+    def setup(self):
+        self.connection = common._time_http_connection(FakeHTTPConnection())
+        self.bucket = FakeBucket(pooled())
+
+    def request(self):
+        # opens a connection of the pool the first time
+        self.bucket.connection.opened = 1
+        self.connection.putrequest('GET', '/')
+        self.connection.send('')
+        return self.connection.getresponse()
+
+    def test_success(self):
+        result = {}
+        eq(common.run_request(self.bucket, result, self.request), 'response')
+        eq(sorted(result), ['duration', 'reused', 'start', 'timing'])
+        assert 'connected' in result['timing']
+        eq(result['reused'], False)
+
+        result = {}
+        common.run_request(self.bucket, result, self.request)
+        eq(result['reused'], True)
+        assert 'connected' not in result['timing']
+
+    def test_without_timing(self):
+        result = {}
+        common.run_request(self.bucket, result, self.request, timing=False)
+        eq(sorted(result), ['duration', 'reused', 'start'])
+
+    def test_untimed_connection(self):
+        result = {}
+        common.run_request(FakeBucket(None), result, lambda: 42)
+        eq(sorted(result), ['duration', 'start'])
+
+    def test_failure(self):
+        def fail():
+            time.sleep(0.01)
+            raise IOError('Not Found')
+        result = {}
+        eq(common.run_request(FakeBucket(None), result, fail), None)
+        eq(result['error']['msg'], 'Not Found')
+        assert 'IOError' in result['error']['traceback']
+        assert result['duration'] >= 0.01 * 1e9
+        assert 'timing' not in result
+
+
+class TestMonotonicClock(object):
+    def fallback(self, **kwargs):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            clock = common._monotonic_clock(**kwargs)
+        eq(len(caught), 1)
+        return clock
+
+    def test_linux(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            clock = common._monotonic_clock(platform='linux2')
+        first = clock()
+        assert clock() >= first
+
+    def test_other_platform(self):
+        assert self.fallback(platform='darwin') is time.time
+
+    def test_no_library(self):
+        assert self.fallback(platform='linux2', find_library=lambda name: None) is time.time
+
+    def test_bad_library(self):
+        clock = self.fallback(platform='linux2', find_library=lambda name: 'libnonexistent.so.0')
+        assert clock is time.time
@@ -0,0 +1,541 @@
+from s3tests import readwrite
+from s3tests import realistic
+from s3tests import results
+
+import StringIO
+import bunch
+import collections
+import gevent
+import gevent.queue
+import itertools
+import random
+import time
+import gevent.pywsgi
+
+from nose.tools import eq_ as eq
+from nose.tools import assert_raises
+
+
+def not_found(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'application/xml')])
+    return ['<?xml version="1.0" encoding="UTF-8"?>'
+            '<Error><Code>NoSuchKey</Code><Message>Not Found</Message></Error>']
+
+
+class TestRunProcesses(object):
+    def setUp(self):
+        self.server = gevent.pywsgi.WSGIServer(('127.0.0.1', 0), not_found, log=None)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_child_errors(self):
+        # every read of the children fails, and only they know
+        config = bunch.bunchify(dict(s3=dict(
+                host='127.0.0.1',
+                port=self.server.server_port,
+                is_secure=False,
+                access_key='access',
+                secret_key='secret',
+                )))
+        plans = [dict(
+                settings=dict(readers=2, writers=0),
+                duration=0.5,
+                writers=[],
+                readers=[(0, 1), (1, 2)],
+                schedule=None,
+                ops=None,
+                )]
+        sink = results.ResultSink(StringIO.StringIO(), format='jsonl')
+        (summaries, errors, first_error) = readwrite.run_processes(
+            processes=2,
+            config=config,
+            bucket_name='bucket',
+            access=realistic.UniformAccess(['foo']),
+            files=None,
+            plans=plans,
+            sink=sink,
+            )
+        sink.close()
+        assert errors > 0
+        eq(errors, summaries[0]['errors'])
+        eq(sink.errors, 0)
+        assert 'Not Found' in first_error['msg']
+
+
+def phase(index, ops_per_sec, p99, ops=100, errors=0):
+    return dict(
+        type='phase',
+        phase=index,
+        settings=dict(readers=index + 1),
+        elapsed=10 * readwrite.NANOSECOND,
+        ops=ops,
+        errors=errors,
+        bytes=ops * 1024,
+        ops_per_sec=ops_per_sec,
+        mb_per_sec=ops_per_sec / 1024.0,
+        latency=dict(mean=p99 / 2, p50=p99 / 2, p99=p99, max=p99 * 2),
+        )
+
+
+class TestFindKnee(object):
+    def test_first_phase(self):
+        # adding load to the first phase gained nothing
+        summaries = [phase(0, 100.0, 10), phase(1, 105.0, 12), phase(2, 106.0, 20)]
+        eq(readwrite.find_knee(summaries), 0)
+
+    def test_middle_phase(self):
+        summaries = [phase(0, 100.0, 10), phase(1, 200.0, 10), phase(2, 210.0, 30), phase(3, 212.0, 90)]
+        eq(readwrite.find_knee(summaries), 1)
+
+    def test_last_phase_by_latency(self):
+        # throughput still grows, but p99 more than doubles
+        summaries = [phase(0, 100.0, 10), phase(1, 200.0, 12), phase(2, 300.0, 30)]
+        eq(readwrite.find_knee(summaries), 1)
+
+    def test_last_phase(self):
+        summaries = [phase(0, 100.0, 10), phase(1, 200.0, 10), phase(2, 300.0, 10), phase(3, 301.0, 10)]
+        eq(readwrite.find_knee(summaries), 2)
+
+    def test_flat(self):
+        # every phase does as well as the one before: no load paid off
+        summaries = [phase(0, 100.0, 10), phase(1, 100.0, 10), phase(2, 100.0, 10)]
+        eq(readwrite.find_knee(summaries), 0)
+
+    def test_scaling(self):
+        summaries = [phase(0, 100.0, 10), phase(1, 200.0, 10), phase(2, 400.0, 11)]
+        eq(readwrite.find_knee(summaries), None)
+
+    def test_single_phase(self):
+        eq(readwrite.find_knee([phase(0, 100.0, 10)]), None)
+
+    def test_idle_phases_are_skipped(self):
+        summaries = [phase(0, 0.0, 0, ops=0), phase(1, 100.0, 10), phase(2, 200.0, 10)]
+        eq(readwrite.find_knee(summaries), None)
+
+
+class TestMergePhaseSummaries(object):
+    def test_merge(self):
+        settings = dict(readers=4)
+        merged = readwrite.merge_phase_summaries(
+            [phase(2, 100.0, 10, ops=100, errors=1), phase(2, 50.0, 30, ops=300, errors=2)],
+            settings,
+            )
+        eq(merged['phase'], 2)
+        eq(merged['settings'], settings)
+        eq(merged['ops'], 400)
+        eq(merged['errors'], 3)
+        eq(merged['bytes'], 400 * 1024)
+        eq(merged['ops_per_sec'], 150.0)
+        # weighted by operations
+        eq(merged['latency']['mean'], (5 * 100 + 15 * 300) / 400)
+        eq(merged['latency']['p99'], 30)
+        eq(merged['latency']['max'], 60)
+
+    def test_empty_phases(self):
+        merged = readwrite.merge_phase_summaries(
+            [phase(0, 0.0, 0, ops=0), phase(0, 0.0, 0, ops=0)],
+            dict(readers=0),
+            )
+        eq(merged['ops'], 0)
+        eq(merged['ops_per_sec'], 0.0)
+        eq(merged['latency'], dict(mean=0, p50=0, p99=0, max=0))
+
+    def test_some_empty_phases(self):
+        merged = readwrite.merge_phase_summaries(
+            [phase(0, 0.0, 0, ops=0), phase(0, 100.0, 10, ops=100)],
+            dict(readers=1),
+            )
+        eq(merged['ops'], 100)
+        eq(merged['latency']['mean'], 5)
+        eq(merged['latency']['p99'], 10)
+
+
+SEEDS = dict(writer=1, reader=2, scheduler=3)
+
+
+def readwrite_conf(**kwargs):
+    conf = dict(duration=10, readers=2, writers=1)
+    conf.update(kwargs)
+    return bunch.bunchify(conf)
+
+
+class TestMakePlans(object):
+    def test_single_phase(self):
+        (plan,) = readwrite.make_plans(readwrite_conf(), SEEDS)
+        eq(plan['duration'], 10)
+        eq(plan['settings'], dict(duration=10, readers=2, writers=1))
+        eq([worker for (worker, seed) in plan['readers']], [0, 1])
+        eq([worker for (worker, seed) in plan['writers']], [0])
+        eq(plan['schedule'], None)
+        eq(plan['ops'], None)
+
+    def test_phases(self):
+        conf = readwrite_conf(phases=[dict(readers=1), dict(readers=4, duration=5)])
+        plans = readwrite.make_plans(conf, SEEDS)
+        eq([plan['duration'] for plan in plans], [10, 5])
+        eq([len(plan['readers']) for plan in plans], [1, 4])
+        eq([len(plan['writers']) for plan in plans], [1, 1])
+        # the same worker keeps its seed from phase to phase
+        eq(plans[0]['readers'][0], plans[1]['readers'][0])
+
+    def test_seeds_are_repeatable(self):
+        conf = readwrite_conf(rate=50)
+        eq(readwrite.make_plans(conf, SEEDS), readwrite.make_plans(conf, SEEDS))
+
+    def test_deterministic_file_names(self):
+        (plan,) = readwrite.make_plans(readwrite_conf(deterministic_file_names=True), SEEDS)
+        eq(plan['writers'], [])
+
+    def test_schedule(self):
+        conf = readwrite_conf(phases=[dict(rate=10), dict(rate=20, arrivals='constant')])
+        plans = readwrite.make_plans(conf, SEEDS)
+        eq(plans[0]['schedule']['rate'], 10.0)
+        eq(plans[0]['schedule']['arrivals'], 'poisson')
+        eq(plans[1]['schedule']['rate'], 20.0)
+        eq(plans[1]['schedule']['arrivals'], 'constant')
+
+    def test_bad_schedule(self):
+        for conf in [
+            readwrite_conf(rate=0),
+            readwrite_conf(rate=10, arrivals='bursty'),
+            readwrite_conf(rate=10, readers=0, writers=0),
+            ]:
+            assert_raises(RuntimeError, readwrite.make_plans, conf, SEEDS)
+
+    def test_ops(self):
+        conf = readwrite_conf(ops=dict(read=3, write=1), range=dict(min_size=1, max_size=10))
+        (plan,) = readwrite.make_plans(conf, SEEDS)
+        eq(plan['ops']['weights'], [('read', 3), ('write', 1)])
+        eq(plan['ops']['settings'], dict(list=None, range=dict(min_size=1, max_size=10), multipart=None))
+
+    def test_bad_ops(self):
+        for ops in [dict(read=1, rename=1), dict(read=-1, write=2), dict(read=0)]:
+            assert_raises(RuntimeError, readwrite.make_plans, readwrite_conf(ops=ops), SEEDS)
+
+    def test_binary_phase_summary(self):
+        # the settings keep the config's Bunch values of ops and rate
+        conf = readwrite_conf(
+            ops=dict(read=3, write=1),
+            rate=10,
+            phases=[dict(readers=1), dict(readers=2, ops=dict(read=1))],
+            )
+        plans = readwrite.make_plans(conf, SEEDS)
+        f = StringIO.StringIO()
+        sink = results.ResultSink(f, format='binary')
+        for (index, plan) in enumerate(plans):
+            stats = readwrite.PhaseStats(index, plan['settings'], sink)
+            stats.put(dict(type='r', key='foo', start=1.0, duration=1000, size=10))
+            sink.put(stats.summary(elapsed=1.0))
+        sink.close()
+        got = list(results.load_all(StringIO.StringIO(f.getvalue())))
+        eq([summary['settings'] for summary in got if summary['type'] == 'phase'],
+           [plan['settings'] for plan in plans])
+
+
+class FakeFile(object):
+    def __init__(self, size):
+        self.size = size
+
+
+def fake_files(*sizes):
+    return itertools.cycle([FakeFile(size) for size in sizes])
+
+
+def op_mix(weights, object_sizes=None):
+    if object_sizes is None:
+        object_sizes = {}
+    return readwrite.OpMix(
+        weights,
+        realistic.UniformAccess(['foo', 'bar']),
+        fake_files(100),
+        object_sizes,
+        )
+
+
+class TestOpMix(object):
+    def test_frequencies(self):
+        mix = op_mix([('read', 3), ('write', 1)])
+        rand = random.Random(1)
+        counts = collections.Counter(mix.choose(rand)[0] for _ in xrange(10000))
+        eq(sorted(counts), ['read', 'write'])
+        assert 7200 < counts['read'] < 7800, counts
+
+    def test_zero_weight_is_never_chosen(self):
+        mix = op_mix([('head', 0), ('read', 1), ('write', 0), ('list', 2)])
+        rand = random.Random(2)
+        names = set(mix.choose(rand)[0] for _ in xrange(5000))
+        eq(names, set(['read', 'list']))
+
+    def test_bad_weights(self):
+        for weights in [[], [('read', 0), ('write', 0)], [('read', -1), ('write', 2)]]:
+            assert_raises(ValueError, op_mix, weights)
+
+    def test_arguments(self):
+        mix = op_mix([('write', 1)])
+        (name, kwargs, rank) = mix.choose(random.Random(3))
+        eq(name, 'write')
+        eq(kwargs['fp'].size, 100)
+        assert kwargs['objname'] in ('foo', 'bar')
+        eq(rank, None)
+
+    def test_record(self):
+        object_sizes = {}
+        mix = op_mix([('read', 1), ('write', 1)], object_sizes)
+        read = dict(type='r', key='foo', size=10)
+        mix.record(read, 'read')
+        eq(read['operation'], 'read')
+        eq(object_sizes, {})
+        write = dict(type='w', key='foo', size=100)
+        mix.record(write, 'write')
+        eq(write['operation'], 'write')
+        eq(object_sizes, dict(foo=100))
+        failed = dict(type='w', key='bar', size=100, error=dict(msg='oops'))
+        mix.record(failed, 'write')
+        eq(object_sizes, dict(foo=100))
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name, size=None):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+
+    def set_contents_from_file(self, fp):
+        if self.name in self.bucket.broken:
+            raise IOError('cannot write {name}'.format(name=self.name))
+        self.bucket.written[self.name] = fp.size
+        self.bucket.objects[self.name] = fp.size
+
+    def set_contents_from_string(self, data):
+        self.bucket.strings[self.name] = data
+        self.bucket.objects[self.name] = len(data)
+
+    def get_contents_as_string(self):
+        return self.bucket.strings[self.name]
+
+
+class FakeDeleted(object):
+    errors = []
+
+
+class FakeBucket(object):
+    name = 'bucket'
+    connection = None
+
+    def __init__(self, objects=None, broken=()):
+        self.objects = dict(objects or {})
+        self.broken = broken
+        self.written = {}
+        self.strings = {}
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def get_key(self, name):
+        if name not in self.objects:
+            return None
+        return FakeKey(self, name, self.objects[name])
+
+    def list(self):
+        return [FakeKey(self, name, size) for (name, size) in sorted(self.objects.iteritems())]
+
+    def delete_keys(self, names):
+        for name in names:
+            del self.objects[name]
+        return FakeDeleted()
+
+
+class TestWarmup(object):
+    def test_uploads_all(self):
+        bucket = FakeBucket()
+        (object_sizes, uploaded, failed) = readwrite.warmup(
+            bucket=bucket,
+            file_names=['a', 'b', 'c'],
+            files=fake_files(10, 20),
+            workers=2,
+            inventory={},
+            )
+        eq(object_sizes, dict(a=10, b=20, c=10))
+        eq(bucket.written, object_sizes)
+        eq((uploaded, failed), (3, 0))
+
+    def test_skips_inventory(self):
+        # only names already there at the right size are skipped, and
+        # skipping one does not shift the files of the others
+        bucket = FakeBucket()
+        (object_sizes, uploaded, failed) = readwrite.warmup(
+            bucket=bucket,
+            file_names=['a', 'b', 'c'],
+            files=fake_files(10, 20, 30),
+            workers=2,
+            inventory=dict(a=10, b=25),
+            )
+        eq(object_sizes, dict(a=10, b=20, c=30))
+        eq(bucket.written, dict(b=20, c=30))
+        eq((uploaded, failed), (2, 0))
+
+    def test_counts_failures(self):
+        bucket = FakeBucket(broken=['b'])
+        (object_sizes, uploaded, failed) = readwrite.warmup(
+            bucket=bucket,
+            file_names=['a', 'b', 'c'],
+            files=fake_files(10),
+            workers=3,
+            inventory={},
+            )
+        eq(bucket.written, dict(a=10, c=10))
+        eq((uploaded, failed), (3, 1))
+
+
+DESCRIPTION = dict(seeds=dict(names=1, contents=2), sizes='constant(size=10)')
+
+
+class TestDatasetInventory(object):
+    def test_matching_manifest(self):
+        bucket = FakeBucket(dict(a=10, b=5, other=7))
+        inventory = readwrite.dataset_inventory(bucket, ['a', 'b', 'c'], DESCRIPTION, DESCRIPTION)
+        eq(inventory, dict(a=10, b=5))
+        eq(bucket.objects, dict(a=10, b=5, other=7))
+
+    def test_other_manifest(self):
+        # files of other settings may have the right size, so they go
+        bucket = FakeBucket(dict(a=10, b=10, other=7))
+        manifest = dict(DESCRIPTION, sizes='constant(size=20)')
+        inventory = readwrite.dataset_inventory(bucket, ['a', 'b', 'c'], manifest, DESCRIPTION)
+        eq(inventory, {})
+        eq(sorted(bucket.objects), sorted([readwrite.MANIFEST, 'other']))
+        eq(readwrite.read_manifest(bucket), DESCRIPTION)
+
+    def test_no_manifest(self):
+        bucket = FakeBucket(dict(a=10))
+        inventory = readwrite.dataset_inventory(bucket, ['a', 'b'], None, DESCRIPTION)
+        eq(inventory, {})
+        eq(sorted(bucket.objects), [readwrite.MANIFEST])
+
+    def test_resume(self):
+        # a first warmup fails part way, and the next run finishes it
+        bucket = FakeBucket(broken=['b'])
+        names = ['a', 'b', 'c']
+        inventory = readwrite.dataset_inventory(bucket, names, None, DESCRIPTION)
+        (_, uploaded, failed) = readwrite.warmup(bucket, names, fake_files(10), 3, inventory)
+        eq((uploaded, failed), (3, 1))
+
+        bucket.broken = ()
+        bucket.written = {}
+        manifest = readwrite.read_manifest(bucket)
+        inventory = readwrite.dataset_inventory(bucket, names, manifest, DESCRIPTION)
+        eq(inventory, dict(a=10, c=10))
+        (_, uploaded, failed) = readwrite.warmup(bucket, names, fake_files(10), 3, inventory)
+        eq((uploaded, failed), (1, 0))
+        eq(bucket.written, dict(b=10))
+
+
+class SlowBucket(FakeBucket):
+    def __init__(self, delay, objects=None):
+        super(SlowBucket, self).__init__(objects)
+        self.delay = delay
+
+    def get_key(self, name):
+        time.sleep(self.delay)
+        return super(SlowBucket, self).get_key(name)
+
+
+class HeadMix(object):
+    # HEADs foo every time, without drawing random numbers
+    def __init__(self):
+        self.recorded = []
+
+    def choose(self, rand):
+        return ('head', dict(objname='foo'), None)
+
+    def record(self, result, name):
+        self.recorded.append(name)
+
+
+class ListQueue(list):
+    put = list.append
+
+
+class TestScheduler(object):
+    def run_scheduled(self, bucket):
+        idle = gevent.queue.Queue()
+        queue = ListQueue()
+        mix = HeadMix()
+        intended = time.time() - 0.05
+        readwrite.run_scheduled(
+            'head',
+            intended=intended,
+            worker_id=3,
+            idle=idle,
+            queue=queue,
+            mix=mix,
+            rank=7,
+            bucket=bucket,
+            objname='foo',
+            )
+        eq(idle.get_nowait(), 3)
+        eq(mix.recorded, ['head'])
+        (result,) = queue
+        eq(result['rank'], 7)
+        return (intended, result)
+
+    def test_latency_from_intended_start(self):
+        (intended, result) = self.run_scheduled(FakeBucket(dict(foo=1)))
+        # waiting for a worker counts as latency
+        eq(result['start'], intended)
+        assert result['lag'] >= 0.05 * readwrite.NANOSECOND
+        assert result['duration'] >= result['lag']
+
+    def test_failure(self):
+        # failed operations are timed from their intended start too
+        (intended, result) = self.run_scheduled(FakeBucket())
+        assert 'error' in result
+        eq(result['start'], intended)
+        assert result['lag'] >= 0.05 * readwrite.NANOSECOND
+
+    def schedule(self, buckets, rate, arrivals, duration, seed=5):
+        queue = ListQueue()
+        greenlet = gevent.spawn(
+            readwrite.scheduler,
+            buckets=buckets,
+            mix=HeadMix(),
+            queue=queue,
+            rand=random.Random(seed),
+            rate=rate,
+            arrivals=arrivals,
+            )
+        gevent.sleep(duration)
+        greenlet.kill(block=True)
+        ops = [result for result in queue if result['type'] == 'head']
+        (schedule,) = [result for result in queue if result['type'] == 'schedule']
+        return (ops, schedule)
+
+    def test_constant(self):
+        (ops, schedule) = self.schedule([FakeBucket(dict(foo=1))], 100, 'constant', 0.2)
+        assert len(ops) >= 10
+        # the last one may still be running when the scheduler stops
+        assert len(ops) <= schedule['scheduled'] <= len(ops) + 1
+        eq((schedule['rate'], schedule['arrivals']), (100, 'constant'))
+        starts = [result['start'] for result in ops]
+        for (a, b) in zip(starts, starts[1:]):
+            assert abs(b - a - 0.01) < 1e-6, (a, b)
+
+    def test_poisson(self):
+        (ops, schedule) = self.schedule([FakeBucket(dict(foo=1))], 100, 'poisson', 0.2, seed=7)
+        assert len(ops) >= 5
+        rand = random.Random(7)
+        gaps = [rand.expovariate(100) for result in ops]
+        starts = [result['start'] for result in ops]
+        for (gap, a, b) in zip(gaps[1:], starts, starts[1:]):
+            assert abs(b - a - gap) < 1e-6, (gap, a, b)
+
+    def test_out_of_workers(self):
+        # one worker taking 50ms cannot keep up with one start per 10ms
+        (ops, schedule) = self.schedule([SlowBucket(0.05, dict(foo=1))], 100, 'constant', 0.3)
+        assert 3 <= schedule['scheduled'] <= 8, schedule
+        assert schedule['late'] >= schedule['scheduled'] - 1
+        assert schedule['max_behind'] >= 0.08 * readwrite.NANOSECOND
+        assert schedule['total_behind'] >= schedule['max_behind']
+        assert ops[-1]['lag'] >= 0.08 * readwrite.NANOSECOND
@@ -1,6 +1,12 @@
 from s3tests import realistic
+import StringIO
+import collections
+import itertools
+import os
+import random
 import shutil
 import tempfile
+import zlib
 
 
 # XXX not used for now
@@ -46,6 +52,296 @@ class TestFiles(object):
 
         assert verifier.valid()
 
+    def test_random_file_seek_matches_sequential_read(self):
+        size = 300001
+        seed = 3391518755
+        whole = realistic.RandomContentFile(size=size, seed=seed).read()
+        assert len(whole) == size
+
+        source = realistic.RandomContentFile(size=size, seed=seed)
+        for offset, count in [(200000, 70000), (5, 10), (size - 20, 20), (131071, 2)]:
+            source.seek(offset)
+            assert source.read(count) == whole[offset:offset + count]
+            assert source.tell() == offset + count
+
+    def test_random_file_digest_after_seek(self):
+        size = 150000
+        seed = 1256193726
+        source = realistic.RandomContentFile(size=size, seed=seed)
+        source.seek(size - 10)
+        tail = source.read()
+        source.seek(0)
+        data = source.read()
+        assert data.endswith(tail)
+
+        verifier = realistic.FileVerifier()
+        verifier.write(data)
+        assert verifier.valid()
+
+    def test_random_file_readinto_matches_read(self):
+        size = 200017
+        seed = 3391518755
+        whole = realistic.RandomContentFile(size=size, seed=seed).read()
+
+        source = realistic.RandomContentFile(size=size, seed=seed)
+        buf = bytearray(8192)
+        parts = []
+        while True:
+            n = source.readinto(buf)
+            if not n:
+                break
+            parts.append(str(buf[:n]))
+        assert ''.join(parts) == whole
+
+    def test_random_file_copy_parts(self):
+        size = 300001
+        seed = 3391518755
+        source = realistic.RandomContentFile(size=size, seed=seed)
+        whole = realistic.RandomContentFile(size=size, seed=seed).read()
+        # the parts read back in any order make up the whole file
+        parts = {}
+        for offset in [200000, 0, 100000]:
+            parts[offset] = source.copy(offset).read(100000)
+        parts[300000] = source.copy(300000).read()
+        data = ''.join(parts[offset] for offset in sorted(parts))
+        assert data == whole
+        assert source.tell() == 0
+
+    def test_random_file_copies_share_digest(self):
+        source = realistic.RandomContentFile(size=300001, seed=42)
+        source.compute_digest()
+        last = source.copy(300000 - 10)
+        # the copy has no hash to work the digest out with
+        assert last.hash is None
+        verifier = realistic.FileVerifier()
+        verifier.write(source.copy().read(300000 - 10))
+        shutil.copyfileobj(last, verifier)
+        assert verifier.valid()
+
+    def test_random_file_smaller_than_digest(self):
+        source = realistic.RandomContentFile(size=7, seed=42)
+        verifier = realistic.FileVerifier()
+        shutil.copyfileobj(source, verifier)
+        assert verifier.size == 7
+        assert verifier.valid()
+
+
+class TestContentRatios(object):
+
+    def test_compression_ratio(self):
+        block_size = realistic.CONTENT_BLOCK_SIZE
+        data = realistic.RandomContentFile(size=16 * block_size, seed=42, compression=4).read()
+        ratio = len(data) / float(len(zlib.compress(data)))
+        assert 3 < ratio < 5
+
+    def test_incompressible_by_default(self):
+        data = realistic.RandomContentFile(size=300000, seed=42).read()
+        assert len(zlib.compress(data)) > len(data)
+
+    def test_dedupe_ratio(self):
+        block_size = realistic.CONTENT_BLOCK_SIZE
+        source = realistic.RandomContentFile(size=200 * block_size, seed=42, dedupe=0.5)
+        data = source.read()
+        blocks = [data[i:i + block_size] for i in xrange(0, 199 * block_size, block_size)]
+        duplicates = len(blocks) - len(set(blocks))
+        assert 60 < duplicates < 100
+
+        verifier = realistic.FileVerifier()
+        verifier.write(data)
+        assert verifier.valid()
+
+    def test_generated_contents_with_ratios_are_valid(self):
+        contents = realistic.generate_file_contents(300000, compression=2, dedupe=0.3)
+        assert len(contents) == 300040
+        assert realistic.FileValidator(StringIO.StringIO(contents)).valid()
+        assert len(zlib.compress(contents)) < 200000
+
+    def test_bad_ratios(self):
+        for kwargs in [dict(compression=0.5), dict(dedupe=1.5)]:
+            try:
+                realistic.RandomContentFile(size=10, seed=1, **kwargs)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('no ValueError for {kwargs}'.format(kwargs=kwargs))
+
+
+class TestSizes(object):
+
+    def test_normal_matches_previous_draws(self):
+        rand = random.Random(5)
+        expected = []
+        while len(expected) < 100:
+            size = int(rand.normalvariate(1000, 2000))
+            if size >= 0:
+                expected.append(size)
+        sizes = realistic.NormalSizes(1000, 2000).sample(random.Random(5), 100)
+        assert sizes == expected
+
+    def test_lognormal_mean(self):
+        sizes = realistic.LognormalSizes(10000, 30000).sample(random.Random(5), 200000)
+        mean = sum(sizes) / float(len(sizes))
+        assert 8000 < mean < 12000
+        assert max(sizes) > 20 * 10000
+
+    def test_pareto_bounds(self):
+        sizes = realistic.ParetoSizes(4096, 1.2, maximum=10 * 1024 * 1024).sample(random.Random(5), 10000)
+        assert min(sizes) >= 4096
+        assert max(sizes) == 10 * 1024 * 1024
+
+    def test_choice_weights(self):
+        sizes = realistic.ChoiceSizes([[4096, 9], [4194304, 1]]).sample(random.Random(5), 10000)
+        counts = collections.Counter(sizes)
+        assert sorted(counts) == [4096, 4194304]
+        assert 800 < counts[4194304] < 1200
+
+    def test_histogram_from_file(self):
+        t = tempfile.NamedTemporaryFile()
+        t.write('# low high count\n0 100 1\n\n1000 2000 3\n')
+        t.flush()
+        sizes = realistic.HistogramSizes.from_file(t.name).sample(random.Random(5), 10000)
+        small = [size for size in sizes if size < 100]
+        large = [size for size in sizes if 1000 <= size < 2000]
+        assert len(small) + len(large) == 10000
+        assert 2000 < len(small) < 3000
+
+    def test_sizes_from_config(self):
+        sizes = realistic.sizes_from_config(dict(num=1, size=4, stddev=1))
+        assert sizes.describe() == dict(distribution='normal', mean=4096, stddev=1024)
+        sizes = realistic.sizes_from_config(dict(distribution='choice', choices=[[1, 1]]))
+        assert sizes.sample(random.Random(5), 3) == [1024] * 3
+        try:
+            realistic.sizes_from_config(dict(distribution='uniform'))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('unknown distribution accepted')
+
+    def test_files_use_sizes(self):
+        sizes = realistic.ChoiceSizes([[10, 1], [20, 1]])
+        fs = itertools.islice(realistic.files(None, None, seed=5, sizes=sizes), 50)
+        assert set(fp.size for fp in fs) == set([10, 20])
+
+
+class TestNames(object):
+
+    def test_names_are_deterministic(self):
+        a = list(itertools.islice(realistic.names(15, 4, seed=7), 3000))
+        b = list(itertools.islice(realistic.names(15, 4, seed=7), 3000))
+        assert a == b
+        assert all(name and name.islower() and name.isalpha() for name in a)
+
+    def test_random_chars_uses_whole_charset(self):
+        chars = realistic.random_chars(random.Random(1), 100000, 'abc')
+        assert len(chars) == 100000
+        counts = collections.Counter(chars)
+        assert sorted(counts) == ['a', 'b', 'c']
+        assert min(counts.values()) > 30000
+
+    def test_tree_names_shape(self):
+        keys = list(itertools.islice(
+            realistic.tree_names(fanout=[3, 5], delimiter='|', prefix='p/', seed=7),
+            2000,
+            ))
+        assert all(key.startswith('p/') for key in keys)
+        parts = [key[2:].split('|') for key in keys]
+        assert all(len(p) == 3 for p in parts)
+        assert len(set(p[0] for p in parts)) == 3
+        assert len(set(tuple(p[:2]) for p in parts)) == 15
+
+    def test_tree_names_skew(self):
+        keys = itertools.islice(realistic.tree_names(fanout=[100], skew=1.5, seed=7), 10000)
+        counts = collections.Counter(key.split('/')[0] for key in keys)
+        top = counts.most_common(1)[0][1]
+        assert top > 2000
+
+
+class TestAccess(object):
+    names = ['name{i}'.format(i=i) for i in xrange(100)]
+
+    def test_uniform_matches_choice(self):
+        access = realistic.UniformAccess(self.names)
+        got = [access.choose(random.Random(5))[0] for _ in xrange(10)]
+        assert got == [random.Random(5).choice(self.names) for _ in xrange(10)]
+        assert access.choose(random.Random(5))[1] is None
+
+    def test_alias_table(self):
+        table = realistic.AliasTable([1, 2, 7])
+        rand = random.Random(5)
+        counts = collections.Counter(table.sample(rand) for _ in xrange(100000))
+        assert 9000 < counts[0] < 11000
+        assert 19000 < counts[1] < 21000
+        assert 69000 < counts[2] < 71000
+
+    def test_zipf(self):
+        access = realistic.ZipfAccess(self.names, s=1.0)
+        rand = random.Random(5)
+        ranks = collections.Counter(access.choose(rand)[1] for _ in xrange(100000))
+        # rank 0 is picked twice as often as rank 1, ten times rank 9
+        assert 1.8 < ranks[0] / float(ranks[1]) < 2.2
+        assert 8 < ranks[0] / float(ranks[9]) < 12
+        (name, rank) = access.choose(rand)
+        assert name == self.names[rank]
+        assert access.describe()['hot_ranks'] == 10
+
+    def test_hotspot(self):
+        access = realistic.HotspotAccess(self.names, hot_ops=0.8, hot_keys=0.2)
+        rand = random.Random(5)
+        ranks = [access.choose(rand)[1] for _ in xrange(10000)]
+        hot = len([rank for rank in ranks if rank < 20])
+        assert 7700 < hot < 8300
+        assert max(ranks) == 99
+
+    def test_moving_hotspot(self):
+        now = [0.0]
+        access = realistic.MovingHotspotAccess(
+            self.names, hot_ops=1.0, hot_keys=0.1, period=10, clock=lambda: now[0])
+        rand = random.Random(5)
+        before = set(access.choose(rand)[0] for _ in xrange(1000))
+        assert before == set(self.names[:10])
+        now[0] = 25.0
+        after = set(access.choose(rand)[0] for _ in xrange(1000))
+        assert after == set(self.names[20:30])
+
+    def test_access_from_config(self):
+        assert isinstance(realistic.access_from_config(None, self.names), realistic.UniformAccess)
+        access = realistic.access_from_config(dict(distribution='hotspot', hot_keys=0.5), self.names)
+        assert access.describe()['hot_ranks'] == 50
+        for conf in [dict(distribution='pareto'), dict(distribution='hotspot', hot_ops=2)]:
+            try:
+                realistic.access_from_config(conf, self.names)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('bad access config accepted: {conf}'.format(conf=conf))
+
+
+class TestFileVerifier(object):
+
+    def test_small_writes_are_valid(self):
+        source = realistic.RandomContentFile(size=5000, seed=42)
+        data = source.read()
+        verifier = realistic.FileVerifier()
+        for i in xrange(0, len(data), 7):
+            verifier.write(data[i:i + 7])
+        assert verifier.size == 5000
+        assert verifier.valid()
+
+    def test_corrupt_data_is_invalid(self):
+        data = realistic.RandomContentFile(size=5000, seed=42).read()
+        verifier = realistic.FileVerifier()
+        verifier.write(data[:100] + chr(ord(data[100]) ^ 1) + data[101:])
+        assert not verifier.valid()
+
+    def test_chunks_are_bounded(self):
+        verifier = realistic.FileVerifier()
+        for _ in xrange(10000):
+            verifier.write('x' * 10)
+        assert len(verifier.chunks) <= realistic.MAX_CHUNKS + 1
+        assert verifier.chunks[-1][0] == 100000
+        sizes = [size for (size, _) in verifier.chunks]
+        assert sizes == sorted(sizes)
+
 
 # new implementation
 class TestFileValidator(object):
@@ -77,3 +373,118 @@ class TestFileValidator(object):
         fp = realistic.FileValidator(t)
         assert fp.valid()
         assert fp.valid()
+
+    def test_new_file_is_valid_when_streamed(self):
+        contents = realistic.generate_file_contents(100000)
+        fp = realistic.FileValidator()
+        for i in xrange(0, len(contents), 33):
+            fp.write(contents[i:i + 33])
+        assert fp.tell() == len(contents)
+        assert fp.valid()
+
+    def test_corrupt_file_is_invalid(self):
+        contents = realistic.generate_file_contents(1000)
+        fp = realistic.FileValidator()
+        fp.write(contents[:10] + chr(ord(contents[10]) ^ 1) + contents[11:])
+        assert not fp.valid()
+
+
+class TestContentPool(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pool_files_are_valid(self):
+        pool = realistic.ContentPool(mean=20000, stddev=5000, seed=42, numfiles=4)
+        assert len(pool) == 4
+        for i in xrange(len(pool)):
+            fp = realistic.FileValidator(pool.open(i))
+            assert fp.valid()
+            assert fp.original_hash == pool.index[i][2]
+
+    def test_pool_file_positions_are_independent(self):
+        pool = realistic.ContentPool(mean=20000, stddev=0, seed=42, numfiles=1)
+        a = pool.open(0)
+        b = pool.open(0)
+        head = a.read(100)
+        assert b.read(100) == head
+        a.seek(0, os.SEEK_END)
+        assert a.tell() == 20040
+        assert a.read() == ''
+
+    def test_existing_pool_is_reused(self):
+        path = os.path.join(self.tmpdir, 'pool')
+        first = realistic.ContentPool(mean=20000, stddev=5000, seed=42, numfiles=3, path=path)
+        second = realistic.ContentPool(mean=20000, stddev=5000, seed=42, numfiles=3, path=path)
+        assert second.index == first.index
+        assert second.open(1).read() == first.open(1).read()
+
+        other = realistic.ContentPool(mean=20000, stddev=5000, seed=43, numfiles=3, path=path)
+        assert other.index != first.index
+
+    def test_pools_generated_at_once_do_not_collide(self):
+        path = os.path.join(self.tmpdir, 'pool')
+        # another process's temporary files in the way change nothing
+        open(path + '.tmp', 'w').close()
+        pids = []
+        for i in xrange(3):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    realistic.ContentPool(mean=20000, stddev=5000, seed=42, numfiles=3, path=path)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        pool = realistic.ContentPool(mean=20000, stddev=5000, seed=42, numfiles=3, path=path)
+        for i in xrange(len(pool)):
+            assert realistic.FileValidator(pool.open(i)).valid()
+        assert sorted(os.listdir(self.tmpdir)) == ['pool', 'pool.index', 'pool.tmp']
+
+
+class SerialPool(object):
+    # runs everything right away, like a pool with nothing else to do
+    class Done(object):
+        def get(self):
+            pass
+
+    def __init__(self):
+        self.blocks = []
+
+    def spawn(self, func, data):
+        self.blocks.append(len(data))
+        func(data)
+        return self.Done()
+
+
+class TestFileValidatorPool(object):
+    def test_valid(self):
+        contents = realistic.generate_file_contents(300000)
+        pool = SerialPool()
+        fp = realistic.FileValidator(pool=pool, block_size=65536)
+        for i in xrange(0, len(contents), 8192):
+            fp.write(contents[i:i + 8192])
+        assert fp.valid()
+        assert fp.valid()
+        assert sum(pool.blocks) == 300000
+        assert len(pool.blocks) > 1
+
+    def test_thread_pool(self):
+        import gevent.threadpool
+        contents = realistic.generate_file_contents(1000000)
+        fp = realistic.FileValidator(pool=gevent.threadpool.ThreadPool(2), block_size=65536)
+        fp.write(contents)
+        assert fp.valid()
+        fp = realistic.FileValidator(pool=gevent.threadpool.ThreadPool(2), block_size=65536)
+        fp.write(contents[:10] + chr(ord(contents[10]) ^ 1) + contents[11:])
+        assert not fp.valid()
+
+    def test_sizer(self):
+        fp = realistic.FileSizer()
+        fp.write('abc')
+        fp.write('de')
+        assert fp.size == fp.tell() == 5
@@ -0,0 +1,255 @@
+from s3tests import results
+
+import StringIO
+import struct
+
+from nose.tools import eq_ as eq
+from nose.tools import assert_raises
+
+RESULTS = [
+    dict(type='config', seeds=dict(names=1, contents=2), sizes='normal(mean=1024, stddev=0)'),
+    dict(type='w', key='foo', start=1.5, duration=1234567, size=1024, chunks=[[0, 0], [1024, 1000]]),
+    dict(type='r', key='bar', start=2.5, duration=7654321, size=4096,
+         error=dict(msg='Not Found', traceback='Traceback...\n')),
+    ]
+
+
+def write_results(format, items=RESULTS):
+    f = StringIO.StringIO()
+    sink = results.ResultSink(f, format=format)
+    for item in items:
+        sink.put(item)
+    sink.close()
+    return sink, f.getvalue()
+
+
+class TestFormats(object):
+    def test_round_trip(self):
+        for format in results.FORMATS:
+            sink, data = write_results(format)
+            eq(sink.count, 3)
+            eq(sink.errors, 1)
+            got = list(results.load_all(StringIO.StringIO(data)))
+            eq(got, RESULTS)
+
+    def test_binary_header(self):
+        _, data = write_results('binary')
+        assert data.startswith(results.BinaryFormat.MAGIC)
+
+    def test_binary_unknown_version(self):
+        _, data = write_results('binary')
+        magic = results.BinaryFormat.MAGIC
+        data = magic + struct.pack('<H', 99) + data[len(magic) + 2:]
+        assert_raises(ValueError, list, results.load_all(StringIO.StringIO(data)))
+
+    def test_binary_other_python(self):
+        # marshal may change between Python versions
+        _, data = write_results('binary')
+        start = len(results.BinaryFormat.MAGIC) + 2
+        data = data[:start] + struct.pack('<BB', 3, 99) + data[start + 2:]
+        assert_raises(ValueError, list, results.load_all(StringIO.StringIO(data)))
+
+    def test_truncated(self):
+        # a killed run leaves a partial last record behind
+        for format in ['jsonl', 'binary']:
+            _, data = write_results(format)
+            got = list(results.load_all(StringIO.StringIO(data[:-3])))
+            eq(got, RESULTS[:2])
+
+    def test_relay(self):
+        for format in results.FORMATS:
+            _, data = write_results(format)
+            f = StringIO.StringIO()
+            sink = results.ResultSink(f, format=format)
+            sink.put(RESULTS[0])
+            results.relay_records(StringIO.StringIO(data), sink)
+            sink.close()
+            eq(sink.count, 4)
+            got = list(results.load_all(StringIO.StringIO(f.getvalue())))
+            eq(got, RESULTS[:1] + RESULTS)
+
+
+class TestHistogram(object):
+    def test_small_values_exact(self):
+        h = results.Histogram()
+        for value in xrange(256):
+            h.record(value)
+        eq(h.count, 256)
+        eq(h.min, 0)
+        eq(h.max, 255)
+        eq(h.percentile(50), 127)
+        eq(h.percentile(100), 255)
+
+    def test_relative_error(self):
+        h = results.Histogram()
+        for value in [300, 12345, 987654321, 2**50 + 12345]:
+            h.record(value)
+            bucket = h._index(value)
+            highest = h._highest(bucket)
+            assert highest >= value
+            assert highest - value <= value * 2**(1 - h.precision)
+            # the bucket before ends below the value
+            assert h._highest(bucket - 1) < value
+
+    def test_percentile(self):
+        h = results.Histogram()
+        for value in xrange(1, 10001):
+            h.record(value * 1000)
+        eq(h.total, sum(xrange(1, 10001)) * 1000)
+        for percent in [50, 90, 99, 99.9]:
+            expected = percent * 100 * 1000
+            got = h.percentile(percent)
+            assert abs(got - expected) <= expected * 2**(1 - h.precision), (percent, got)
+
+    def test_empty(self):
+        h = results.Histogram()
+        eq(h.percentile(50), None)
+        eq(h.mean(), None)
+
+    def test_merge(self):
+        a = results.Histogram()
+        b = results.Histogram()
+        both = results.Histogram()
+        for value in [1, 5000, 70000]:
+            a.record(value)
+            both.record(value)
+        for value in [3, 5000, 9000000]:
+            b.record(value)
+            both.record(value)
+        a.merge(b)
+        eq(a.to_dict(), both.to_dict())
+
+    def test_dict(self):
+        h = results.Histogram()
+        for value in [1, 5000, 70000, 70001]:
+            h.record(value)
+        eq(results.Histogram.from_dict(h.to_dict()).to_dict(), h.to_dict())
+
+
+class ListSink(list):
+    put = list.append
+
+
+class TestAggregator(object):
+    def test_aggregate(self):
+        sink = ListSink()
+        aggregator = results.Aggregator(sink, interval=3600)
+        aggregator.put(RESULTS[0])
+        aggregator.put(RESULTS[1])
+        aggregator.put(RESULTS[2])
+        aggregator.put(dict(type='w', start=3.0, duration=1000, size=100))
+        eq(sink, [RESULTS[0]])
+        aggregator.flush()
+        eq(len(sink), 3)
+        eq(aggregator.errors, 1)
+        eq(aggregator.first_error['msg'], 'Not Found')
+
+        r, w = sink[1:]
+        eq(r['op'], 'r')
+        eq(r['errors'], 1)
+        eq(r['latency']['count'], 0)
+        eq(w['op'], 'w')
+        eq(w['errors'], 0)
+        eq(w['start'], 1.5)
+        eq(w['end'], 3.0 + 1000 / 1e9)
+        latency = results.Histogram.from_dict(w['latency'])
+        eq((latency.count, latency.min, latency.max), (2, 1000, 1234567))
+        eq(w['bytes']['total'], 1124)
+
+        aggregator.flush()
+        eq(len(sink), 3)
+
+    def test_labels(self):
+        sink = ListSink()
+        aggregator = results.Aggregator(sink, interval=3600)
+        for length in [100, 1000, 5000, 2000]:
+            aggregator.put(dict(type='range', start=1.0, duration=1000, size=length, length=length))
+        for part_size in [5 << 20, 8 << 20]:
+            aggregator.put(dict(type='multipart', start=1.0, duration=1000, size=1, part_size=part_size))
+        aggregator.flush()
+        eq([(r['op'], r['latency']['count']) for r in sink], [
+                ('multipart 5120 KB parts', 1),
+                ('multipart 8192 KB parts', 1),
+                ('range up to 1 KB', 2),
+                ('range up to 2 KB', 1),
+                ('range up to 8 KB', 1),
+                ])
+
+    def test_breakdowns(self):
+        sink = ListSink()
+        aggregator = results.Aggregator(sink, interval=3600, hot_ranks=2)
+        for (rank, reused, duration) in [(0, False, 1000), (1, True, 2000), (5, True, 3000)]:
+            aggregator.put(dict(type='r', start=1.0, duration=duration, size=10, rank=rank, reused=reused))
+        aggregator.put(dict(type='w', start=1.0, duration=5000, size=30, parts=[
+                    dict(num=1, size=20, start=1.0, duration=3000),
+                    dict(num=2, size=10, start=1.0, duration=1000),
+                    ]))
+        aggregator.flush()
+        r, w = sink
+        eq(r['reuse'], dict(new=[1, 1000], reused=[2, 5000]))
+        eq(r['hot_ranks'], 2)
+        eq(results.Histogram.from_dict(r['hot']).count, 2)
+        eq(results.Histogram.from_dict(r['cold']).max, 3000)
+        assert 'parts' not in r
+        assert 'reuse' not in w and 'hot' not in w
+        eq((w['parts']['size'], w['parts']['busy']), (30, 4000))
+        eq(results.Histogram.from_dict(w['parts']['latency']).count, 2)
+
+
+class TestLiveStats(object):
+    def test_report(self):
+        sink = ListSink()
+        stream = StringIO.StringIO()
+        live = results.LiveStats(sink, interval=3600, stream=stream, label='test')
+        for item in RESULTS:
+            live.put(item)
+        live.put(dict(type='w', start=3.0, duration=1000, size=100))
+        eq(sink, RESULTS + [dict(type='w', start=3.0, duration=1000, size=100)])
+        live.close()
+        lines = stream.getvalue().splitlines()
+        eq(len(lines), 2)
+        assert ' [test] ' in lines[0]
+        assert '1 errors' in lines[0]
+        assert ' w:' in lines[1]
+
+    def test_file(self):
+        import json
+        import os
+        import tempfile
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            live = results.LiveStats(ListSink(), interval=3600, path=path, stream=StringIO.StringIO())
+            live.put(RESULTS[1])
+            live.report()
+            live.report()
+            live.put(RESULTS[2])
+            live.close()
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            os.unlink(path)
+        eq([(l['op'], l['ops'], l['errors']) for l in lines], [('w', 1, 0), ('r', 0, 1)])
+        eq(lines[0]['p50'] * 1e9 >= 1234567, True)
+
+
+class TestTiming(object):
+    TIMING = dict(request=10, connect_start=20, connected=120, sent=150, first_byte=1150, last_byte=1200)
+
+    def test_components(self):
+        eq(results.timing_components(self.TIMING),
+           dict(prepare=10, connect=100, send=30, wait=1000, receive=50))
+        reused = dict(request=10, sent=150, first_byte=1150, last_byte=1200)
+        eq(results.timing_components(reused),
+           dict(prepare=10, send=140, wait=1000, receive=50))
+
+    def test_aggregate(self):
+        sink = ListSink()
+        aggregator = results.Aggregator(sink, interval=3600)
+        aggregator.put(dict(RESULTS[1], timing=self.TIMING))
+        aggregator.put(RESULTS[1])
+        aggregator.flush()
+        timing = sink[0]['timing']
+        eq(sorted(timing), sorted(results.TIMING_COMPONENTS))
+        wait = results.Histogram.from_dict(timing['wait'])
+        eq((wait.count, wait.max), (1, 1000))
@@ -0,0 +1,165 @@
+from s3tests import roundtrip
+from s3tests import realistic
+from s3tests import results
+
+import gevent.queue
+import random
+import re
+import time
+
+from nose.tools import eq_ as eq
+
+
+class ListQueue(list):
+    put = list.append
+
+
+def contents(size, seed=42):
+    return realistic.RandomContentFile(size, seed).read()
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def get_contents_to_file(self, fp):
+        (data, visible_at) = self.bucket.objects.get(self.name, (None, None))
+        if data is None or time.time() < visible_at:
+            raise IOError('404 Not Found')
+        fp.write(data)
+
+    def get_contents_as_string(self, headers):
+        (data, _) = self.bucket.objects[self.name]
+        (first, last) = re.match(r'bytes=(\d+)-(\d+)$', headers['Range']).groups()
+        return data[int(first):int(last) + 1]
+
+
+class FakeBucket(object):
+    name = 'bucket'
+    connection = None
+
+    def __init__(self):
+        # the contents of each object, and from when on they can be read
+        self.objects = {}
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+
+class TestVisibility(object):
+    def setup(self):
+        self.bucket = FakeBucket()
+        self.queue = ListQueue()
+
+    def check(self, delays, **kwargs):
+        buckets = gevent.queue.Queue()
+        buckets.put(self.bucket)
+        visibility = roundtrip.Visibility(buckets, self.queue, delays, **kwargs)
+        self.written = time.time()
+        visibility.put(dict(type='w', key='foo', start=self.written, duration=0, size=1000))
+        visibility.close()
+        eq(self.queue[0]['type'], 'w')
+        checks = [result for result in self.queue if result['type'] == 'visibility']
+        lags = dict(
+            (result['delay'], result)
+            for result in self.queue
+            if result['type'] == 'visibility_lag'
+            )
+        eq(sorted(lags), sorted(delays))
+        return (sorted(checks, key=lambda check: check['delay']), lags)
+
+    def test_retries_until_visible(self):
+        self.bucket.objects['foo'] = (contents(1000), time.time() + 0.1)
+        (checks, lags) = self.check([0, 0.05], retry=0.02, timeout=1)
+        for check in checks:
+            assert 'error' not in check
+            assert check['lag'] >= 0.1 * roundtrip.NANOSECOND
+            assert check['attempts'] > 1
+        eq(lags[0]['missing'], 0)
+        eq(lags[0]['lag']['count'], 1)
+        lag = results.Histogram.from_dict(lags[0.05]['lag'])
+        eq(lag.count, 1)
+        assert lag.min >= 0.1 * roundtrip.NANOSECOND
+
+    def test_visible_right_away(self):
+        self.bucket.objects['foo'] = (contents(1000), 0)
+        (checks, lags) = self.check([0.05], retry=0.02, timeout=1)
+        (check,) = checks
+        eq(check['attempts'], 1)
+        # read no sooner than asked for
+        assert check['lag'] >= 0.05 * roundtrip.NANOSECOND
+
+    def test_timeout(self):
+        (checks, lags) = self.check([0], retry=0.02, timeout=0.1)
+        (check,) = checks
+        assert 'not visible after 0.1 secs: 404 Not Found' in check['error']['msg']
+        assert 'lag' not in check
+        eq(lags[0]['missing'], 1)
+        eq(lags[0]['lag']['count'], 0)
+
+    def test_corrupted(self):
+        data = contents(1000)
+        self.bucket.objects['foo'] = (data[:500] + 'x' + data[501:], 0)
+        (checks, lags) = self.check([0], retry=0.02, timeout=0.1)
+        assert 'md5sum check failed' in checks[0]['error']['msg']
+        eq(lags[0]['missing'], 1)
+
+    def test_failed_writes_are_not_checked(self):
+        buckets = gevent.queue.Queue()
+        visibility = roundtrip.Visibility(buckets, self.queue, [0])
+        visibility.put(dict(type='w', key='foo', start=time.time(), duration=0, size=1000,
+                            error=dict(msg='oops')))
+        visibility.put(dict(type='r', key='foo', start=time.time(), duration=0, size=1000))
+        visibility.close()
+        eq([result['type'] for result in self.queue], ['w', 'r', 'visibility_lag'])
+        eq(self.queue[-1]['missing'], 0)
+
+
+class TestRandomRanges(object):
+    def test_ranges(self):
+        files = dict(small=100, large=1 << 20, empty=0)
+        ranges = list(roundtrip.random_ranges(random.Random(1), files, 4000, 1, 1 << 20))
+        eq(len(ranges), 4000)
+        lengths = dict(small=[], large=[])
+        for (objname, offset, length) in ranges:
+            assert 1 <= length <= files[objname]
+            assert 0 <= offset <= files[objname] - length
+            lengths[objname].append(length)
+        # cut to the object size
+        eq(max(lengths['small']), 100)
+        assert lengths['small'].count(100) > len(lengths['small']) / 2
+        # log-uniform: about as many up to 1KB as from there to 1MB
+        short = len([length for length in lengths['large'] if length <= 1024])
+        assert 0.4 < short / float(len(lengths['large'])) < 0.6, short
+
+    def test_no_objects(self):
+        eq(list(roundtrip.random_ranges(random.Random(1), dict(empty=0), 10, 1, 100)), [])
+
+
+class TestRangeReader(object):
+    def read(self, data, offset, length):
+        bucket = FakeBucket()
+        bucket.objects['foo'] = (data, 0)
+        queue = ListQueue()
+        roundtrip.range_reader(bucket, 'foo', offset, length, 100000, 42, {}, queue)
+        (result,) = queue
+        eq((result['type'], result['offset'], result['length']), ('range', offset, length))
+        return result
+
+    def test_intact(self):
+        result = self.read(contents(100000), 99000, 1000)
+        assert 'error' not in result
+        eq(result['size'], 1000)
+
+    def test_corrupted(self):
+        data = contents(100000)
+        data = data[:50000] + chr(ord(data[50000]) ^ 1) + data[50001:]
+        result = self.read(data, 49990, 20)
+        eq(result['error']['msg'], 'range check failed: 20 bytes from 49990, 20 expected')
+        # the rest still reads back intact
+        assert 'error' not in self.read(data, 50001, 1000)
+
+    def test_short(self):
+        result = self.read(contents(100000)[:99500], 99000, 1000)
+        eq(result['error']['msg'], 'range check failed: 500 bytes from 99000, 1000 expected')
@@ -0,0 +1,138 @@
+from s3tests import results
+from s3tests.analysis import rwstats
+
+import StringIO
+import bunch
+import os
+import sys
+import tempfile
+
+from nose.tools import eq_ as eq
+
+MS = rwstats.NANOSECONDS // 1000
+
+
+def reads(count, **kwargs):
+    # durations of 1 to count ms, all finished within 10 secs
+    items = []
+    for i in xrange(count):
+        item = dict(type='r', key='foo', start=1000.0 + i * 0.01, duration=(i + 1) * MS, size=1024)
+        item.update(kwargs)
+        items.append(item)
+    return items
+
+
+def aggregated(items, hot_ranks=None):
+    sink = []
+    aggregator = results.Aggregator(bunch.Bunch(put=sink.append), interval=3600, hot_ranks=hot_ranks)
+    for item in items:
+        aggregator.put(item)
+    aggregator.flush()
+    return sink
+
+
+class TestRWStats(object):
+    def setup(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+
+    def teardown(self):
+        os.unlink(self.path)
+
+    def analyze(self, items, hot_ranks=None):
+        """
+        Returns the stats of `items`, by name, and the report of them.
+        """
+        with open(self.path, 'wb') as f:
+            sink = results.ResultSink(f, format='jsonl')
+            for item in items:
+                sink.put(item)
+            sink.close()
+        options = bunch.Bunch(input=self.path, verbose=False, hot_ranks=hot_ranks)
+        # in the order calculate_stats and print_results take them
+        names = ['total', 'histograms', 'reuse', 'hotcold', 'timings', 'visibility',
+                 'parts', 'min_time', 'max_time', 'errors', 'success']
+        stats = bunch.Bunch((name, {}) for name in names)
+        args = [stats[name] for name in names]
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            rwstats.calculate_stats(options, *args)
+            rwstats.print_results(*args)
+            report = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return (stats, report)
+
+    def test_percentiles(self):
+        items = reads(1000)
+        items.append(dict(type='r', key='foo', start=1000.0, error=dict(msg='Not Found')))
+        for data in [items, aggregated(items)]:
+            (stats, report) = self.analyze(data)
+            latency = stats.histograms['r']
+            eq(latency.count, 1000)
+            for (p, ms) in [(50, 500), (90, 900), (99, 990), (99.9, 999)]:
+                assert abs(latency.percentile(p) - ms * MS) <= ms * MS * 0.01, (p, latency.percentile(p))
+            eq((stats.success['r'], stats.errors['r']), (1000, 1))
+            assert 'Stats for type: [r]' in report
+            assert 'Transactions:                   1001 hits' in report
+            assert '50th percentile:                0.50' in report
+            assert '99.9th percentile:              1.00' in report
+            assert 'Longest transaction:            1.00' in report
+
+    def test_labels(self):
+        items = [
+            dict(type='range', key='foo', start=1000.0, duration=MS, size=100, length=100),
+            dict(type='range', key='foo', start=1000.0, duration=MS, size=3000, length=3000),
+            dict(type='multipart', key='foo', start=1000.0, duration=MS, size=10, part_size=5 << 20),
+            ]
+        for data in [items, aggregated(items)]:
+            (stats, report) = self.analyze(data)
+            eq(sorted(stats.histograms), ['multipart 5120 KB parts', 'range up to 1 KB', 'range up to 4 KB'])
+
+    def test_hot_cold(self):
+        items = reads(4, rank=0) + reads(6, rank=5)
+        config = dict(type='config', access=dict(distribution='zipf', hot_ranks=2))
+        for data in [[config] + items, [config] + aggregated(items, hot_ranks=2)]:
+            (stats, report) = self.analyze(data)
+            eq(stats.hotcold['r'][True].count, 4)
+            eq(stats.hotcold['r'][False].count, 6)
+            assert 'Hot key transactions:              4 hits' in report
+            assert 'Cold key transactions:             6 hits' in report
+        # only per-op records can be split otherwise
+        (stats, report) = self.analyze(items, hot_ranks=6)
+        eq(stats.hotcold['r'][True].count, 10)
+
+    def test_reuse(self):
+        items = reads(3, reused=False) + reads(5, reused=True)
+        for data in [items, aggregated(items)]:
+            (stats, report) = self.analyze(data)
+            eq(stats.reuse['r'][False], [3, 6 * MS])
+            eq(stats.reuse['r'][True], [5, 15 * MS])
+            assert 'New connections:                   3 hits' in report
+            assert 'New connection time:            0.00 secs' in report
+            assert 'Reused connections:                5 hits' in report
+
+    def test_no_breakdowns(self):
+        (stats, report) = self.analyze(reads(3))
+        eq((stats.reuse, stats.hotcold, stats.parts, stats.visibility), ({}, {}, {}, {}))
+        assert 'connections' not in report
+        assert 'Hot key' not in report
+
+    def test_visibility(self):
+        lags = results.Histogram()
+        for ms in [10, 20, 30]:
+            lags.record(ms * MS)
+        more = results.Histogram()
+        more.record(40 * MS)
+        (stats, report) = self.analyze([
+                dict(type='visibility_lag', delay=0, missing=1, lag=lags.to_dict()),
+                dict(type='visibility_lag', delay=0, missing=0, lag=more.to_dict()),
+                dict(type='visibility_lag', delay=0.5, missing=2, lag=results.Histogram().to_dict()),
+                ])
+        (merged, missing) = stats.visibility[0]
+        eq((merged.count, merged.max, missing), (4, 40 * MS, 1))
+        eq(stats.visibility[0.5][1], 2)
+        assert 'Visibility from 0 secs:\nObjects seen:                      4 of 5' in report
+        assert 'Longest lag:                   0.040 secs' in report
+        assert 'Visibility from 0.5 secs:\nObjects seen:                      0 of 2' in report
@@ -27,6 +27,7 @@ setup(
             's3tests-test-roundtrip = s3tests.roundtrip:main',
             's3tests-fuzz-headers = s3tests.fuzz.headers:main',
             's3tests-analysis-rwstats = s3tests.analysis.rwstats:main',
+            's3tests-benchmark-content = s3tests.benchmark_content:main',
             ],
         },
 